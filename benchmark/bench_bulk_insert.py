@@ -0,0 +1,70 @@
+"""
+Benchmark: per-object ctx.db.add() vs bulk_insert / bulk_upsert on a local SQLite database.
+
+    python benchmark/bench_bulk_insert.py --rows 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import Column, Integer, String
+
+from lessweb.plugin import database
+from lessweb.plugin.database import DbModel
+
+
+class BenchRow(DbModel):
+    __tablename__ = 'bench_row'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+    score = Column(Integer)
+
+
+def per_object(session, rows):
+    for row in rows:
+        session.add(BenchRow(**row))
+    session.commit()
+
+
+def bulk_insert(session, rows, chunk_size):
+    BenchRow.bulk_insert(session, rows, chunk_size=chunk_size)
+    session.commit()
+
+
+def bulk_upsert(session, rows, chunk_size):
+    BenchRow.bulk_upsert(session, rows, chunk_size=chunk_size)
+    session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    rows = [{'id': i + 1, 'name': 'row%d' % i, 'score': i % 1000} for i in range(args.rows)]
+    cases = [
+        ('add() per object', lambda session: per_object(session, rows)),
+        ('bulk_insert', lambda session: bulk_insert(session, rows, args.chunk_size)),
+        ('bulk_upsert (new rows)', lambda session: bulk_upsert(session, rows, args.chunk_size)),
+    ]
+    print('%24s %10s %12s' % ('method', 'time(s)', 'rows/s'))
+    for name, fn in cases:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database.init(dburi='sqlite:///' + os.path.join(tmpdir, 'bench.db'), echo=False)
+            database.create_all(BenchRow)
+            with database.make_session() as session:
+                start = time.perf_counter()
+                fn(session)
+                elapsed = time.perf_counter() - start
+                assert session.query(BenchRow).count() == args.rows
+            database.global_data.db_engine.dispose()
+        print('%24s %10.2f %12.0f' % (name, elapsed, args.rows / elapsed))
+
+
+if __name__ == '__main__':
+    main()
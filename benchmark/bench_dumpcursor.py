@@ -0,0 +1,84 @@
+"""
+Benchmark: dumppage (COUNT + OFFSET) vs dumpcursor (keyset) on a local SQLite database.
+
+    python benchmark/bench_dumpcursor.py
+    python benchmark/bench_dumpcursor.py --rows 3000000   # deep pages of a large table (minutes, ~200MB file)
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import Column, Integer, String
+
+from lessweb.plugin import database
+from lessweb.plugin.database import DbModel, _encode_cursor
+
+
+class BenchRow(DbModel):
+    __tablename__ = 'bench_row'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+    score = Column(Integer, index=True)
+
+    def dump(self):
+        return {'id': self.id, 'name': self.name, 'score': self.score}
+
+
+def populate(rows, chunk=100000):
+    table = BenchRow.__table__
+    with database.global_data.db_engine.begin() as conn:
+        for start in range(0, rows, chunk):
+            conn.execute(table.insert(), [
+                {'id': i + 1, 'name': 'row%d' % i, 'score': i % 1000}
+                for i in range(start, min(rows, start + chunk))
+            ])
+
+
+def best_of(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database.init(dburi='sqlite:///' + os.path.join(tmpdir, 'bench.db'), echo=False)
+        database.create_all(BenchRow)
+        start = time.perf_counter()
+        populate(args.rows)
+        print('populated %d rows in %.1fs' % (args.rows, time.perf_counter() - start))
+
+        print('%10s %14s %14s' % ('page', 'dumppage(ms)', 'dumpcursor(ms)'))
+        with database.make_session() as session:
+            query = session.query(BenchRow)
+            pages = args.rows // args.size
+            for page_no in sorted({1, 10, 100, 1000, 10000, pages // 2, pages}):
+                if page_no < 1 or page_no > pages:
+                    continue
+                paging = database.dumppage(page_no, args.size)
+                cursor = database.dumpcursor(size=args.size, order_by=BenchRow.id)
+                if page_no > 1:  # the token a client would hold after reading page_no-1 pages
+                    cursor.after = _encode_cursor(cursor.signature, [(page_no - 1) * args.size])
+                offset_time = best_of(lambda: query.order_by(BenchRow.id) | paging, args.repeat)
+                cursor_time = best_of(lambda: query | cursor, args.repeat)
+                assert (query.order_by(BenchRow.id) | paging).list == (query | cursor).list
+                print('%10d %14.2f %14.2f' % (page_no, offset_time * 1000, cursor_time * 1000))
+        database.global_data.db_engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark: dumpall (ORM objects + dump()) vs dumprows (column tuples + RowMapper) on a local SQLite database.
+
+    python benchmark/bench_dumprows.py --rows 100000 --size 1000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import Column, Integer, String, DateTime, Numeric
+
+from lessweb.plugin import database
+from lessweb.plugin.database import DbModel
+
+
+class BenchRow(DbModel):
+    __tablename__ = 'bench_row'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+    score = Column(Integer)
+    price = Column(Numeric(12, 2))
+    created = Column(DateTime)
+
+    def dump(self):
+        return {'id': self.id, 'name': self.name, 'score': self.score, 'price': float(self.price),
+                'created': self.created.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def best_of(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database.init(dburi='sqlite:///' + os.path.join(tmpdir, 'bench.db'), echo=False)
+        database.create_all(BenchRow)
+        now = datetime(2020, 1, 1)
+        with database.make_session() as session:
+            BenchRow.bulk_insert(session, ({'name': 'row%d' % i, 'score': i % 1000, 'price': i / 100, 'created': now}
+                                           for i in range(args.rows)), chunk_size=10000)
+            session.commit()
+
+        print('%10s %14s %14s' % ('limit', 'dumpall(ms)', 'dumprows(ms)'))
+        with database.make_session() as session:
+            for limit in [10, 100, args.size, args.rows]:
+                query = session.query(BenchRow).order_by(BenchRow.id).limit(limit)
+                assert (query | database.dumpall) == (query | database.dumprows())
+                orm_time = best_of(lambda: (query | database.dumpall, session.expunge_all()), args.repeat)
+                rows_time = best_of(lambda: query | database.dumprows(), args.repeat)
+                print('%10d %14.2f %14.2f' % (limit, orm_time * 1000, rows_time * 1000))
+        database.global_data.db_engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
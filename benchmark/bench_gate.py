@@ -0,0 +1,242 @@
+"""
+Regression gate for benchmark/bench_micro.py: compares a run with the baseline of the running Python
+(benchmark/baselines/<implementation>-<major>.<minor>.json) and exits with status 1 if a benchmark
+got slower by more than the threshold.
+
+    python benchmark/bench_gate.py                     # run the benchmarks and compare
+    python benchmark/bench_gate.py --threshold 0.10    # fail above 10% slowdown (default 15%)
+    python benchmark/bench_gate.py --results run.json  # compare a saved run (bench_micro.py --json run.json)
+    python benchmark/bench_gate.py --update --runs 3   # run 3 times and store as the new baseline
+
+Noise handling:
+    * every result is the median of several samples (of several runs with --runs, each run scaled by its
+      own calibration), and the allowed slowdown of a benchmark is widened to 3 times the relative spread
+      of its baseline samples (median absolute deviation) when that is larger, up to 2 times the threshold;
+    * benchmarks which look regressed are measured again (--retries times, each with its own calibration)
+      and judged by the median of the changes of all their measurements: a real regression shows in most
+      of them, a burst of load on the machine during one measurement does not fail the gate. When the
+      measurements disagree by more than half the threshold the benchmark is reported as unstable (a warning:
+      run the gate again on a quieter machine) instead of REGRESSED;
+    * results are divided by a fixed pure-Python workload measured in the same run (--no-normalize: off),
+      so that a baseline recorded on another machine, or under a different load, stays comparable.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+
+import bench_micro
+
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+GROUPS = (
+    ('routing', 'dispatch'),
+    ('binding', 'fetch_'),
+    ('serialization', 'json_dumps'),
+    ('parsing', 'field_input'),
+    ('end-to-end', 'wsgifunc'),
+)
+
+
+def baseline_path():
+    return os.path.join(BASELINE_DIR, '%s-%s.json' % (
+        platform.python_implementation().lower(), '.'.join(platform.python_version_tuple()[:2])))
+
+
+def spread(samples):
+    """relative median absolute deviation"""
+    median = statistics.median(samples)
+    return statistics.median(abs(x - median) for x in samples) / median if median else 0.0
+
+
+def group_of(name):
+    for group, prefix in GROUPS:
+        if name.startswith(prefix):
+            return group
+    return 'other'
+
+
+def compare(baseline, current, threshold, normalize=True):
+    """
+    -> [{name, group, baseline, current, change, allowed, status}], status: ok, improved, REGRESSED, new, missing
+    (and unstable, see recheck())
+    change: relative change of ops/sec (normalized by the calibration workload if normalize)
+    """
+    normalize = normalize and 'calibration' in baseline and 'calibration' in current
+    base_scale = baseline['calibration'] if normalize else 1.0
+    cur_scale = current['calibration'] if normalize else 1.0
+    rows = []
+    for name in list(baseline['results']) + [n for n in current['results'] if n not in baseline['results']]:
+        base, cur = baseline['results'].get(name), current['results'].get(name)
+        row = {'name': name, 'group': group_of(name), 'baseline': base and base['ops_per_sec'],
+               'current': cur and cur['ops_per_sec'], 'change': None, 'allowed': threshold}
+        if base is None:
+            row['status'] = 'new'
+        elif cur is None:
+            row['status'] = 'missing'
+        else:
+            row['change'] = (cur['ops_per_sec'] / cur_scale) / (base['ops_per_sec'] / base_scale) - 1
+            # noise of the baseline only: a noisy current run must not hide a regression
+            row['allowed'] = min(max(threshold, 3 * spread(base['samples'])), 2 * threshold)
+            if row['change'] < -row['allowed']:
+                row['status'] = 'REGRESSED'
+            elif row['change'] > row['allowed']:
+                row['status'] = 'improved'
+            else:
+                row['status'] = 'ok'
+        rows.append(row)
+    return rows
+
+
+def recheck(rows, baseline, remeasure, retries, threshold, normalize=True):
+    """
+    -> rows, where each REGRESSED benchmark is replaced by its measurement of median change among the first one
+    and `retries` more (remeasure(name) -> a run of that benchmark alone, or None if it cannot be run);
+    its status is 'unstable' if it still looks regressed but the measurements disagree
+    """
+    checked = []
+    for row in rows:
+        measurements = [row]
+        while row['status'] == 'REGRESSED' and len(measurements) <= retries:
+            again = remeasure(row['name'])
+            if again is None:
+                break
+            measurements += compare(dict(baseline, results={row['name']: baseline['results'][row['name']]}),
+                                    again, threshold, normalize)
+        measurements.sort(key=lambda x: x['change'])
+        row = measurements[(len(measurements) - 1) // 2]
+        if row['status'] == 'REGRESSED' and spread([1 + x['change'] for x in measurements]) > threshold / 2:
+            row = dict(row, status='unstable')
+        checked.append(row)
+    return checked
+
+
+def group_changes(rows):
+    """-> {group: geometric mean of (1 + change) - 1} over the benchmarks present in both runs"""
+    ratios = {}
+    for row in rows:
+        if row['change'] is not None:
+            ratios.setdefault(row['group'], []).append(1 + row['change'])
+    return {group: statistics.geometric_mean(values) - 1 for group, values in ratios.items()}
+
+
+def format_report(rows, baseline, current):
+    lines = ['baseline: python %s, lessweb %s, %s (%s)' % (
+        baseline['environment']['python'], baseline['environment']['lessweb'],
+        baseline['environment']['machine'], baseline['environment']['time'])]
+    lines.append('%-42s %12s %12s %9s %9s  %s' % ('benchmark', 'baseline', 'current', 'change', 'allowed', 'status'))
+    for row in rows:
+        lines.append('%-42s %12s %12s %9s %9s  %s' % (
+            row['name'],
+            '-' if row['baseline'] is None else '%.0f' % row['baseline'],
+            '-' if row['current'] is None else '%.0f' % row['current'],
+            '-' if row['change'] is None else '%+.1f%%' % (row['change'] * 100),
+            '-%.1f%%' % (row['allowed'] * 100),
+            row['status']))
+    lines.append('')
+    for group, change in group_changes(rows).items():
+        lines.append('%-14s %+.1f%%' % (group, change * 100))
+    return '\n'.join(lines)
+
+
+def merge(runs):
+    """
+    one result per benchmark from several runs: the median of all their samples, after scaling the samples
+    of each run to the median calibration (a run on a slower moment of the machine counts as fast as the others)
+    """
+    calibration = statistics.median(run.get('calibration', 1.0) for run in runs)
+    merged = dict(runs[0], calibration=calibration, results={})
+    for name in runs[0]['results']:
+        results = [(run['results'][name], calibration / run.get('calibration', calibration))
+                   for run in runs if name in run['results']]
+        samples = [x * scale for result, scale in results for x in result['samples']]
+        merged['results'][name] = {
+            'ops_per_sec': statistics.median(samples),
+            'samples': samples,
+            'peak_bytes': min(result['peak_bytes'] for result, _ in results),
+            'retained_blocks': statistics.median(result['retained_blocks'] for result, _ in results),
+        }
+    return merged
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline', default=baseline_path(), help='baseline file (default: %(default)s)')
+    parser.add_argument('--results', help='compare this bench_micro.py --json output instead of running')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='allowed relative slowdown of a benchmark (default: %(default)s)')
+    parser.add_argument('--filter', help='only the benchmarks whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=7, help='samples per benchmark')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per sample')
+    parser.add_argument('--retries', type=int, default=4,
+                        help='measure regressed benchmarks this many times again (default: %(default)s)')
+    parser.add_argument('--no-normalize', dest='normalize', action='store_false',
+                        help='compare raw ops/sec (baseline recorded on this machine)')
+    parser.add_argument('--update', action='store_true', help='store the run as the baseline')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='run the benchmarks this many times and merge the samples (e.g. --update --runs 3)')
+    parser.add_argument('--json', metavar='PATH', help='write the comparison as JSON')
+    args = parser.parse_args()
+    assert 0 < args.threshold < 1, 'threshold:[{}] should be between 0 and 1'.format(args.threshold)
+    assert not (args.update and args.filter), '--update stores all the benchmarks, it cannot be filtered'
+
+    if args.results:
+        current = load(args.results)
+    else:
+        current = merge([bench_micro.run(args.filter, args.repeat, args.min_time, out=sys.stderr)
+                          for _ in range(args.runs)])
+
+    if args.update:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline written to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('no baseline for this Python: %s (create it with --update)' % args.baseline, file=sys.stderr)
+        return 2
+    baseline = load(args.baseline)
+    if args.filter:
+        baseline['results'] = {k: v for k, v in baseline['results'].items() if args.filter in k}
+
+    rows = compare(baseline, current, args.threshold, args.normalize)
+    cases = bench_micro.all_cases()
+
+    def remeasure(name):
+        if name not in cases:
+            return None
+        print('measuring again: %s' % name, file=sys.stderr)
+        calibrations = [bench_micro.calibrate(repeat=1)]
+        result = bench_micro.measure(cases[name], args.repeat, args.min_time)
+        calibrations.append(bench_micro.calibrate(repeat=1))
+        return {'calibration': statistics.median(calibrations), 'results': {name: result}}
+
+    if not args.results:
+        rows = recheck(rows, baseline, remeasure, args.retries, args.threshold, args.normalize)
+
+    print(format_report(rows, baseline, current))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'baseline': args.baseline, 'threshold': args.threshold, 'rows': rows,
+                       'groups': group_changes(rows)}, f, indent=2)
+    unstable = [row['name'] for row in rows if row['status'] == 'unstable']
+    if unstable:
+        print('\nwarning: the measurements of %s disagree, the machine is too noisy to tell' % ', '.join(unstable))
+    regressed = [row for row in rows if row['status'] in ('REGRESSED', 'missing')]
+    if regressed:
+        print('\n%d benchmark(s) regressed beyond the threshold' % len(regressed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Load test scenarios: hello world, a JSON list and a SQLite-backed page, served by each server mode.
+
+    python benchmark/bench_load.py -c 64 -d 10
+    python benchmark/bench_load.py --modes run --scenarios sqlite --json load.json
+
+Single scenario with custom options (see python -m lessweb.loadtest -h):
+
+    python -m lessweb.loadtest bench_load:json_app -r 'GET /items?size=100' --no-keepalive
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import Column, Integer, String
+
+from lessweb import Application, Context
+from lessweb.loadtest import Request, load_test, format_report
+from lessweb.plugin import database
+from lessweb.plugin.database import DbModel, DatabaseCtx
+
+
+class LoadItem(DbModel):
+    __tablename__ = 'load_item'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+    score = Column(Integer, index=True)
+
+    def dump(self):
+        return {'id': self.id, 'name': self.name, 'score': self.score}
+
+
+def _hello(ctx: Context):
+    return 'Hello, world!'
+
+
+def hello_app():
+    app = Application(debug=False)
+    app.add_get_mapping('/hello', _hello)
+    return app
+
+
+def _items(ctx: Context, size: int = 20):
+    return [{'id': i, 'name': 'item%d' % i, 'tags': ['a', 'b'], 'price': i * 1.5} for i in range(size)]
+
+
+def json_app():
+    app = Application(debug=False)
+    app.add_get_mapping('/items', _items)
+    return app
+
+
+def _page(ctx: DatabaseCtx, pageNo: int = 1, size: int = 20):
+    return ctx.db.query(LoadItem).order_by(LoadItem.id) | database.dumppage(pageNo, size)
+
+
+def _add(ctx: DatabaseCtx, name: str):
+    item = LoadItem(name=name, score=len(name))
+    ctx.db.add(item)
+    ctx.db.commit()
+    return item.dump()
+
+
+def sqlite_app(rows=10000):
+    database.init(dburi='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'load.db'), echo=False)
+    database.create_all(LoadItem)
+    with database.make_session() as session:
+        LoadItem.bulk_insert(session, [{'name': 'row%d' % i, 'score': i % 100} for i in range(rows)])
+        session.commit()
+    app = Application(debug=False)
+    app.add_interceptor('.*', '*', database.processor)
+    app.add_get_mapping('/items', _page)
+    app.add_post_mapping('/items', _add)
+    return app
+
+
+SCENARIOS = {
+    'hello': ('bench_load:hello_app', ['GET /hello']),
+    'json': ('bench_load:json_app', ['GET /items']),
+    'sqlite': ('bench_load:sqlite_app', [
+        'GET /items?pageNo=1@4', 'GET /items?pageNo=200@4',
+        Request('POST', '/items', body='name=x', headers={'Content-Type': 'application/x-www-form-urlencoded'}),
+    ]),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--modes', nargs='+', default=['run', 'wsgiref'], choices=['run', 'wsgiref'])
+    parser.add_argument('--workers', type=int, help='threads of Application.run()')
+    parser.add_argument('-c', '--concurrency', type=int, default=32)
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--no-keepalive', dest='keepalive', action='store_false')
+    parser.add_argument('--json', metavar='PATH', help='write the results as JSON')
+    args = parser.parse_args()
+
+    pythonpath = [os.path.dirname(os.path.abspath(__file__)), os.path.join(os.path.dirname(__file__), '..')]
+    results = []
+    for name in args.scenarios:
+        target, requests = SCENARIOS[name]
+        for mode in args.modes:
+            results.append(load_test(target, requests, mode, args.workers, args.concurrency, args.duration,
+                                     args.warmup, args.keepalive, seed=0, pythonpath=pythonpath))
+            report = format_report(results[-1:]).splitlines()
+            print('\n'.join(report if len(results) == 1 else report[1:]), flush=True)  # the header once
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
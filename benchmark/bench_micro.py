@@ -0,0 +1,298 @@
+"""
+Micro-benchmarks of the request path: routing/dispatch, parameter binding, JSON serialization,
+request body parsing and the whole WSGI cycle. Runs offline, in one process:
+
+    python benchmark/bench_micro.py
+    python benchmark/bench_micro.py --filter dispatch --json results.json
+
+Each case reports operations per second (median of --repeat samples, with the garbage collector disabled
+as in timeit), the peak memory allocated by one operation (tracemalloc) and the memory blocks still
+allocated per operation afterwards (a leak shows as > 0).
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime
+from decimal import Decimal
+from enum import Enum
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import lessweb
+from lessweb import Application, Context, Model
+from lessweb.application import _make_default_json_encoders
+from lessweb.model import fetch_param, fetch_model_param
+from lessweb.utils import json_dumps
+
+
+ROUTE_COUNTS = (10, 100, 1000)
+INTERCEPTOR_DEPTHS = (0, 5, 20)
+
+
+class Color(Enum):
+    red = 'red'
+    blue = 'blue'
+
+
+class ItemForm(Model):
+    id: int
+    name: str
+    price: float
+    color: Color
+    active: bool
+
+
+class Item(ItemForm):
+    createdAt: datetime
+
+
+def _environ(path, method='GET', query='', body=b'', content_type=None):
+    env = {
+        'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query, 'HTTP_HOST': 'localhost:8080',
+        'REMOTE_ADDR': '127.0.0.1', 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(body),
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    if content_type is not None:
+        env['CONTENT_TYPE'] = content_type
+    return env
+
+
+def _ok(ctx: Context):
+    return 'ok'
+
+
+def _pass_through(ctx: Context):
+    return ctx()
+
+
+def make_app(routes, interceptors):
+    app = Application(debug=False)
+    for _ in range(interceptors):
+        app.add_interceptor('.*', '*', _pass_through)
+    for i in range(routes):
+        app.add_get_mapping('/r%d/{id}' % i, _ok)
+    return app
+
+
+def dispatch_cases():
+    cases = {}
+    for routes in ROUTE_COUNTS:
+        for depth in INTERCEPTOR_DEPTHS:
+            app = make_app(routes, depth)
+            env = _environ('/r%d/42' % (routes - 1))  # the last route: every pattern is tried
+
+            def _1_dispatch(app=app, env=env):
+                app._handle_with_dealers(app._load(env))
+
+            cases['dispatch[routes=%d,interceptors=%d]' % (routes, depth)] = _1_dispatch
+    return cases
+
+
+def _get_item(ctx: Context, id: int, name: str, price: float, active: bool, pageNo: int = 1, tag: str = ''):
+    pass
+
+
+def _create_item(ctx: Context, item: ItemForm):
+    pass
+
+
+def binding_cases():
+    ctx = Context(Application())
+    ctx.url_input = {'id': '42'}
+    ctx._fields = {'name': 'apple', 'price': '3.5', 'active': 'true', 'pageNo': '2',
+                   'color': 'red', 'id': '42'}
+    return {
+        'fetch_param': lambda: fetch_param(ctx, _get_item),
+        'fetch_model_param': lambda: fetch_model_param(ctx, ItemForm, _create_item),
+    }
+
+
+def _decimal_jsonizer(x: Decimal):
+    return str(x)
+
+
+def serialization_cases():
+    encoders = _make_default_json_encoders([_decimal_jsonizer])
+    items = []
+    for i in range(100):
+        item = Item()
+        item.setall(id=i, name='item%d' % i, price=i * 1.5, color=Color.red, createdAt=datetime(2020, 1, 2),
+                    active=bool(i % 2))
+        items.append({'item': item, 'amount': Decimal('%d.25' % i), 'tags': ['a', 'b'], 'seen': datetime.now()})
+    plain = [{'id': i, 'name': 'item%d' % i, 'price': i * 1.5, 'tags': ['a', 'b']} for i in range(100)]
+    return {
+        'json_dumps[plain,100]': lambda: json_dumps(plain, encoders),
+        'json_dumps[jsonizers,100]': lambda: json_dumps(items, encoders),
+    }
+
+
+def _multipart_body(boundary):
+    parts = []
+    for name, value in (('name', 'apple'), ('price', '3.5'), ('active', 'true')):
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value))
+    parts.append('--%s\r\nContent-Disposition: form-data; name="photo"; filename="a.png"\r\n'
+                 'Content-Type: image/png\r\n\r\n' % boundary)
+    return ''.join(parts).encode() + b'\x89PNG' + b'\0' * 2048 + ('\r\n--%s--\r\n' % boundary).encode()
+
+
+def parsing_cases():
+    app = Application()
+    query = 'name=apple&price=3.5&active=true&pageNo=2&tag=x&tag=y'
+    json_body = json.dumps({'name': 'apple', 'price': 3.5, 'active': True, 'tags': ['x', 'y'] * 10}).encode()
+    boundary = 'lesswebbenchmarkboundary'
+    multipart_body = _multipart_body(boundary)
+
+    def _1_parse(method, query='', body=b'', content_type=None):
+        def _1_1_field_input():
+            ctx = app._load(_environ('/items', method, query, body, content_type))
+            return ctx.field_input
+
+        return _1_1_field_input
+
+    return {
+        'field_input[GET]': _1_parse('GET', query),
+        'field_input[JSON]': _1_parse('POST', body=json_body, content_type='application/json'),
+        'field_input[multipart]': _1_parse('POST', body=multipart_body,
+                                           content_type='multipart/form-data; boundary=' + boundary),
+    }
+
+
+def _list_items(ctx: Context, pageNo: int = 1):
+    return [{'id': i, 'name': 'item%d' % i, 'page': pageNo} for i in range(20)]
+
+
+def wsgi_cases():
+    app = make_app(20, 3)
+    app.add_get_mapping('/hello', lambda ctx: 'Hello, world!')
+    app.add_get_mapping('/items', _list_items)
+    wsgi = app.wsgifunc()
+
+    def _start_response(status, headers):
+        pass
+
+    def _1_request(path, query=''):
+        def _1_1_cycle():
+            body = wsgi(_environ(path, query=query), _start_response)
+            try:
+                return b''.join(body)
+            finally:
+                body.close()
+
+        return _1_1_cycle
+
+    return {
+        'wsgifunc[hello]': _1_request('/hello'),
+        'wsgifunc[json_list]': _1_request('/items', 'pageNo=2'),
+    }
+
+
+def all_cases():
+    cases = {}
+    for group in (dispatch_cases, binding_cases, serialization_cases, parsing_cases, wsgi_cases):
+        cases.update(group())
+    return cases
+
+
+def measure(fn, repeat=5, min_time=0.2):
+    """-> {ops_per_sec, samples, peak_bytes, retained_blocks}"""
+    fn()  # warm up (lazy imports, caches)
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    samples = [number / timer.timeit(number) for _ in range(repeat)]
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    for _ in range(100):
+        fn()
+    gc.collect()
+    retained = (sys.getallocatedblocks() - blocks) / 100
+    return {
+        'ops_per_sec': statistics.median(samples),
+        'samples': samples,
+        'peak_bytes': peak_bytes,
+        'retained_blocks': retained,
+    }
+
+
+def _calibration_workload():
+    data = {}
+    for i in range(200):
+        data['k%d' % i] = [i, str(i), (i, i * 2)]
+    return sorted(data.items(), key=lambda kv: kv[1][1])
+
+
+def calibrate(repeat=5):
+    """-> ops/sec of a fixed pure-Python workload, best of repeat (bench_gate.py compares runs relative to it)"""
+    timer = timeit.Timer(_calibration_workload)
+    number, _ = timer.autorange()
+    return max(number / timer.timeit(number) for _ in range(repeat))
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'lessweb': lessweb.__version__,
+        'time': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def run(filter=None, repeat=5, min_time=0.2, out=sys.stdout):
+    """
+    -> {'environment': {...}, 'calibration': calibrate(), 'results': {name: measure()}}
+    prints a table to out (None: quiet)
+    The calibration is measured before each benchmark and the median is kept, as the speed of a shared machine
+    changes during a run.
+    """
+    results, calibrations = {}, []
+    if out is not None:
+        print('%-42s %14s %10s %16s' % ('benchmark', 'ops/sec', 'peak(B)', 'retained(blk/op)'), file=out)
+    for name, fn in all_cases().items():
+        if filter and filter not in name:
+            continue
+        calibrations.append(calibrate(repeat=1))
+        result = results[name] = measure(fn, repeat, min_time)
+        if out is not None:
+            print('%-42s %14.0f %10d %16.2f' % (name, result['ops_per_sec'], result['peak_bytes'],
+                                                 result['retained_blocks']), file=out)
+            out.flush()
+    calibrations.append(calibrate(repeat=1))
+    return {'environment': environment(), 'calibration': statistics.median(calibrations), 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', help='run the benchmarks whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=5, help='samples per benchmark')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per sample')
+    parser.add_argument('--json', metavar='PATH', help="write the results as JSON ('-': stdout)")
+    args = parser.parse_args()
+
+    report = run(args.filter, args.repeat, args.min_time, out=sys.stderr if args.json == '-' else sys.stdout)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
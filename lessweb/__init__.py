@@ -15,8 +15,10 @@ from .context import Context
 from .model import get_annotations, get_func_parameters, get_model_parameters, Model
 from .model import RestParam, Jsonable
 from .storage import Storage
+from .sse import ServerSentEvent, EventStream
 from .webapi import HttpError, MovedPermanently, Found, SeeOther, NotModified, TempRedirect, \
     BadRequest, Unauthorized, Forbidden, NotFound, NoMethod, NotAcceptable, Conflict, Gone, \
-    PreconditionFailed, UnsupportedMediaType, UnavailableForLegalReasons, InternalError
+    PreconditionFailed, UnsupportedMediaType, UnavailableForLegalReasons, InternalError, ServiceUnavailable, \
+    GatewayTimeout, UnprocessableEntity, TooManyRequests
 from .webapi import UploadedFile, status_table, NeedParamError, BadParamError
 from .utils import _nil, Service, eafp, json_dumps, ChainMock
@@ -2,23 +2,31 @@
 Web application
 (from lessweb)
 """
+import asyncio
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
+import inspect
 import itertools
 import json
 import logging
 import os
 import re
+import threading
 import traceback
 from types import GeneratorType
-from typing import NamedTuple, Any, Callable, Tuple, Dict
+from typing import NamedTuple, Any, Callable, Tuple, Dict, Optional
 from enum import Enum
 from urllib.parse import splitquery, urlencode
 from io import BytesIO
 from contextlib import contextmanager
 
-from lessweb.webapi import HttpError, NotFound, NoMethod, NeedParamError, BadParamError
+from lessweb.webapi import HttpError, NotFound, NoMethod, NeedParamError, BadParamError, ServiceUnavailable
 from lessweb.webapi import http_methods
 from lessweb.context import Context
+from lessweb.background import BackgroundPool
+from lessweb.limiter import ConcurrencyLimiter, AsyncConcurrencyLimiter
+from lessweb.singleflight import CREDENTIAL_HEADERS, RequestCoalescer
+from lessweb.sse import EventStream
 from lessweb.model import fetch_param, Model, Jsonable
 from lessweb.storage import Storage
 from lessweb.utils import eafp, json_dumps, re_standardize
@@ -42,7 +50,8 @@ class Interceptor:
 # Application.mapping: List[Mapping]
 class Mapping:
     """Mapping to定义请求处理者和path的对应关系"""
-    def __init__(self, pattern, method, dealer, doc, patternobj, view, querynames) -> None:
+    def __init__(self, pattern, method, dealer, doc, patternobj, view, querynames, limiter=None,
+                 coalescer=None, timeout=None) -> None:
         self.pattern: str = pattern
         self.method: str = method
         self.dealer: Callable = dealer
@@ -50,6 +59,9 @@ class Mapping:
         self.patternobj: Any = patternobj
         self.view = view
         self.querynames = querynames
+        self.limiter: Optional[ConcurrencyLimiter] = limiter
+        self.coalescer: Optional[RequestCoalescer] = coalescer
+        self.timeout: Optional[float] = timeout
 
 
 def build_controller(dealer):
@@ -87,18 +99,48 @@ def interceptor(dealer):
         >>> assert list(ret) == ['ctx', 'id', 'lpn'], ret
     """
     def _1_wrapper(fn):
-        def _1_1_controller(ctx:Context):
-            ctx.app_stack.append(build_controller(fn))
+        async def _1_1_await(ctx, controller, coro):
+            ctx.app_stack.append(controller)
+            try:
+                return await coro
+            finally:
+                ctx.app_stack.pop()
+
+        def _1_2_controller(ctx:Context):
+            controller = build_controller(fn)
+            ctx.app_stack.append(controller)
             params = fetch_param(ctx, dealer)
             result = dealer(**params)
             ctx.app_stack.pop()  # 有多次调用ctx()的可能性，比如批量删除
+            if inspect.iscoroutine(result):  # async interceptor: 它的ctx()在被await时才执行
+                return _1_1_await(ctx, controller, result)
             return result
 
-        return _1_1_controller
+        return _1_2_controller
 
     return _1_wrapper
 
 
+class _ResponseBody:
+    """WSGI response iterable: when the server closes it after sending, runs the tasks from ctx.defer()"""
+    def __init__(self, iterable, generator, ctx, aiter=None) -> None:
+        self.iterable = iterable
+        self.generator = generator  # the dealer's generator, if any
+        self.ctx: Context = ctx
+        self.aiter = aiter  # async body served on the event loop by lessweb.server.StreamingWSGIHandler
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if self.generator is not None:
+                self.generator.close()
+        finally:
+            for fn, args, kwargs in self.ctx._deferred:
+                self.ctx.app.background.submit(fn, *args, **kwargs)
+
+
 def _make_default_json_encoders(jsonizers):
     def _jsonable_encoder(obj:Jsonable):
         if hasattr(obj, 'lessweb_jsonize'):
@@ -131,17 +173,52 @@ class Application(object):
         app.add_mapping('/hello', lambda ctx: 'Hello!')
         app.run(port=8080)
 
+    timeout: 默认的请求时间预算(秒)，用于设置ctx.deadline，可被add_mapping(..., timeout=...)覆盖
+    defer_workers, defer_queue: 执行ctx.defer()任务的后台线程数和队列长度
+
     """
-    def __init__(self, encoding='utf-8', debug=True) -> None:
+    def __init__(self, encoding='utf-8', debug=True, timeout=None, defer_workers=4, defer_queue=1000) -> None:
         self.mapping = []
         self.interceptors = []
         self.jsonizers = []
         self.encoding: str = encoding
         self.debug: bool = debug
+        self.timeout: Optional[float] = timeout
+        self.background = BackgroundPool(defer_workers, defer_queue)
+        self.server_limiter: Optional[AsyncConcurrencyLimiter] = None  # set by run()
+        self._async_loop = None
+        self._async_lock = threading.Lock()
+
+    def _get_async_loop(self):
+        """event loop thread of the application, used to run async dealers when not served by run()"""
+        with self._async_lock:
+            if self._async_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='lessweb-async', daemon=True).start()
+                self._async_loop = loop
+            return self._async_loop
+
+    def _run_coroutine(self, coro, ctx):
+        """
+        Wait for the coroutine returned by an async dealer / interceptor. It runs on the event loop of run(),
+        or on the application's own event loop thread, so that async resources (e.g. the connection pool of
+        lessweb.plugin.aiodatabase) always stay on one loop.
+        """
+        loop = (ctx.env or {}).get('lessweb.loop') or self._get_async_loop()
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result(ctx.remaining())
+        except FutureTimeoutError:
+            future.cancel()
+            ctx.check_deadline()
+            raise
 
     def _load(self, env):
         ctx = Context(self)
         ctx.environ = ctx.env = env
+        request = env.get('aiohttp.request')  # run()记录的收到请求的时间，包含在event loop上排队的时间
+        if request is not None and 'lessweb.received_at' in request:
+            ctx.received_at = request['lessweb.received_at']
         ctx.host = env.get('HTTP_HOST', '[unknown]')
         if env.get('wsgi.url_scheme') in ['http', 'https']:
             ctx.protocol = env['wsgi.url_scheme']
@@ -177,6 +254,7 @@ class Application(object):
                 if _:
                     if mapping.method == ctx.method or mapping.method == '*':
                         ctx.url_input = _.groupdict()
+                        ctx.mapping = mapping
                         ctx.view = mapping.view
                         if mapping.querynames == '*':
                             ctx.querynames = None
@@ -184,7 +262,10 @@ class Application(object):
                             ctx.querynames = mapping.querynames.replace(',', ' ').split()
                         else:
                             ctx.querynames = mapping.querynames
-                        return mapping.dealer
+                        timeout = self.timeout if mapping.timeout is None else mapping.timeout
+                        if timeout is not None:
+                            ctx.deadline = ctx.received_at + timeout
+                        return mapping
                     else:
                         supported_methods.append(mapping.method)
 
@@ -193,12 +274,44 @@ class Application(object):
             else:
                 raise NoMethod(text="Method Not Allowed", methods=supported_methods)
 
+        def _2_call(f, limiter):
+            ctx.check_deadline()  # 已超时的请求不再排队和执行
+            if limiter is not None:
+                try:
+                    limiter.acquire(timeout=ctx.remaining())
+                except ServiceUnavailable:
+                    ctx.check_deadline()  # 排队等到了deadline: 504
+                    raise
+            try:
+                ctx.check_deadline()
+                result = f(ctx)
+                if inspect.iscoroutine(result):
+                    result = self._run_coroutine(result, ctx)
+            finally:
+                if limiter is not None:
+                    limiter.release()
+            if not isinstance(result, GeneratorType):
+                ctx.check_deadline()
+            return result
+
+        def _3_call_encoded(f, limiter):
+            result = _2_call(f, limiter)
+            body = b''.join(self._encode_result(result if isinstance(result, GeneratorType) else (result,)))
+            return ctx.status_code, ctx.reason, list(ctx.headers), body
+
         try:
-            f = build_controller(_1_mapping_match())
+            mapping = _1_mapping_match()
+            f = build_controller(mapping.dealer)
             for itr in self.interceptors:
                 if itr.patternobj.search(ctx.path) and (itr.method == ctx.method or itr.method == '*'):
                     f = interceptor(itr.dealer)(f)
-            return f(ctx)
+            coalescer = mapping.coalescer
+            if coalescer is None or ctx.method not in ('GET', 'HEAD'):
+                return _2_call(f, mapping.limiter)
+            ctx.status_code, ctx.reason, headers, body = coalescer.do(
+                coalescer.key(ctx), lambda: _3_call_encoded(f, mapping.limiter), coalescer.timeout)
+            ctx.headers = list(headers)
+            return body
         except HttpError as e:
             ctx.status_code = e.status_code
             ctx.reason = e.reason
@@ -226,7 +339,10 @@ class Application(object):
         patternobj = re.compile(re_standardize(pattern))
         self.interceptors.insert(0, Interceptor(pattern, method, dealer, patternobj))
 
-    def add_mapping(self, pattern, method, dealer, doc='', view=None, querynames='*'):
+    def add_mapping(self, pattern, method, dealer, doc='', view=None, querynames='*',
+                    max_concurrency=None, max_queue=0, queue_timeout=None, retry_after=1,
+                    coalesce=False, coalesce_query=None, coalesce_vary=CREDENTIAL_HEADERS, coalesce_timeout=10,
+                    timeout=None):
         """
         Example:
 
@@ -239,65 +355,114 @@ class Application(object):
             app.add_mapping('/hello/(?P<name>.+)', 'GET', sayhello)
             app.add_mapping('/age/(?P<age>[0-9]+)', 'GET', sayhello)
             app.run()
+
+        max_concurrency: 该路由同时执行的请求数上限，超出的请求最多max_queue个排队等待，
+            队列已满或等待超过queue_timeout秒则返回503，并带上Retry-After: retry_after
+        coalesce: 合并同时到达的相同GET/HEAD请求，只执行一次dealer并共享编码后的响应。
+            相同请求指method、path、coalesce_query中的query参数(None表示完整query)
+            和coalesce_vary中的请求头都相同；等待超过coalesce_timeout秒则自己执行。
+            等待者不执行自己的interceptor，coalesce_vary默认为Authorization和Cookie，
+            避免不同用户共享响应；给出coalesce_vary时，响应与用户有关就要包含凭证头
+        timeout: 该路由的请求时间预算(秒)，覆盖Application的timeout。超时后dealer返回时响应504，
+            dealer中可以用ctx.remaining()/ctx.check_deadline()提前放弃
         """
         assert isinstance(pattern, str), 'pattern:[{}] should be RegExp str'.format(pattern)
         method = method.upper()
         assert method == '*' or method in http_methods, 'Method:[{}] should be one of {}'.format(method, ['*'] + http_methods)
         patternobj = re.compile(re_standardize(pattern))
-        self.mapping.append(Mapping(pattern, method, dealer, doc, patternobj, view, querynames))
+        limiter = None
+        if max_concurrency is not None:
+            limiter = ConcurrencyLimiter(max_concurrency, max_queue, queue_timeout, retry_after)
+        coalescer = None
+        if coalesce:
+            coalescer = RequestCoalescer(coalesce_query, coalesce_vary, coalesce_timeout)
+        self.mapping.append(Mapping(pattern, method, dealer, doc, patternobj, view, querynames, limiter, coalescer,
+                                    timeout))
 
     # add_*_interceptor / add_*_mapping are generated by code below:
     """
     for m in ['CONNECT', 'DELETE', 'GET', 'HEAD', 'OPTIONS', 'POST', 'PUT']:
         print(("def add_{m}_interceptor(self, pattern, dealer): return self.add_interceptor(pattern, '{M}', dealer)\n"
-        "def add_{m}_mapping(self, pattern, dealer, doc='', view=None, querynames='*'): return self.add_mapping(pattern, '{M}', dealer, doc, view, querynames)\n")
+        "def add_{m}_mapping(self, pattern, dealer, doc='', view=None, querynames='*', **options): return self.add_mapping(pattern, '{M}', dealer, doc, view, querynames, **options)\n")
         .format(m=m.lower(), M=m))
     """
     def add_connect_interceptor(self, pattern, dealer):
         return self.add_interceptor(pattern, 'CONNECT', dealer)
 
-    def add_connect_mapping(self, pattern, dealer, doc='', view=None, querynames='*'):
-        return self.add_mapping(pattern, 'CONNECT', dealer, doc, view, querynames)
+    def add_connect_mapping(self, pattern, dealer, doc='', view=None, querynames='*', **options):
+        return self.add_mapping(pattern, 'CONNECT', dealer, doc, view, querynames, **options)
 
     def add_delete_interceptor(self, pattern, dealer):
         return self.add_interceptor(pattern, 'DELETE', dealer)
 
-    def add_delete_mapping(self, pattern, dealer, doc='', view=None, querynames='*'):
-        return self.add_mapping(pattern, 'DELETE', dealer, doc, view, querynames)
+    def add_delete_mapping(self, pattern, dealer, doc='', view=None, querynames='*', **options):
+        return self.add_mapping(pattern, 'DELETE', dealer, doc, view, querynames, **options)
 
     def add_get_interceptor(self, pattern, dealer):
         return self.add_interceptor(pattern, 'GET', dealer)
 
-    def add_get_mapping(self, pattern, dealer, doc='', view=None, querynames='*'):
-        return self.add_mapping(pattern, 'GET', dealer, doc, view, querynames)
+    def add_get_mapping(self, pattern, dealer, doc='', view=None, querynames='*', **options):
+        return self.add_mapping(pattern, 'GET', dealer, doc, view, querynames, **options)
 
     def add_head_interceptor(self, pattern, dealer):
         return self.add_interceptor(pattern, 'HEAD', dealer)
 
-    def add_head_mapping(self, pattern, dealer, doc='', view=None, querynames='*'):
-        return self.add_mapping(pattern, 'HEAD', dealer, doc, view, querynames)
+    def add_head_mapping(self, pattern, dealer, doc='', view=None, querynames='*', **options):
+        return self.add_mapping(pattern, 'HEAD', dealer, doc, view, querynames, **options)
 
     def add_options_interceptor(self, pattern, dealer):
         return self.add_interceptor(pattern, 'OPTIONS', dealer)
 
-    def add_options_mapping(self, pattern, dealer, doc='', view=None, querynames='*'):
-        return self.add_mapping(pattern, 'OPTIONS', dealer, doc, view, querynames)
+    def add_options_mapping(self, pattern, dealer, doc='', view=None, querynames='*', **options):
+        return self.add_mapping(pattern, 'OPTIONS', dealer, doc, view, querynames, **options)
 
     def add_post_interceptor(self, pattern, dealer):
         return self.add_interceptor(pattern, 'POST', dealer)
 
-    def add_post_mapping(self, pattern, dealer, doc='', view=None, querynames='*'):
-        return self.add_mapping(pattern, 'POST', dealer, doc, view, querynames)
+    def add_post_mapping(self, pattern, dealer, doc='', view=None, querynames='*', **options):
+        return self.add_mapping(pattern, 'POST', dealer, doc, view, querynames, **options)
 
     def add_put_interceptor(self, pattern, dealer):
         return self.add_interceptor(pattern, 'PUT', dealer)
 
-    def add_put_mapping(self, pattern, dealer, doc='', view=None, querynames='*'):
-        return self.add_mapping(pattern, 'PUT', dealer, doc, view, querynames)
+    def add_put_mapping(self, pattern, dealer, doc='', view=None, querynames='*', **options):
+        return self.add_mapping(pattern, 'PUT', dealer, doc, view, querynames, **options)
 
     def add_jsonizer(self, jsonizer):
         self.jsonizers.append(jsonizer)
 
+    def concurrency_stats(self):
+        """
+        Counters of the server-wide wait queue (when run() is given max_workers and max_queue),
+        of each mapping with max_concurrency and of each mapping with coalesce.
+
+            {'server': Storage(active=.., waiting=.., admitted=.., rejected=.., ...) or None,
+             'mapping': {'GET /report': Storage(...), ...},
+             'coalesce': {'GET /items': Storage(executions=.., shared=.., fallbacks=.., inflight=..), ...}}
+        """
+        return Storage(
+            server=self.server_limiter.stats() if self.server_limiter else None,
+            mapping={
+                '%s %s' % (m.method, m.pattern): m.limiter.stats()
+                for m in self.mapping if m.limiter is not None
+            },
+            coalesce={
+                '%s %s' % (m.method, m.pattern): m.coalescer.stats()
+                for m in self.mapping if m.coalescer is not None
+            },
+        )
+
+    def _encode_result(self, result):
+        for r in result:
+            if isinstance(r, bytes):
+                yield r
+            elif isinstance(r, str):
+                yield r.encode(self.encoding)
+            elif r is None:
+                yield b''
+            else:
+                yield json_dumps(r, _make_default_json_encoders(self.jsonizers)).encode(self.encoding)
+
     def wsgifunc(self, *middleware):
         """
             Example:
@@ -322,32 +487,44 @@ class Application(object):
                     firstchunk = ''
                 return itertools.chain([firstchunk], iterator)
 
+            async def _2_aencode(aiter):
+                try:
+                    async for text in aiter:
+                        yield text.encode('utf-8')
+                finally:
+                    await aiter.aclose()
+
             ctx = self._load(env)
+            generator = aiter = None
             try:
                 _ = self._handle_with_dealers(ctx)
-                result = _1_peep(_) if isinstance(_, GeneratorType) else (_,)
+                if isinstance(_, EventStream):
+                    for k, v in EventStream.headers:
+                        ctx.set_header(k, v)
+                    encode = lambda obj: json_dumps(obj, _make_default_json_encoders(self.jsonizers))
+                    if not _.is_async:
+                        _ = (text.encode('utf-8') for text in _.iter_text(encode))
+                    elif not env.get('lessweb.async_body'):
+                        _ = (text.encode('utf-8') for text in _.iter_text_blocking(encode))
+                    else:
+                        aiter = _2_aencode(_.aiter_text(encode))
+                        _ = ()
+                if isinstance(_, GeneratorType):
+                    generator = _
+                    result = _1_peep(_)
+                else:
+                    result = (_,)
             except Exception as e:
                 logging.exception(e)
                 ctx.status_code, ctx.reason = 500, 'Internal Server Error'
                 result = (traceback.format_exc(),)
 
-            def _2_build_result(result):
-                for r in result:
-                    if isinstance(r, bytes):
-                        yield r
-                    elif isinstance(r, str):
-                        yield r.encode(self.encoding)
-                    elif r is None:
-                        yield b''
-                    else:
-                        yield json_dumps(r, _make_default_json_encoders(self.jsonizers)).encode(self.encoding)
-
-            result = _2_build_result(result)
+            result = self._encode_result(result)
             status = '{0} {1}'.format(ctx.status_code, ctx.reason)
             ctx.set_header('Content-Type', 'text/html; charset=' + self.encoding, setdefault=True)
             headers = list(ctx.headers)
             start_resp(status, headers)
-            return itertools.chain(result, (b'',))
+            return _ResponseBody(itertools.chain(result, (b'',)), generator, ctx, aiter)
 
         for m in middleware:
             wsgi = m(wsgi)
@@ -391,7 +568,11 @@ class Application(object):
             response.header_items = headers
 
         data = self.wsgifunc()(env, start_response)
-        response.data = b"".join(data)
+        try:
+            response.data = b"".join(data)
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
         return response
 
     @contextmanager
@@ -436,7 +617,8 @@ class Application(object):
     def test_put(self, localpart='/', data=None, headers=None, status_code=200, parsejson=True, https=False, env=None):
         return self._reqtest(localpart, 'PUT', data, headers, status_code, parsejson, https, env)
 
-    def run(self, wsgifunc=None, port:int=8080, homepath=''):
+    def run(self, wsgifunc=None, port:int=8080, homepath='',
+            max_workers=None, max_queue=None, queue_timeout=None, retry_after=1):
         """
         Example:
 
@@ -445,9 +627,16 @@ class Application(object):
             app.add_interceptor('/', '*', lambda ctx: ctx() + ' world!')
             app.add_mapping('/hello', lambda ctx: 'Hello')
             app.run(port=80, homepath='/api')
+
+        生成器响应按chunk流式发送；EventStream(异步生成器)在event loop上发送，不占用线程。
+
+        max_workers: 执行wsgifunc的线程池大小(默认使用asyncio的默认executor)
+        max_queue: 线程全忙时最多排队等待的请求数，队列已满或等待超过queue_timeout秒
+            则在event loop上直接返回503(带Retry-After: retry_after)，不占用线程
         """
+        from concurrent.futures import ThreadPoolExecutor
         from aiohttp import web
-        from aiohttp_wsgi import WSGIHandler
+        from lessweb.server import StreamingWSGIHandler
         app = web.Application()
         if wsgifunc is None:
             wsgifunc = self.wsgifunc()
@@ -457,5 +646,16 @@ class Application(object):
         if homepath and homepath[0] != '/':
             homepath = '/' + homepath
 
-        app.router.add_route("*", homepath + "/{path_info:.*}", WSGIHandler(wsgifunc))
+        executor = None
+        if max_workers is not None:
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lessweb')
+        if max_workers is not None and max_queue is not None:
+            self.server_limiter = AsyncConcurrencyLimiter(max_workers, max_queue, queue_timeout, retry_after)
+        handler = StreamingWSGIHandler(wsgifunc, executor=executor, limiter=self.server_limiter)
+
+        async def drain_background(_app):
+            await asyncio.get_event_loop().run_in_executor(None, self.background.shutdown)
+
+        app.router.add_route("*", homepath + "/{path_info:.*}", handler)
+        app.on_cleanup.append(drain_background)
         web.run_app(app, port=port)
@@ -0,0 +1,81 @@
+"""
+Background tasks deferred until the response is sent
+(from lessweb)
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from lessweb.storage import Storage
+
+
+__all__ = [
+    "BackgroundPool",
+]
+
+
+class BackgroundPool:
+    """
+    执行ctx.defer()登记的任务的有界线程池。
+    排队+执行中的任务数达到max_queue时，新任务在调用者线程中直接执行(不丢弃任务)；
+    任务抛出的异常只记录日志。
+
+        >>> pool = BackgroundPool(max_workers=1, max_queue=10)
+        >>> done = []
+        >>> pool.submit(done.append, 1)
+        >>> pool.submit(lambda: 1 / 0)
+        >>> pool.shutdown()
+        >>> done, pool.stats()
+        ([1], <Storage {'pending': 0, 'completed': 1, 'failed': 1, 'inline': 0}>)
+    """
+    def __init__(self, max_workers=4, max_queue=1000) -> None:
+        assert max_workers >= 1, 'max_workers:[{}] should be >= 1'.format(max_workers)
+        self.max_workers: int = max_workers
+        self.max_queue: int = max_queue
+        self._executor = None  # 第一次submit时才创建线程池
+        self._lock = threading.Lock()
+        self._closed = False
+        self.pending: int = 0
+        self.completed: int = 0
+        self.failed: int = 0
+        self.inline: int = 0  # 因队列已满或已关闭而在调用者线程中执行的任务数
+
+    def _run(self, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logging.exception(e)
+            with self._lock:
+                self.failed += 1
+        else:
+            with self._lock:
+                self.completed += 1
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            inline = self._closed or self.pending >= self.max_queue
+            self.pending += 1
+            if inline:
+                self.inline += 1
+            elif self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='lessweb-defer')
+        if inline:
+            logging.warning('lessweb background queue is full, running %r inline', fn)
+            self._run(fn, args, kwargs)
+        else:
+            self._executor.submit(self._run, fn, args, kwargs)
+
+    def shutdown(self, wait=True):
+        """停止接收新任务(之后的任务在调用者线程中执行)，wait=True时等待已排队的任务执行完"""
+        with self._lock:
+            self._closed = True
+            executor = self._executor
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self):
+        return Storage(pending=self.pending, completed=self.completed, failed=self.failed, inline=self.inline)
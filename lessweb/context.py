@@ -3,6 +3,7 @@ import cgi
 import json
 import os
 import gzip
+import time
 import requests
 from wsgiref.handlers import format_date_time
 from datetime import datetime, timedelta
@@ -11,7 +12,7 @@ from time import mktime
 from io import BytesIO
 
 from lessweb.storage import Storage
-from lessweb.webapi import UploadedFile, HttpError, mimetypes, hop_by_hop_headers
+from lessweb.webapi import UploadedFile, HttpError, GatewayTimeout, mimetypes, hop_by_hop_headers
 from lessweb.webapi import make_cookie, parse_cookie, set_header
 from lessweb.utils import _nil, fields_in_query
 
@@ -60,6 +61,11 @@ class Context(object):
             fullpath => /hello/echo?a=1&b=2
 
         lessweb use ctx.path in routing.
+
+    Request deadline:
+        * received_at – time.monotonic() when the request was received
+        * deadline – time.monotonic() after which the request is abandoned (504), or None without timeout.
+          Set from Application(timeout=...) or add_mapping(..., timeout=...).
     """
     def __init__(self, app=None) -> None:
         self.status_code: int = 200
@@ -67,6 +73,7 @@ class Context(object):
         self.headers: List = []
         self.app_stack: List = []
         self.app = app
+        self.mapping = None  # the matched lessweb.application.Mapping
         self.view = None
         self.querynames = None  # querynames in whitelist
         self.aliases: Dict[str, str] = {}  # alias {realname: queryname}
@@ -91,9 +98,40 @@ class Context(object):
         self.query: str = ''
         self.fullpath: str = ''
 
+        self.received_at: float = time.monotonic()
+        self.deadline: Optional[float] = None
+        self._deferred: List = []
+
     def __call__(self):
         return self.app_stack[-1](self)
 
+    def remaining(self) -> Optional[float]:
+        """
+        Seconds left before ctx.deadline, or None if the request has no deadline.
+
+            >>> ctx = Context()
+            >>> ctx.remaining() is None
+            True
+            >>> ctx.deadline = time.monotonic() - 1
+            >>> ctx.remaining()
+            0.0
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check_deadline(self):
+        """Raise GatewayTimeout(504) if ctx.deadline has passed; call it between slow steps."""
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise GatewayTimeout()
+
+    def defer(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) on app.background after the response has been sent,
+        e.g. audit logging, cache warming or webhook fan-out.
+        """
+        self._deferred.append((fn, args, kwargs))
+
     def set_param(self, realname, realvalue):
         self._pipe[realname] = realvalue
 
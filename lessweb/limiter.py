@@ -0,0 +1,141 @@
+"""
+Concurrency limits and backpressure
+(from lessweb)
+"""
+import asyncio
+import threading
+
+from lessweb.storage import Storage
+from lessweb.webapi import ServiceUnavailable
+
+
+__all__ = [
+    "ConcurrencyLimiter", "AsyncConcurrencyLimiter",
+]
+
+
+class _LimiterBase:
+    def __init__(self, max_concurrency, max_queue=0, queue_timeout=None, retry_after=1) -> None:
+        assert max_concurrency >= 1, 'max_concurrency:[{}] should be >= 1'.format(max_concurrency)
+        assert max_queue >= 0, 'max_queue:[{}] should be >= 0'.format(max_queue)
+        self.max_concurrency: int = max_concurrency
+        self.max_queue: int = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active: int = 0  # 正在执行的请求数
+        self.waiting: int = 0  # 等待队列的深度
+        self.admitted: int = 0
+        self.rejected: int = 0  # 队列已满或等待超时而返回503的请求数
+
+    def _reject(self):
+        self.rejected += 1
+        raise ServiceUnavailable(retry_after=self.retry_after)
+
+    def stats(self):
+        return Storage(
+            max_concurrency=self.max_concurrency, max_queue=self.max_queue,
+            active=self.active, waiting=self.waiting,
+            admitted=self.admitted, rejected=self.rejected,
+        )
+
+
+class ConcurrencyLimiter(_LimiterBase):
+    """
+    限制同时执行的请求数(用于执行dealer的线程)，超出的请求进入有界的等待队列，
+    队列已满或等待超过queue_timeout秒则抛出ServiceUnavailable(503 + Retry-After)
+
+        >>> limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=0)
+        >>> limiter.acquire()
+        >>> limiter.acquire()
+        Traceback (most recent call last):
+            ...
+        lessweb.webapi.ServiceUnavailable
+        >>> limiter.release()
+        >>> limiter.stats()
+        <Storage {'max_concurrency': 1, 'max_queue': 0, 'active': 0, 'waiting': 0, 'admitted': 1, 'rejected': 1}>
+    """
+    def __init__(self, max_concurrency, max_queue=0, queue_timeout=None, retry_after=1) -> None:
+        super().__init__(max_concurrency, max_queue, queue_timeout, retry_after)
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """timeout: 本次最多等待的秒数(与queue_timeout取较小值)"""
+        if timeout is None or (self.queue_timeout is not None and self.queue_timeout < timeout):
+            timeout = self.queue_timeout
+        with self._cond:
+            if self.active >= self.max_concurrency:
+                if self.waiting >= self.max_queue:
+                    self._reject()
+                self.waiting += 1
+                try:
+                    ok = self._cond.wait_for(lambda: self.active < self.max_concurrency, timeout)
+                finally:
+                    self.waiting -= 1
+                if not ok:
+                    self._reject()
+            self.active += 1
+            self.admitted += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class AsyncConcurrencyLimiter(_LimiterBase):
+    """
+    ConcurrencyLimiter的asyncio版本，在event loop上做准入控制，
+    被拒绝的请求不会占用executor中的线程，可以在event loop启动前创建
+
+        >>> limiter = AsyncConcurrencyLimiter(max_concurrency=2)
+        >>> loop = asyncio.new_event_loop()
+        >>> loop.run_until_complete(limiter.acquire())
+        >>> loop.close()
+        >>> limiter.stats().active
+        1
+    """
+    def __init__(self, max_concurrency, max_queue=0, queue_timeout=None, retry_after=1) -> None:
+        super().__init__(max_concurrency, max_queue, queue_timeout, retry_after)
+        self._cond_ = None
+
+    @property
+    def _cond(self):
+        # python<3.10的asyncio.Condition在创建时绑定event loop，所以在首次使用时(loop已运行)才创建
+        if self._cond_ is None:
+            self._cond_ = asyncio.Condition()
+        return self._cond_
+
+    async def acquire(self):
+        async with self._cond:
+            if self.active >= self.max_concurrency:
+                if self.waiting >= self.max_queue:
+                    self._reject()
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(
+                        self._cond.wait_for(lambda: self.active < self.max_concurrency), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    self._reject()
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+
+    async def release(self):
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
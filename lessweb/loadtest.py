@@ -0,0 +1,341 @@
+"""
+HTTP load test of lessweb apps
+(from lessweb)
+
+Starts the app in a child process on a local port and drives it with an asyncio (aiohttp) client:
+
+    python -m lessweb.loadtest myapp:app -c 64 -d 10 -r 'GET /hello' -r 'GET /items?pageNo=2@3'
+    python -m lessweb.loadtest myapp:create_app --mode wsgiref --no-keepalive --json result.json
+
+The app is given as module:attribute, an Application or a function returning one (e.g. to open a database
+in the server process). Server modes:
+    run: Application.run() (aiohttp, --workers threads)
+    wsgiref: the standard library WSGI server, one thread per connection
+
+Reported: throughput, latency percentiles, errors (status >= 400 and failed requests), and CPU and RSS of
+the server process (from /proc, or psutil if it is installed).
+
+Requirements:
+    aiohttp
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from lessweb.storage import Storage
+
+
+__all__ = [
+    "Request", "ServerProcess", "run_load", "load_test", "format_report",
+]
+
+
+class Request:
+    """
+    One kind of request of the mix, chosen with probability weight / total weight
+
+        >>> Request.parse('POST /items@3')
+        <Request POST /items weight=3>
+    """
+    def __init__(self, method, path, body=None, headers=None, weight=1) -> None:
+        self.method: str = method.upper()
+        self.path: str = path
+        self.body = body  # bytes, str, or data sent as JSON
+        self.headers = dict(headers or {})
+        self.weight: float = weight
+        if body is not None and not isinstance(body, (bytes, str)):
+            self.body = json.dumps(body)
+            self.headers.setdefault('Content-Type', 'application/json')
+
+    @classmethod
+    def parse(cls, spec):
+        """'[METHOD] path[@weight]'"""
+        spec, _, weight = spec.partition('@')
+        parts = spec.split(None, 1)
+        method, path = parts if len(parts) == 2 else ('GET', parts[0])
+        return cls(method, path, weight=float(weight) if weight else 1)
+
+    def __repr__(self):
+        return '<Request %s %s weight=%g>' % (self.method, self.path, self.weight)
+
+
+def _wait_for_port(port, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with status %s' % process.returncode)
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError('server did not listen on port %d within %ss' % (port, timeout))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServerProcess:
+    """
+    The app served in a child process (python -m lessweb.loadtest --serve ...):
+
+        with ServerProcess('myapp:app', mode='run') as server:
+            ...  # http://127.0.0.1:<server.port>/
+    """
+    def __init__(self, target, mode='run', port=None, workers=None, start_timeout=30, pythonpath=()) -> None:
+        assert mode in ('run', 'wsgiref'), "mode:[{}] should be 'run' or 'wsgiref'".format(mode)
+        self.target: str = target
+        self.mode: str = mode
+        self.port: int = port or _free_port()
+        self.workers = workers
+        self.start_timeout: float = start_timeout
+        self.pythonpath = [os.getcwd(), *pythonpath]
+        self.process = None
+        self._peak_rss = None  # largest RSS seen by usage(), without a high-water mark from the OS
+
+    def start(self):
+        argv = [sys.executable, '-m', 'lessweb.loadtest', '--serve', self.target,
+                '--mode', self.mode, '--port', str(self.port)]
+        if self.workers is not None:
+            argv += ['--workers', str(self.workers)]
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([*self.pythonpath, *filter(None, [env.get('PYTHONPATH')])])
+        self.process = subprocess.Popen(argv, env=env, stdout=subprocess.DEVNULL)
+        try:
+            _wait_for_port(self.port, self.process, self.start_timeout)
+        except:
+            self.stop()
+            raise
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def usage(self):
+        """
+        -> Storage(cpu_seconds, rss_bytes, peak_rss_bytes) of the server process
+        peak_rss_bytes: high-water mark from /proc (Linux), else the largest RSS of the calls to usage()
+        """
+        pid = self.process.pid
+        usage = None
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open('/proc/%d/status' % pid) as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:  # not Linux
+            pass
+        else:
+            ticks = os.sysconf('SC_CLK_TCK')
+            kb = lambda name: int(status[name].split()[0]) * 1024 if name in status else None
+            usage = Storage(cpu_seconds=(int(fields[11]) + int(fields[12])) / ticks,
+                            rss_bytes=kb('VmRSS'), peak_rss_bytes=kb('VmHWM'))
+        if usage is None:
+            try:
+                import psutil
+            except ImportError:
+                return Storage(cpu_seconds=None, rss_bytes=None, peak_rss_bytes=None)
+            p = psutil.Process(pid)
+            cpu, memory = p.cpu_times(), p.memory_info()
+            usage = Storage(cpu_seconds=cpu.user + cpu.system, rss_bytes=memory.rss,
+                            peak_rss_bytes=getattr(memory, 'peak_wset', None))  # peak_wset: Windows only
+        if usage.peak_rss_bytes is None and usage.rss_bytes is not None:
+            self._peak_rss = usage.peak_rss_bytes = max(self._peak_rss or 0, usage.rss_bytes)
+        return usage
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def _percentile(ordered, p):
+    """nearest-rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+async def _drive(base_url, requests, concurrency, duration, warmup, keepalive, timeout, seed):
+    import aiohttp
+
+    rng = random.Random(seed)
+    weights = [r.weight for r in requests]
+    latencies, statuses, failures = [], Counter(), Counter()
+    connector = aiohttp.TCPConnector(limit=concurrency, force_close=not keepalive)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    start = time.monotonic()
+    measure_from, stop_at = start + warmup, start + warmup + duration
+
+    async def _1_worker(session):
+        while True:
+            sent = time.monotonic()
+            if sent >= stop_at:
+                return
+            request = rng.choices(requests, weights)[0]
+            try:
+                async with session.request(request.method, base_url + request.path, data=request.body,
+                                           headers=request.headers) as resp:
+                    await resp.read()
+                    status = resp.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if sent >= measure_from:
+                    failures[type(e).__name__] += 1
+                continue
+            if sent >= measure_from:
+                latencies.append(time.monotonic() - sent)
+                statuses[status] += 1
+
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        await asyncio.gather(*[_1_worker(session) for _ in range(concurrency)])
+    return latencies, statuses, failures, time.monotonic() - measure_from
+
+
+def run_load(base_url, requests, concurrency=32, duration=10, warmup=1, keepalive=True, timeout=30, seed=None):
+    """
+    Drive base_url (e.g. 'http://127.0.0.1:8080') with `concurrency` clients for warmup + duration seconds;
+    requests sent during the warmup are not counted.
+    -> Storage(requests, seconds, throughput, latency_ms{p50, p95, p99, max, mean}, statuses, failures,
+               errors, error_rate)
+    """
+    assert concurrency >= 1, 'concurrency:[{}] should be >= 1'.format(concurrency)
+    requests = [Request.parse(r) if isinstance(r, str) else r for r in requests]
+    latencies, statuses, failures, seconds = asyncio.run(
+        _drive(base_url.rstrip('/'), requests, concurrency, duration, warmup, keepalive, timeout, seed))
+    latencies.sort()
+    count = len(latencies) + sum(failures.values())
+    errors = sum(n for status, n in statuses.items() if status >= 400) + sum(failures.values())
+    ms = lambda x: None if x is None else x * 1000
+    return Storage(
+        requests=count, seconds=seconds, throughput=len(latencies) / seconds if seconds > 0 else 0.0,
+        latency_ms=Storage(p50=ms(_percentile(latencies, 50)), p95=ms(_percentile(latencies, 95)),
+                           p99=ms(_percentile(latencies, 99)), max=ms(latencies[-1] if latencies else None),
+                           mean=ms(sum(latencies) / len(latencies) if latencies else None)),
+        statuses={str(k): v for k, v in sorted(statuses.items())}, failures=dict(failures),
+        errors=errors, error_rate=errors / count if count else 0.0,
+    )
+
+
+def load_test(target, requests, mode='run', workers=None, concurrency=32, duration=10, warmup=1,
+              keepalive=True, timeout=30, seed=None, pythonpath=()):
+    """
+    Serve target ('module:app') in a child process and run_load() it
+    -> Storage(scenario, mode, concurrency, keepalive, ..., server=Storage(cpu_percent, rss_mb, peak_rss_mb))
+    """
+    with ServerProcess(target, mode, workers=workers, pythonpath=pythonpath) as server:
+        before = server.usage()
+        result = run_load('http://127.0.0.1:%d' % server.port, requests, concurrency, duration, warmup,
+                          keepalive, timeout, seed)
+        after = server.usage()
+    cpu = None
+    if before.cpu_seconds is not None and after.cpu_seconds is not None and result.seconds > 0:
+        # the warmup is included in the CPU time, so it is divided by the whole run
+        cpu = (after.cpu_seconds - before.cpu_seconds) / (result.seconds + warmup) * 100
+    mb = lambda x: None if x is None else x / 1024 / 1024
+    result.update(scenario=target, mode=mode, concurrency=concurrency, keepalive=keepalive,
+                  server=Storage(cpu_percent=cpu, rss_mb=mb(after.rss_bytes), peak_rss_mb=mb(after.peak_rss_bytes)))
+    return result
+
+
+def format_report(results):
+    """table of load_test() results"""
+    fmt = lambda x, spec: '-' if x is None else spec % x
+    lines = ['%-28s %-8s %5s %9s %8s %8s %8s %7s %7s %8s' % (
+        'scenario', 'mode', 'conc', 'req/s', 'p50(ms)', 'p95(ms)', 'p99(ms)', 'errors', 'cpu%', 'rss(MB)')]
+    for r in results:
+        lines.append('%-28s %-8s %5d %9.0f %8s %8s %8s %6.2f%% %7s %8s' % (
+            r.scenario, r.mode, r.concurrency, r.throughput, fmt(r.latency_ms.p50, '%.2f'),
+            fmt(r.latency_ms.p95, '%.2f'), fmt(r.latency_ms.p99, '%.2f'), r.error_rate * 100,
+            fmt(r.server.cpu_percent, '%.0f'), fmt(r.server.peak_rss_mb or r.server.rss_mb, '%.1f')))
+    return '\n'.join(lines)
+
+
+def _load_app(target):
+    from lessweb import Application
+    module_name, _, attr = target.partition(':')
+    app = getattr(importlib.import_module(module_name), attr or 'app')
+    if not isinstance(app, Application):
+        app = app()
+    return app
+
+
+def serve(target, mode='run', port=8080, workers=None):
+    app = _load_app(target)
+    if mode == 'run':
+        app.run(port=port, max_workers=workers)
+        return
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+    class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+        request_queue_size = 1024  # listen backlog (default 5: connections would wait for SYN retries)
+
+    class _QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    make_server('127.0.0.1', port, app.wsgifunc(), _ThreadingWSGIServer, _QuietHandler).serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lessweb.loadtest', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('target', help='module:attribute of an Application, or of a function returning one')
+    parser.add_argument('--mode', default='run', choices=['run', 'wsgiref'])
+    parser.add_argument('--workers', type=int, help='threads of Application.run()')
+    parser.add_argument('-c', '--concurrency', type=int, default=32)
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds before measuring')
+    parser.add_argument('-r', '--request', action='append', dest='requests', metavar="'[METHOD] path[@weight]'",
+                        help="request of the mix (repeatable; default: 'GET /')")
+    parser.add_argument('--mix', metavar='PATH',
+                        help='JSON list of {method, path, body, headers, weight} added to the mix')
+    parser.add_argument('--no-keepalive', dest='keepalive', action='store_false')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds per request')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', metavar='PATH', help="write the result as JSON ('-': stdout)")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=8080, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.target, args.mode, args.port, args.workers)
+        return 0
+
+    requests = [Request.parse(spec) for spec in args.requests or ()]
+    if args.mix:
+        with open(args.mix) as f:
+            requests.extend(Request(**item) for item in json.load(f))
+    result = load_test(args.target, requests or [Request('GET', '/')], args.mode, args.workers, args.concurrency,
+                       args.duration, args.warmup, args.keepalive, args.timeout, args.seed)
+    if args.json == '-':
+        json.dump(result, sys.stdout, indent=2)
+    else:
+        print(format_report([result]))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
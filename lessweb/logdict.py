@@ -0,0 +1,277 @@
+"""
+Append-only log backend of lessweb.utils.static_dict
+(from lessweb)
+"""
+import os
+import pickle
+import struct
+import zlib
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are not serialized, see LogDict
+    fcntl = None
+
+
+__all__ = [
+    "LogDict",
+]
+
+
+_MAGIC = b'LWLOG1\n'
+_HEADER = struct.Struct('>BIII')  # op, crc32 of key + value, key length, value length
+_SET, _DEL = 1, 2
+_DELETED = object()
+
+
+class LogDict(MutableMapping):
+    """
+    Dict stored in an append-only log of pickled (key, value) records.
+
+    * Opening it only indexes the keys; a value is unpickled when it is first read.
+    * Changes are kept in memory and appended to the log by commit() (on exit of LogDict.open()),
+      so an update costs the size of the changed items, not of the whole table.
+    * When more than compact_ratio of the log is made of overwritten or deleted records (and the log
+      is larger than compact_min_bytes), it is rewritten to a temporary file which replaces it with
+      an atomic rename.
+    * Readers in other processes need no lock: records are never modified in place, an incomplete
+      record at the end of the log is ignored, and a reader keeps reading the file it opened after a
+      compaction replaced it. Writers are serialized by a lock file (path + '.lock'); the last commit
+      of a key wins.
+    * On Windows there is no such lock (no fcntl) and a file cannot be replaced while another process
+      has it open: use a log from one process at a time.
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'table.log')
+        >>> with LogDict.open(path) as d:
+        ...     d.update(a=1, b=[2])
+        >>> with LogDict.open(path) as d:
+        ...     del d['a']
+        ...     d['c'] = 3
+        >>> with LogDict.open(path) as d:
+        ...     sorted(d.items())
+        [('b', [2]), ('c', 3)]
+    """
+    def __init__(self, path, compact_ratio=0.5, compact_min_bytes=1 << 20) -> None:
+        self.path: str = str(path)
+        self.lock_path: str = self.path + '.lock'
+        self.compact_ratio: float = compact_ratio
+        self.compact_min_bytes: int = compact_min_bytes
+        self.touched: bool = False
+        self._file = None  # binary read handle of the log
+        self._ino = None
+        self._size: int = 0  # bytes of the log indexed so far
+        self._dead: int = 0  # bytes of overwritten or deleted records
+        self._index = {}  # key => (record offset, key length, value length)
+        self._values = {}  # values already unpickled
+        self._changes = {}  # key => value or _DELETED, not yet committed
+
+    @classmethod
+    @contextmanager
+    def open(cls, path, **kwargs):
+        """with LogDict.open(path) as data: ...  (changes are committed if the block exits without error)"""
+        data = cls(path, **kwargs)
+        data.load()
+        try:
+            yield data
+            data.commit()
+        finally:
+            data.close()
+
+    # ~ file
+
+    def load(self):
+        self.close()
+        self._index, self._values = {}, {}
+        self._size, self._dead, self._ino = 0, 0, None
+        if not os.path.exists(self.path):
+            return
+        self._file = open(self.path, 'rb')
+        self._ino = os.fstat(self._file.fileno()).st_ino
+        if self._pread(len(_MAGIC), 0) != _MAGIC:
+            raise ValueError('{} is not a LogDict file'.format(self.path))
+        self._size = len(_MAGIC)
+        self._scan()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _pread(self, size, offset):
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def _scan(self):
+        """index the records appended after self._size (up to the last complete one)"""
+        end = os.fstat(self._file.fileno()).st_size
+        offset = self._size
+        while offset + _HEADER.size <= end:
+            op, _, key_len, value_len = _HEADER.unpack(self._pread(_HEADER.size, offset))
+            record_len = _HEADER.size + key_len + value_len
+            if op not in (_SET, _DEL) or offset + record_len > end:
+                break
+            key = pickle.loads(self._pread(key_len, offset + _HEADER.size))
+            old = self._index.pop(key, None)
+            if old is not None:
+                self._dead += _HEADER.size + old[1] + old[2]
+                self._values.pop(key, None)
+            if op == _SET:
+                self._index[key] = (offset, key_len, value_len)
+            else:
+                self._dead += record_len
+            offset += record_len
+        self._size = offset
+
+    def _read(self, key):
+        offset, key_len, value_len = self._index[key]
+        raw = self._pread(_HEADER.size + key_len + value_len, offset)
+        _, crc, _, _ = _HEADER.unpack_from(raw)
+        if zlib.crc32(raw[_HEADER.size:]) != crc:
+            raise ValueError('corrupted record of {!r} in {}'.format(key, self.path))
+        return pickle.loads(raw[_HEADER.size + key_len:])
+
+    @staticmethod
+    def _record(op, key, value=None):
+        key_raw = pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+        value_raw = pickle.dumps(value, pickle.HIGHEST_PROTOCOL) if op == _SET else b''
+        return _HEADER.pack(op, zlib.crc32(key_raw + value_raw), len(key_raw), len(value_raw)) \
+            + key_raw + value_raw
+
+    @contextmanager
+    def _exclusive(self):
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _catch_up(self):
+        """(holding the lock) see the commits of other processes"""
+        try:
+            replaced = os.stat(self.path).st_ino != self._ino
+        except FileNotFoundError:
+            replaced = self._file is not None
+        if replaced:  # compacted (or created) by another process
+            self.load()
+        elif self._file is not None:
+            self._scan()  # records appended by other processes
+
+    def commit(self):
+        """append the changes to the log, and compact it if needed"""
+        if not self._changes:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._exclusive():
+            self._catch_up()
+            if self._file is None:
+                with open(self.path, 'xb') as f:
+                    f.write(_MAGIC)
+                self.load()
+
+            with open(self.path, 'r+b') as f:
+                f.truncate(self._size)  # an incomplete record left by a crashed writer
+                f.seek(self._size)
+                for key, value in self._changes.items():
+                    if value is _DELETED:
+                        if key in self._index:
+                            f.write(self._record(_DEL, key))
+                    else:
+                        f.write(self._record(_SET, key, value))
+                f.flush()
+                os.fsync(f.fileno())
+            self._scan()
+            for key, value in self._changes.items():
+                if value is not _DELETED:
+                    self._values[key] = value
+            self._changes = {}
+            self.touched = False
+            if self._size > self.compact_min_bytes and self._dead >= self._size * self.compact_ratio:
+                self._compact()
+
+    def compact(self):
+        """rewrite the log without overwritten or deleted records (uncommitted changes are kept in memory)"""
+        with self._exclusive():
+            self._catch_up()
+            if self._file is not None:
+                self._compact()
+
+    def _compact(self):
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        index = {}
+        with open(tmp_path, 'wb') as f:
+            f.write(_MAGIC)
+            offset = len(_MAGIC)
+            for key, (old_offset, key_len, value_len) in self._index.items():
+                record_len = _HEADER.size + key_len + value_len
+                f.write(self._pread(record_len, old_offset))
+                index[key] = (offset, key_len, value_len)
+                offset += record_len
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()  # before the rename, which Windows refuses on an open file
+        os.replace(tmp_path, self.path)
+        _fsync_dir(self.path)
+        self._file = open(self.path, 'rb')
+        self._ino = os.fstat(self._file.fileno()).st_ino
+        self._index, self._size, self._dead = index, offset, 0
+
+    # ~ dict
+
+    def __getitem__(self, key):
+        value = self._changes.get(key, self._values.get(key, _DELETED))
+        if value is not _DELETED:
+            return value
+        if key in self._changes:  # deleted
+            raise KeyError(key)
+        value = self._values[key] = self._read(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._changes[key] = value
+        self.touched = True
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._changes[key] = _DELETED
+        self._values.pop(key, None)
+        self.touched = True
+
+    def __contains__(self, key):
+        value = self._changes.get(key, None)
+        if value is not None:
+            return value is not _DELETED
+        return key in self._changes or key in self._index
+
+    def __iter__(self):
+        for key in self._index:
+            if self._changes.get(key, None) is not _DELETED:
+                yield key
+        for key, value in self._changes.items():
+            if value is not _DELETED and key not in self._index:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '<LogDict {!r} ({} keys)>'.format(self.path, len(self))
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -27,6 +27,7 @@ class PagedList(Jsonable):
     pageNo: int = 1
     pageSize: int = 1
     totalNum: int = 0
+    totalCapped: bool = False  # totalNum is a lower bound ("totalNum+"), see dumppage(count_cap=...)
     list: List = None
 
     @property
@@ -38,10 +39,29 @@ class PagedList(Jsonable):
         self.list = []
 
     def jsonize(self):
-        return {
+        data = {
             'list': self.list, 'pageNo': self.pageNo, 'pageSize': self.pageSize,
             'totalNum': self.totalNum, 'totalPage': self.totalPage
         }
+        if self.totalCapped:
+            data['totalCapped'] = True
+        return data
+
+
+class CursorList(Jsonable):
+    """Page of keyset (cursor) pagination; pass nextCursor back as `after` to get the next page"""
+    size: int = 1
+    nextCursor: Optional[str] = None
+    list: List = None
+
+    def __init__(self):
+        self.list = []
+
+    def jsonize(self):
+        return {
+            'list': self.list, 'size': self.size, 'nextCursor': self.nextCursor,
+            'hasMore': self.nextCursor is not None,
+        }
 
 
 def get_func_parameters(func):
@@ -0,0 +1,284 @@
+import base64
+import inspect
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from types import GeneratorType
+
+from ..context import Context
+from ..singleflight import SingleFlight, RequestCoalescer
+from ..storage import Storage
+from ..utils import json_dumps, _nil
+from . import redis as redis_plugin
+
+
+__all__ = ["LocalCache", "TwoTierCache", "response_cache"]
+
+
+class LocalCache:
+    """
+    In-process TTL + LRU cache
+
+        >>> cache = LocalCache(maxsize=1, ttl=60)
+        >>> cache.set('a', None)
+        >>> cache.get('a')
+        >>> cache.get('b', 'missing')
+        'missing'
+        >>> cache.set('b', 2)
+        >>> cache.get('a', 'evicted'), cache.get('b')
+        ('evicted', 2)
+    """
+    def __init__(self, maxsize=10000, ttl=60) -> None:
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key => (expire_at, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TwoTierCache:
+    """
+    Cache with a local LRU near-cache in each process and Redis (lessweb.plugin.redis) as the shared tier.
+    set() and delete() broadcast the keys on a pub/sub channel, so that the other processes drop their
+    local copies at once; local_ttl bounds the staleness if a message is lost.
+    Values are stored as JSON with lessweb's encoders (Models and Jsonables are read back as dicts).
+
+        cache = TwoTierCache('myapp', ttl=300)
+
+        def get_category(ctx: Context, id: int):
+            return cache.get_or_set('category:%d' % id, lambda: load_category(id))
+
+    get_or_set() computes a missing value once: concurrent callers in the process wait for the same call,
+    and other processes wait (up to lock_timeout seconds) for the process holding the Redis lock.
+    """
+    def __init__(self, namespace='lessweb:cache', ttl=300, local_maxsize=10000, local_ttl=60, redis=None,
+                 invalidation=True, lock_timeout=10, encoders=()) -> None:
+        self.namespace: str = namespace
+        self.ttl: float = ttl
+        self.local = LocalCache(local_maxsize, local_ttl)
+        self.redis = redis
+        self.invalidation: bool = invalidation
+        self.lock_timeout: float = lock_timeout
+        self.encoders = encoders
+        self.channel: str = namespace + ':invalidate'
+        self.origin: str = uuid.uuid4().hex  # id of this process' cache in invalidation messages
+        self._flight = SingleFlight()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+        self.local_hits: int = 0
+        self.redis_hits: int = 0
+        self.misses: int = 0
+        self.computes: int = 0
+        self.invalidations_received: int = 0
+
+    def _client(self):
+        return self.redis if self.redis is not None else redis_plugin.session()
+
+    def _name(self, key):
+        return '%s:%s' % (self.namespace, key)
+
+    def _encode(self, value):
+        from ..application import _make_default_json_encoders
+        return json_dumps(value, _make_default_json_encoders(self.encoders))
+
+    def _on_message(self, message):
+        try:
+            data = json.loads(message['data'])
+        except (TypeError, ValueError):
+            return
+        if data.get('origin') != self.origin:
+            self.invalidations_received += 1
+            if data.get('clear'):
+                self.local.clear()
+            else:
+                self.local.delete(*data.get('keys', ()))
+
+    def start_listener(self):
+        """subscribe to the invalidation channel (done on first use when invalidation=True)"""
+        with self._listener_lock:
+            if self._listener is None:
+                pubsub = self._client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.channel: self._on_message})
+                self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop_listener(self):
+        with self._listener_lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self._listener = None
+
+    def _publish(self, **message):
+        if self.invalidation:
+            self._client().publish(self.channel, json.dumps(dict(message, origin=self.origin)))
+
+    def _get(self, key):
+        """-> value or _nil"""
+        if self.invalidation and self._listener is None:
+            self.start_listener()
+        value = self.local.get(key, _nil)
+        if value is not _nil:
+            self.local_hits += 1
+            return value
+        raw = self._client().get(self._name(key))
+        if raw is None:
+            self.misses += 1
+            return _nil
+        self.redis_hits += 1
+        value = json.loads(raw)
+        self.local.set(key, value)
+        return value
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        return default if value is _nil else value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        raw = self._encode(value)
+        client = self._client()
+        with client.pipeline(transaction=False) as pipe:
+            pipe.set(self._name(key), raw, px=max(1, int(ttl * 1000)))
+            if self.invalidation:
+                pipe.publish(self.channel, json.dumps({'origin': self.origin, 'keys': [key]}))
+            pipe.execute()
+        self.local.set(key, json.loads(raw), ttl)  # the same value other processes read
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        self._client().delete(*[self._name(k) for k in keys])
+        self.local.delete(*keys)
+        self._publish(keys=list(keys))
+
+    def clear_local(self, broadcast=False):
+        """drop the near-cache of this process (broadcast=True: of all processes)"""
+        self.local.clear()
+        if broadcast:
+            self._publish(clear=True)
+
+    def _compute(self, key, fn, ttl, cacheable):
+        value = self._get(key)
+        if value is not _nil:
+            return value
+        client = self._client()
+        lock_name = self._name(key) + ':lock'
+        locked = client.set(lock_name, self.origin, nx=True, px=int(self.lock_timeout * 1000))
+        if not locked:  # another process is computing it
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                raw = client.get(self._name(key))
+                if raw is not None:
+                    value = json.loads(raw)
+                    self.local.set(key, value)
+                    return value
+                if not client.exists(lock_name):
+                    break
+        try:
+            self.computes += 1
+            value = fn()
+            if cacheable is None or cacheable(value):
+                self.set(key, value, ttl)
+            return value
+        finally:
+            if locked:
+                client.delete(lock_name)
+
+    def get_or_set(self, key, fn, ttl=None, cacheable=None):
+        """
+        fn: () -> value, called on a miss
+        cacheable: value -> bool, whether the computed value is stored (default: always)
+        """
+        value = self._get(key)
+        if value is not _nil:
+            return value
+        return self._flight.do(key, lambda: self._compute(key, fn, ttl, cacheable), self.lock_timeout)
+
+    def stats(self):
+        return Storage(local_hits=self.local_hits, redis_hits=self.redis_hits, misses=self.misses,
+                       computes=self.computes, invalidations_received=self.invalidations_received,
+                       local_size=len(self.local))
+
+
+def response_cache(cache: TwoTierCache, ttl=60, query=None, vary=()):
+    """
+    Interceptor caching the responses (status 200) of GET/HEAD requests in a TwoTierCache:
+
+        app.add_interceptor('/categories.*', 'GET', response_cache(cache, ttl=60, vary=['Accept-Language']))
+
+    The key is the method, path, query (or only the query parameters named in `query`) and the `vary` headers.
+    Set-Cookie headers and streamed (generator) responses are not cached. The response of an async dealer
+    is cached after its coroutine has run.
+    """
+    keyer = RequestCoalescer(query=query, vary=vary)
+
+    def _1_response_cache(ctx: Context):
+        if ctx.method not in ('GET', 'HEAD'):
+            return ctx()
+
+        key = 'response:b64:' + json.dumps(keyer.key(ctx))  # base64 bodies: entries of the text format are not read
+        deferred = []  # a stream, or the coroutine of an async dealer, which is cached once it has run
+
+        def _1_1_record(result):
+            body = b''.join(ctx.app._encode_result((result,)))
+            headers = [[k, v] for k, v in ctx.headers if k.lower() != 'set-cookie']
+            return {'status': ctx.status_code, 'reason': ctx.reason, 'headers': headers,
+                    'body': base64.b64encode(body).decode('ascii')}  # any bytes, in a JSON value
+
+        def _1_1_render():
+            result = ctx()
+            if isinstance(result, GeneratorType) or inspect.iscoroutine(result):
+                deferred.append(result)
+                return {'deferred': True}
+            return _1_1_record(result)
+
+        async def _1_1_store(coro):
+            result = await coro
+            response = _1_1_record(result)
+            if response['status'] == 200:
+                cache.set(key, response, ttl)
+            return result
+
+        response = cache.get_or_set(key, _1_1_render, ttl,
+                                    cacheable=lambda r: 'deferred' not in r and r['status'] == 200)
+        if 'deferred' in response:  # requests sharing the call of a deferred response run their own dealer
+            result = deferred[0] if deferred else ctx()
+            return _1_1_store(result) if inspect.iscoroutine(result) else result
+        ctx.status_code, ctx.reason = response['status'], response['reason']
+        for k, v in response['headers']:
+            ctx.set_header(k, v)
+        return base64.b64decode(response['body'])
+
+    return _1_response_cache
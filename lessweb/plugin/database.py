@@ -1,27 +1,247 @@
+from abc import ABC, abstractmethod
+import base64
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time as datetime_time
+from decimal import Decimal
+import csv
+import hashlib
+import inspect
+import io
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+from types import GeneratorType
 from typing import Any, overload, List
 from urllib.parse import quote
 
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from enum import Enum as PyEnum
+from sqlalchemy import create_engine, event, text, and_, or_, tuple_, func, inspect as sa_inspect, types
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError, DBAPIError
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.util import find_tables
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.orm.session import Session
 from sqlalchemy.ext.declarative import declarative_base
 
 from ..context import Context
 from ..storage import Storage
-from ..model import Model, PagedList
+from ..model import Model, PagedList, CursorList
+from ..webapi import BadParamError
+from ..utils import eafp, json_dumps
 
-__all__ = ["global_data", "DbModel", "init", "processor", "create_all", "make_session", "dumpall"]
+__all__ = ["global_data", "DbModel", "init", "processor", "create_all", "make_session", "dumpall",
+           "dumppage", "dumpcursor", "dumpstream", "dumprows", "dumpone", "row_mapper", "apply_deadline", "pool_stats", "replica", "primary",
+           "bulk_insert", "bulk_upsert", "LocalQueryCache", "RedisQueryCache", "init_query_cache",
+           "invalidate_query_cache", "dumpcached", "SqlStats"]
 
 
 class GlobalData:
     db_session_maker: Any
     db_engine: Any
     autocommit: bool
+    replicas: Any = None  # ReplicaSet
+    sticky_seconds: float = 0
+    sticky_cookie: str = 'lwdbsticky'
+    query_cache: Any = None  # LocalQueryCache or RedisQueryCache
+    sql_warn_repeats: int = 10
+
+
+class PoolStats:
+    """
+    连接池的checkout计数、超时计数和等待时间直方图(秒)
+
+        >>> stats = PoolStats()
+        >>> stats.observe(0.003)
+        >>> stats.observe(7)
+        >>> stats.timeouts += 1
+        >>> s = stats.storage()
+        >>> s.checkouts, s.timeouts, s.wait_histogram['<=0.005'], s.wait_histogram['>5']
+        (2, 1, 1, 1)
+    """
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checkouts: int = 0
+        self.timeouts: int = 0  # 等待超过pool_timeout而失败的checkout
+        self.in_use: int = 0
+        self.wait_total: float = 0.0
+        self.wait_max: float = 0.0
+        self.wait_counts: List[int] = [0] * (len(self.buckets) + 1)
+
+    def observe(self, seconds, ok=True):
+        with self._lock:
+            if ok:
+                self.in_use += 1
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            self.wait_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def storage(self):
+        with self._lock:
+            histogram = {'<=%g' % b: n for b, n in zip(self.buckets, self.wait_counts)}
+            histogram['>%g' % self.buckets[-1]] = self.wait_counts[-1]
+            return Storage(checkouts=self.checkouts, timeouts=self.timeouts, in_use=self.in_use,
+                           wait_total=self.wait_total, wait_max=self.wait_max, wait_histogram=histogram)
+
+
+class _InstrumentedPool:
+    """Mixin for sqlalchemy pool classes: records wait time and timeouts of each checkout"""
+    lessweb_stats: PoolStats
+
+    def _do_get(self):
+        start = time.perf_counter()
+        ok = False
+        try:
+            conn = super()._do_get()
+            ok = True
+            return conn
+        except PoolTimeoutError:
+            with self.lessweb_stats._lock:
+                self.lessweb_stats.timeouts += 1
+            raise
+        finally:
+            self.lessweb_stats.observe(time.perf_counter() - start, ok)
+
+    def _do_return_conn(self, conn):
+        with self.lessweb_stats._lock:
+            self.lessweb_stats.in_use -= 1
+        return super()._do_return_conn(conn)
+
+
+class ReplicaSet:
+    """
+    Read replicas of the primary database.
+        policy: 'round_robin' or 'least_connections' (fewest connections checked out)
+        retry_after: seconds a replica is skipped after it failed to connect
+    """
+    def __init__(self, engines, session_makers, policy='round_robin', retry_after=30) -> None:
+        assert policy in ('round_robin', 'least_connections'), 'policy:[{}]'.format(policy)
+        self.engines = engines
+        self.session_makers = session_makers
+        self.policy: str = policy
+        self.retry_after: float = retry_after
+        self._lock = threading.Lock()
+        self._next = 0
+        self._down_until = [0.0] * len(engines)
+        self.failures: List[int] = [0] * len(engines)
+        self.fallbacks: int = 0  # sessions that fell back to the primary because no replica was available
+
+    def candidates(self):
+        """indexes of replicas to try, in order of preference"""
+        now = time.monotonic()
+        with self._lock:
+            alive = [i for i in range(len(self.engines)) if self._down_until[i] <= now]
+            if self.policy == 'round_robin':
+                start = self._next % len(self.engines)
+                self._next += 1
+                return sorted(alive, key=lambda i: (i - start) % len(self.engines))
+        return sorted(alive, key=lambda i: self.engines[i].pool.lessweb_stats.in_use)
+
+    def mark_down(self, i):
+        with self._lock:
+            self._down_until[i] = time.monotonic() + self.retry_after
+            self.failures[i] += 1
+
+    def open_session(self):
+        """-> a session connected to an available replica, or None"""
+        for i in self.candidates():
+            session = self.session_makers[i]()
+            try:
+                session.connection()
+                return session
+            except DBAPIError:
+                session.close()
+                self.mark_down(i)
+        with self._lock:
+            self.fallbacks += 1
+        return None
+
+
+class SqlStats:
+    """
+    SQL statements executed for one request (ctx.sql):
+        count, total_time (seconds), rows (as reported by cursor.rowcount, when the driver knows it),
+        statements: [(sql, seconds, rows)] (the first max_statements ones),
+        fingerprints: {statement shape: times executed}
+
+        >>> SqlStats.fingerprint("SELECT * FROM t WHERE id IN (?, ?, ?) AND name = 'x'")
+        'select * from t where id in (?+) and name = ?'
+    """
+    max_statements = 100
+    _literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s|\$\d+|:\w+")
+    _list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+    def __init__(self, warn_repeats=None) -> None:
+        self.warn_repeats = warn_repeats  # log a warning when a statement shape is executed more times
+        self.count: int = 0
+        self.total_time: float = 0.0
+        self.rows: int = 0
+        self.statements: List = []
+        self.fingerprints = {}
+
+    @classmethod
+    def fingerprint(cls, sql):
+        sql = ' '.join(sql.split()).lower()
+        return cls._list_re.sub('(?+)', cls._literal_re.sub('?', sql))
+
+    def observe(self, sql, seconds, rows):
+        self.count += 1
+        self.total_time += seconds
+        if rows > 0:
+            self.rows += rows
+        if len(self.statements) < self.max_statements:
+            self.statements.append((sql, seconds, rows))
+        shape = self.fingerprint(sql)
+        repeats = self.fingerprints[shape] = self.fingerprints.get(shape, 0) + 1
+        if self.warn_repeats and repeats == self.warn_repeats + 1:
+            logging.warning('possible N+1 queries: statement executed more than %d times in one request: %s',
+                            self.warn_repeats, shape)
+
+    def repeated(self, min_count=2):
+        """-> {statement shape: times executed} of the shapes executed at least min_count times"""
+        return {k: v for k, v in self.fingerprints.items() if v >= min_count}
+
+    def server_timing(self):
+        """value of the Server-Timing header"""
+        return 'db;dur=%.1f;desc="%d queries"' % (self.total_time * 1000, self.count)
+
+
+_SQL_STATS = 'lessweb_sql_stats'  # key in Session.info and Connection.info
+
+
+def _attach_sql_stats(session, transaction, connection):
+    stats = session.info.get(_SQL_STATS)
+    if stats is not None:
+        connection.info[_SQL_STATS] = stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _SQL_STATS in conn.info:
+        conn.info.setdefault('lessweb_sql_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = conn.info.get(_SQL_STATS)
+    if stats is not None and conn.info.get('lessweb_sql_start'):
+        seconds = time.perf_counter() - conn.info['lessweb_sql_start'].pop()
+        stats.observe(statement, seconds, getattr(cursor, 'rowcount', -1))
+
+
+event.listen(Session, 'after_begin', _attach_sql_stats)
 
 
 class DatabaseCtx(Context):
     db : Session
+    sql : SqlStats
 
 
 global_data = GlobalData()
@@ -69,12 +289,480 @@ class DumpAllDbModel:
 dumpall = DumpAllDbModel()
 
 
+def _column_encoder(column):
+    """-> function encoding the column's values like lessweb's json encoders, or None if not needed"""
+    type_ = column.type
+    if isinstance(type_, types.DateTime):
+        return lambda v: v.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(type_, (types.Date, types.Time)):
+        return lambda v: v.isoformat()
+    if isinstance(type_, types.Numeric) and type_.asdecimal:
+        return float
+    if isinstance(type_, types.Enum) and type_.enum_class is not None and issubclass(type_.enum_class, PyEnum):
+        return lambda v: dict(value=v.value, show=v.show) if hasattr(v, 'show') else v.value
+    return None
+
+
+class RowMapper:
+    """
+    Precompiled mapping of selected column tuples to dicts {attribute name: json-ready value},
+    bypassing ORM object construction.
+
+        >>> from sqlalchemy import Column, Integer, DateTime
+        >>> class DbEvent(DbModel):
+        ...     __tablename__ = 'event'
+        ...     id = Column(Integer, primary_key=True)
+        ...     at = Column(DateTime)
+        >>> mapper = row_mapper(DbEvent)
+        >>> mapper.keys
+        ['id', 'at']
+        >>> mapper((1, datetime(2020, 1, 2, 3, 4, 5)))
+        {'id': 1, 'at': '2020-01-02 03:04:05'}
+    """
+    def __init__(self, columns) -> None:
+        self.columns = list(columns)
+        self.keys: List[str] = [c.key for c in self.columns]
+        self._encoders = [_column_encoder(c) for c in self.columns]
+        if any(self._encoders):
+            self._convert = self._convert_encoded
+        else:
+            self._convert = self._convert_plain
+
+    def _convert_plain(self, row):
+        return dict(zip(self.keys, row))
+
+    def _convert_encoded(self, row):
+        return {k: v if f is None or v is None else f(v) for k, f, v in zip(self.keys, self._encoders, row)}
+
+    def __call__(self, row) -> dict:
+        return self._convert(row)
+
+    def select(self, query):
+        """the query (of a DbModel) selecting only the mapper's columns, keeping filters and order"""
+        return query.with_entities(*self.columns)
+
+
+_row_mappers = {}  # DbModel class => RowMapper
+
+
+def row_mapper(target) -> RowMapper:
+    """target: DbModel class (all its columns, mapper cached per class) or list of columns"""
+    if isinstance(target, type):
+        mapper = _row_mappers.get(target)
+        if mapper is None:
+            mapper = _row_mappers[target] = RowMapper(
+                getattr(target, attr.key) for attr in sa_inspect(target).column_attrs)
+        return mapper
+    return RowMapper(target)
+
+
+def _query_row_mapper(query, columns) -> RowMapper:
+    """columns: True (all columns of the queried DbModel), a DbModel class or a list of columns"""
+    if columns is True:
+        columns = query.column_descriptions[0]['entity']
+    return row_mapper(columns)
+
+
+class DumpRowsDbModel:
+    def __init__(self, columns) -> None:
+        self.columns = columns
+
+    def __ror__(self, other) -> List:
+        if other is None:
+            return []
+        mapper = _query_row_mapper(other, self.columns)
+        return [mapper(row) for row in mapper.select(other)]
+
+
+def dumprows(columns=True):
+    """
+    Fast counterpart of dumpall: select column tuples and map them to dicts without creating ORM objects.
+        columns: True (all columns of the queried DbModel), a DbModel class or a list of columns
+
+        ctx.db.query(DbUser).filter(...).order_by(DbUser.id) | dumprows()
+        ctx.db.query(DbUser) | dumprows([DbUser.id, DbUser.name])
+
+    The dicts hold the column attributes (DbModel.dump() is not called).
+    """
+    return DumpRowsDbModel(columns)
+
+
+class _QueryCacheBackend(ABC):
+    """
+    Backend of the query cache. Each table has a generation number which is part of the cache key
+    of the queries reading it: invalidating a table increases its generation, so that the entries
+    computed from the old data are never read again (and expire by TTL / LRU).
+    """
+    def __init__(self) -> None:
+        self.hits: int = 0
+        self.misses: int = 0
+        self.invalidations: int = 0
+
+    @abstractmethod
+    def generations(self, tables) -> List[int]:
+        pass
+
+    @abstractmethod
+    def lookup(self, key):
+        """-> cached value or None"""
+
+    @abstractmethod
+    def store(self, key, value, ttl):
+        pass
+
+    @abstractmethod
+    def invalidate(self, tables):
+        pass
+
+    def stats(self):
+        return Storage(hits=self.hits, misses=self.misses, invalidations=self.invalidations)
+
+
+def _copy_rows(rows):
+    """
+    new list of copies of the row dicts (a caller changing its result must not change the cached one)
+
+        >>> rows = [{'id': 1}]
+        >>> copied = _copy_rows(rows)
+        >>> copied[0]['id'] = 2; copied.append({'id': 3})
+        >>> rows
+        [{'id': 1}]
+    """
+    return [dict(row) if isinstance(row, dict) else row for row in rows]
+
+
+class LocalQueryCache(_QueryCacheBackend):
+    """
+    In-process query cache (TTL + LRU), invalidated by the commits of this process only.
+    Results are copied in and out, down to the row dicts (values inside a row are shared).
+    """
+    def __init__(self, maxsize=1024) -> None:
+        super().__init__()
+        self._entries = _CountCache(maxsize)
+        self._lock = threading.Lock()
+        self._generations = {}  # table name => generation
+
+    def generations(self, tables):
+        with self._lock:
+            return [self._generations.get(t, 0) for t in tables]
+
+    def lookup(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _copy_rows(value)
+
+    def store(self, key, value, ttl):
+        self._entries.set(key, _copy_rows(value), ttl)
+
+    def invalidate(self, tables):
+        with self._lock:
+            for t in tables:
+                self._generations[t] = self._generations.get(t, 0) + 1
+            self.invalidations += 1
+
+
+class RedisQueryCache(_QueryCacheBackend):
+    """
+    Query cache shared by all workers through Redis (lessweb.plugin.redis.init() must be called first,
+    or pass a redis client). Values are stored as JSON. Size is bounded by the TTL and Redis' maxmemory policy.
+    """
+    def __init__(self, redis=None, prefix='lessweb:qc:') -> None:
+        super().__init__()
+        self.redis = redis
+        self.prefix: str = prefix
+
+    def _client(self):
+        if self.redis is None:
+            from . import redis as redis_plugin
+            return redis_plugin.session()
+        return self.redis
+
+    def generations(self, tables):
+        if not tables:
+            return []
+        return [int(g or 0) for g in self._client().mget([self.prefix + 'gen:' + t for t in tables])]
+
+    def _name(self, key):
+        return self.prefix + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        raw = self._client().get(self._name(key))
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    def store(self, key, value, ttl):
+        from ..application import _make_default_json_encoders
+        self._client().set(self._name(key), json_dumps(value, _make_default_json_encoders(())),
+                           px=max(1, int(ttl * 1000)))
+
+    def invalidate(self, tables):
+        pipe = self._client().pipeline(transaction=False)
+        for t in tables:
+            pipe.incr(self.prefix + 'gen:' + t)
+        pipe.execute()
+        self.invalidations += 1
+
+
+_WRITTEN_TABLES = 'lessweb_written_tables'  # key in Session.info
+
+
+def _record_flush(session, flush_context):
+    tables = session.info.setdefault(_WRITTEN_TABLES, set())
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        tables.update(t.name for t in sa_inspect(obj).mapper.tables)
+
+
+def _record_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = orm_execute_state.statement.table
+        name = getattr(table, 'name', None) or eafp(lambda: sa_inspect(table).local_table.name, None)
+        if name is not None:
+            orm_execute_state.session.info.setdefault(_WRITTEN_TABLES, set()).add(name)
+
+
+def _invalidate_on_commit(session):
+    tables = session.info.pop(_WRITTEN_TABLES, None)
+    if tables and global_data.query_cache is not None:
+        global_data.query_cache.invalidate(sorted(tables))
+
+
+def _forget_on_rollback(session):
+    session.info.pop(_WRITTEN_TABLES, None)
+
+
+def init_query_cache(backend=None):
+    """
+    Enable the query cache used by dumpcached():
+        backend: LocalQueryCache(maxsize) (default) or RedisQueryCache() to share it between workers
+    Entries of a table are invalidated when a session commits ORM changes or insert/update/delete statements
+    (session.execute) touching it. For writes the session cannot see (raw SQL text, other applications),
+    call invalidate_query_cache(table names).
+    """
+    if not event.contains(Session, 'after_commit', _invalidate_on_commit):
+        event.listen(Session, 'after_flush', _record_flush)
+        event.listen(Session, 'do_orm_execute', _record_execute)
+        event.listen(Session, 'after_commit', _invalidate_on_commit)
+        event.listen(Session, 'after_rollback', _forget_on_rollback)
+    global_data.query_cache = backend if backend is not None else LocalQueryCache()
+    return global_data.query_cache
+
+
+def invalidate_query_cache(*tables):
+    if global_data.query_cache is not None:
+        global_data.query_cache.invalidate(tables)
+
+
+class DumpCachedDbModel:
+    def __init__(self, ttl, columns) -> None:
+        assert ttl > 0, 'ttl:[{}] should be > 0'.format(ttl)
+        self.ttl = ttl
+        self.columns = columns
+
+    def _dump(self, query):
+        return query | (dumpall if self.columns is None else dumprows(self.columns))
+
+    def __ror__(self, other) -> List:
+        cache = global_data.query_cache
+        if other is None:
+            return []
+        if cache is None:
+            return self._dump(other)
+        tables = sorted({t.name for t in find_tables(other.statement, include_joins=True, include_aliases=True)
+                         if hasattr(t, 'name')})
+        if set(tables) & other.session.info.get(_WRITTEN_TABLES, set()):
+            return self._dump(other)  # the session has uncommitted writes to these tables
+        columns = None if self.columns is None else repr(_query_row_mapper(other, self.columns).keys)
+        key = _query_key(other) + (tuple(tables), tuple(cache.generations(tables)), columns)
+        value = cache.lookup(key)
+        if value is None:
+            value = self._dump(other)
+            cache.store(key, value, self.ttl)
+        return value
+
+
+def dumpcached(ttl=60, columns=None):
+    """
+    dumpall (or dumprows(columns) if columns is given) with the result cached by the query cache
+    for at most ttl seconds, keyed on the compiled SQL and parameters:
+
+        init_query_cache()  # once, after init()
+        categories = ctx.db.query(DbCategory).order_by(DbCategory.id) | dumpcached(ttl=300)
+
+    Without init_query_cache() the query is not cached.
+    """
+    return DumpCachedDbModel(ttl, columns)
+
+
+class DumpStreamDbModel:
+    """
+    query | dumpstream(...) => generator of str chunks, one chunk per batch of rows
+        batch_size: rows fetched per round trip (Query.yield_per: server-side cursor where supported)
+        format: 'json' (a JSON array), 'jsonl' (one JSON object per line) or 'csv' (header from the first row)
+        encode: obj -> JSON text (default: json_dumps with the encoders of lessweb.Application)
+        columns: None (DbModel.dump() of each row), or the fast path of dumprows(columns)
+    """
+    def __init__(self, batch_size, format, encode, columns=None) -> None:
+        assert batch_size >= 1, 'batch_size:[{}] should be >= 1'.format(batch_size)
+        assert format in ('json', 'jsonl', 'csv'), 'format:[{}]'.format(format)
+        self.batch_size: int = batch_size
+        self.format: str = format
+        self.encode = encode
+        self.columns = columns
+
+    def _encode_json(self, obj):
+        if self.encode is not None:
+            return self.encode(obj)
+        from ..application import _make_default_json_encoders
+        return json_dumps(obj, _make_default_json_encoders(()))
+
+    def __ror__(self, other):
+        if self.format == 'json':
+            yield '['
+        if other is None:
+            yield ']' if self.format == 'json' else ''
+            return
+        if self.columns is None:
+            dump = lambda x: x.dump()
+        else:
+            dump = _query_row_mapper(other, self.columns)
+            other = dump.select(other)
+        rows = iter(other.yield_per(self.batch_size))
+        try:
+            first, writer, buffer = True, None, io.StringIO()
+            while True:
+                batch = [dump(x) for _, x in zip(range(self.batch_size), rows)]
+                if not batch:
+                    break
+                if self.format == 'csv':
+                    if writer is None:
+                        writer = csv.DictWriter(buffer, fieldnames=list(batch[0].keys()), extrasaction='ignore')
+                        writer.writeheader()
+                    writer.writerows(batch)
+                    chunk = buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                elif self.format == 'jsonl':
+                    chunk = ''.join(self._encode_json(x) + '\n' for x in batch)
+                else:
+                    chunk = ('' if first else ',') + ','.join(self._encode_json(x) for x in batch)
+                first = False
+                yield chunk
+        finally:
+            if hasattr(rows, 'close'):
+                rows.close()
+        if self.format == 'json':
+            yield ']'
+
+
+def dumpstream(batch_size=1000, format='json', encode=None, columns=None):
+    """
+    Stream a query in constant memory:
+
+        def export(ctx: DatabaseCtx):
+            ctx.set_header('Content-Type', 'text/csv; charset=utf-8')
+            return ctx.db.query(DbUser).order_by(DbUser.id) | dumpstream(batch_size=500, format='csv')
+
+    Under processor(), ctx.db stays open until the response has been sent (or the client disconnected).
+    """
+    return DumpStreamDbModel(batch_size, format, encode, columns)
+
+
+class _CountCache:
+    """
+    TTL + LRU cache of query totals
+
+        >>> cache = _CountCache(maxsize=1)
+        >>> cache.set('a', (10, False), ttl=60)
+        >>> cache.get('a')
+        (10, False)
+        >>> cache.set('b', (20, False), ttl=60)
+        >>> cache.get('a') is None, cache.get('b')
+        (True, (20, False))
+    """
+    def __init__(self, maxsize=1024) -> None:
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key => (expire_at, value)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_count_cache = _CountCache()
+
+
+def _query_key(query):
+    """-> (database url, compiled SQL, parameters) identifying the result of a query"""
+    bind = query.session.get_bind()
+    compiled = query.statement.compile(dialect=bind.dialect)
+    return str(bind.url), str(compiled), repr(sorted(compiled.params.items()))
+
+
+_count_executor = None
+
+
+def _get_count_executor():
+    global _count_executor
+    if _count_executor is None:
+        _count_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='lessweb-count')
+    return _count_executor
+
+
 class DumpPageModel:
-    def __init__(self, pageNo, pageSize):
+    def __init__(self, pageNo, pageSize, count_ttl=None, count_concurrently=False, count_cap=None, columns=None):
         if pageNo < 1: pageNo = 1
         assert pageSize >= 1, pageSize
+        assert count_cap is None or count_cap >= 1, count_cap
         self.pageNo = pageNo
         self.pageSize = pageSize
+        self.count_ttl = count_ttl
+        self.count_concurrently = count_concurrently
+        self.count_cap = count_cap
+        self.columns = columns
+
+    def _count(self, query):
+        """-> (totalNum, totalCapped)"""
+        if self.count_cap is None:
+            return query.count(), False
+        subquery = query.order_by(None).limit(self.count_cap + 1).subquery()
+        count = query.session.query(func.count()).select_from(subquery).scalar()
+        return min(count, self.count_cap), count > self.count_cap
+
+    def _count_in_new_session(self, query, bind):
+        """bind: the engine of query's session, so that the count runs on the same replica as the rows"""
+        session = Session(bind=bind)
+        try:
+            return self._count(query.with_session(session))
+        finally:
+            session.close()
+
+    def _cache_key(self, query):
+        return _query_key(query) + (self.count_cap,)
 
     def __ror__(self, other) -> PagedList:
         pagelist = PagedList()
@@ -84,17 +772,186 @@ class DumpPageModel:
         if other is None:
             return pagelist
 
-        totalNum = other.count()
-        dbitems = other.offset((self.pageNo - 1) * self.pageSize).limit(self.pageSize).all()
+        cache_key = total = future = None
+        if self.count_ttl is not None:
+            cache_key = self._cache_key(other)
+            total = _count_cache.get(cache_key)
+        if total is None and self.count_concurrently:
+            future = _get_count_executor().submit(self._count_in_new_session, other, other.session.get_bind())
+        page = other.offset((self.pageNo - 1) * self.pageSize).limit(self.pageSize)
+        if self.columns is None:
+            dbitems = page.all()
+        else:
+            mapper = _query_row_mapper(other, self.columns)
+            dbitems = mapper.select(page).all()
+        if total is None:
+            total = future.result() if future is not None else self._count(other)
+            if cache_key is not None:
+                _count_cache.set(cache_key, total, self.count_ttl)
+        totalNum, totalCapped = total
 
         if totalNum > 0:
-            pagelist.list.extend(x.dump() for x in dbitems)
+            if self.columns is None:
+                pagelist.list.extend(x.dump() for x in dbitems)
+            else:
+                pagelist.list.extend(mapper(row) for row in dbitems)
             pagelist.totalNum = totalNum
+            pagelist.totalCapped = totalCapped
         return pagelist
 
 
-def dumppage(pageNo, pageSize):
-    return DumpPageModel(pageNo, pageSize)
+def dumppage(pageNo, pageSize, count_ttl=None, count_concurrently=False, count_cap=None, columns=None):
+    """
+    count_ttl: reuse the total of an identical query (same SQL and parameters) for count_ttl seconds
+    count_concurrently: run the COUNT in another session in a background thread while fetching the page
+        (the COUNT does not see the request session's uncommitted changes)
+    count_cap: count at most count_cap+1 rows; above the cap totalNum = count_cap and totalCapped = True,
+        which means "count_cap+"
+    columns: None (DbModel.dump() of each row), or the fast path of dumprows(columns)
+    """
+    return DumpPageModel(pageNo, pageSize, count_ttl, count_concurrently, count_cap, columns)
+
+
+_ISO_FORMATS = {
+    datetime: ['%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'],
+    date: ['%Y-%m-%d'],
+    datetime_time: ['%H:%M:%S.%f%z', '%H:%M:%S%z', '%H:%M:%S.%f', '%H:%M:%S'],
+}
+
+
+def _strptime_iso(cls, text):
+    """
+    cls.fromisoformat() for python3.6, reading the output of isoformat()
+
+        >>> _strptime_iso(datetime, '2018-01-31T08:30:00.500000+08:00')
+        datetime.datetime(2018, 1, 31, 8, 30, 0, 500000, tzinfo=datetime.timezone(datetime.timedelta(seconds=28800)))
+        >>> _strptime_iso(datetime_time, '08:30:00')
+        datetime.time(8, 30)
+    """
+    if len(text) > 6 and text[-6] in '+-' and text[-3] == ':':  # python3.6 %z has no colon
+        text = text[:-3] + text[-2:]
+    for fmt in _ISO_FORMATS[cls]:
+        try:
+            value = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return value if cls is datetime else value.date() if cls is date else value.timetz()
+    raise ValueError('invalid isoformat string: %r' % text)
+
+
+def _iso_parser(cls):
+    return getattr(cls, 'fromisoformat', None) or (lambda text: _strptime_iso(cls, text))  # python3.7+
+
+
+_cursor_types = {'datetime': _iso_parser(datetime), 'date': _iso_parser(date),
+                 'time': _iso_parser(datetime_time), 'decimal': Decimal}
+
+
+def _encode_cursor(signature, values):
+    """
+        >>> token = _encode_cursor('s', [3, 'x', datetime(2018, 1, 31), Decimal('1.5')])
+        >>> _decode_cursor('s', token)
+        [3, 'x', datetime.datetime(2018, 1, 31, 0, 0), Decimal('1.5')]
+    """
+    def _tag(v):
+        for name, cls in [('datetime', datetime), ('date', date), ('time', datetime_time), ('decimal', Decimal)]:
+            if isinstance(v, cls):
+                return {name: v.isoformat() if name != 'decimal' else str(v)}
+        return v
+
+    payload = json.dumps([signature, [_tag(v) for v in values]], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(signature, token):
+    def _untag(v):
+        if isinstance(v, dict) and len(v) == 1:
+            (name, text), = v.items()
+            return _cursor_types[name](text)
+        return v
+
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+        token_signature, values = payload
+        assert token_signature == signature
+        return [_untag(v) for v in values]
+    except Exception:
+        raise BadParamError(query='after', error='invalid cursor')
+
+
+class DumpCursorModel:
+    """
+    Keyset pagination: instead of OFFSET, each page continues from the order_by values of the previous page's
+    last row (WHERE (c1, c2) > (:v1, :v2) ORDER BY c1, c2 LIMIT size+1), so page N costs the same as page 1
+    given an index on the order_by columns, and no COUNT is issued.
+
+    order_by: columns or desc(column); the last one must be unique (e.g. the primary key).
+    """
+    def __init__(self, after, size, order_by):
+        assert size >= 1, size
+        if not isinstance(order_by, (list, tuple)):
+            order_by = [order_by]
+        assert order_by, 'order_by should not be empty'
+        self.after = after
+        self.size = size
+        self.order_by = order_by
+        self.columns = []  # [(column, is_desc)]
+        for clause in order_by:
+            if getattr(clause, 'modifier', None) in (operators.desc_op, operators.asc_op):
+                self.columns.append((clause.element, clause.modifier is operators.desc_op))
+            else:
+                self.columns.append((clause, False))
+        signature = ','.join('%s%s' % ('-' if is_desc else '', column.key) for column, is_desc in self.columns)
+        self.signature = hashlib.md5(signature.encode('utf-8')).hexdigest()[:8]
+        # DbModel.attr -> its column, so that the mapped attribute can be looked up in cursor_values()
+        self.columns = [(column.__clause_element__() if hasattr(column, '__clause_element__') else column, is_desc)
+                        for column, is_desc in self.columns]
+
+    def cursor_values(self, last):
+        """the order_by values of a row, read from the mapped attributes (named as the columns or not)"""
+        mapper = sa_inspect(last).mapper
+        return [getattr(last, mapper.get_property_by_column(column).key) for column, _ in self.columns]
+
+    def _keyset_predicate(self, values):
+        directions = {is_desc for _, is_desc in self.columns}
+        if len(directions) == 1:  # row value comparison can use a composite index directly
+            left = tuple_(*[column for column, _ in self.columns])
+            right = tuple_(*values)
+            return left < right if directions.pop() else left > right
+        clauses = []
+        for i, (column, is_desc) in enumerate(self.columns):
+            equals = [c == v for (c, _), v in zip(self.columns[:i], values[:i])]
+            clauses.append(and_(*equals, column < values[i] if is_desc else column > values[i]))
+        return or_(*clauses)
+
+    def __ror__(self, other) -> CursorList:
+        cursorlist = CursorList()
+        cursorlist.size = self.size
+        if other is None:
+            return cursorlist
+
+        query = other.order_by(None).order_by(*self.order_by)
+        if self.after:
+            query = query.filter(self._keyset_predicate(_decode_cursor(self.signature, self.after)))
+        dbitems = query.limit(self.size + 1).all()
+
+        if len(dbitems) > self.size:
+            dbitems = dbitems[:self.size]
+            last = dbitems[-1]
+            cursorlist.nextCursor = _encode_cursor(self.signature, self.cursor_values(last))
+        cursorlist.list.extend(x.dump() for x in dbitems)
+        return cursorlist
+
+
+def dumpcursor(after=None, size=20, order_by=()):
+    """
+    Example:
+
+        def list_orders(ctx: DatabaseCtx, after=None, size: int = 20):
+            return ctx.db.query(DbOrder).filter(DbOrder.userId == uid) | \\
+                dumpcursor(after=after, size=size, order_by=[desc(DbOrder.createdAt), desc(DbOrder.id)])
+    """
+    return DumpCursorModel(after, size, order_by)
 
 
 class DumpOneModel:
@@ -107,14 +964,51 @@ class DumpOneModel:
 dumpone = DumpOneModel()
 
 
+def _create_engine(dburi, echo, pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping, poolclass,
+                   factory=create_engine):
+    assert pool_size is None or (isinstance(pool_size, int) and pool_size >= 0), \
+        'pool_size:[{}] should be int >= 0'.format(pool_size)
+    assert max_overflow is None or (isinstance(max_overflow, int) and max_overflow >= -1), \
+        'max_overflow:[{}] should be int >= -1 (-1 means no limit)'.format(max_overflow)
+    assert pool_timeout is None or pool_timeout > 0, 'pool_timeout:[{}] should be > 0'.format(pool_timeout)
+    assert pool_recycle is None or pool_recycle == -1 or pool_recycle > 0, \
+        'pool_recycle:[{}] should be > 0 or -1'.format(pool_recycle)
+
+    if poolclass is None:
+        url = make_url(dburi)
+        poolclass = url.get_dialect().get_pool_class(url)
+    options = dict(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout,
+                   pool_recycle=pool_recycle)
+    options = {k: v for k, v in options.items() if v is not None}  # NullPool等不接受pool_size等参数
+    engine = factory(
+        dburi,
+        poolclass=type('Lessweb' + poolclass.__name__, (_InstrumentedPool, poolclass), {'lessweb_stats': PoolStats()}),
+        pool_pre_ping=pool_pre_ping,
+        **options
+    )
+    sync_engine = getattr(engine, 'sync_engine', engine)  # events of an AsyncEngine are on its sync_engine
+    sync_engine.echo = echo
+    event.listen(sync_engine, 'checkin', _reset_deadline)
+    event.listen(sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    return engine
+
+
 @overload
-def init(*, dburi, echo=True, autoflush=True, autocommit=False): ...
+def init(*, dburi, echo=True, autoflush=True, autocommit=False, pool_size=None, max_overflow=None,
+         pool_timeout=None, pool_recycle=3600, pool_pre_ping=False, poolclass=None,
+         replicas=None, replica_policy='round_robin', replica_retry=30, sticky_seconds=0, sql_warn_repeats=10): ...
 @overload
-def init(*, protocol, username, password, host, port:int, entity, echo=True, autoflush=True, autocommit=False): ...
+def init(*, protocol, username, password, host, port:int, entity, echo=True, autoflush=True, autocommit=False,
+         pool_size=None, max_overflow=None, pool_timeout=None, pool_recycle=3600, pool_pre_ping=False,
+         poolclass=None, replicas=None, replica_policy='round_robin', replica_retry=30, sticky_seconds=0,
+         sql_warn_repeats=10): ...
 
 
 def init(*, protocol=None, username=None, password=None, host=None, port:int=None, entity=None, dburi=None,
-         echo:bool=True, autoflush=True, autocommit=False):
+         echo:bool=True, autoflush=True, autocommit=False, pool_size=None, max_overflow=None, pool_timeout=None,
+         pool_recycle=3600, pool_pre_ping=False, poolclass=None,
+         replicas=None, replica_policy='round_robin', replica_retry=30, sticky_seconds=0, sql_warn_repeats=10):
     """
     Database requirements:
         sqlalchemy
@@ -125,37 +1019,278 @@ def init(*, protocol=None, username=None, password=None, host=None, port:int=Non
         protocol = postgresql (default-port = 5432)
             psycopg2
 
+    Pool options (None means sqlalchemy's default; see create_engine()):
+        pool_size: connections kept in the pool (QueuePool default 5)
+        max_overflow: connections allowed beyond pool_size, -1 for no limit (QueuePool default 10)
+        pool_timeout: seconds to wait for a connection before raising sqlalchemy.exc.TimeoutError
+        pool_recycle: seconds after which a connection is replaced
+        pool_pre_ping: test connections for liveness on checkout
+    Size pool_size + max_overflow against the number of worker threads (Application.run(max_workers=...)).
+    Live statistics are available from pool_stats().
+
+    Read replicas:
+        replicas: list of dburi of read replicas (same pool options as the primary)
+        replica_policy: 'round_robin' or 'least_connections'
+        replica_retry: seconds a replica that failed to connect is skipped
+        sticky_seconds: after a write request, the same client reads from the primary for sticky_seconds
+            (tracked with a cookie), so it reads its own writes despite replication lag
+    processor() routes GET/HEAD/OPTIONS requests to a replica and other requests to the primary;
+    decorate a dealer with @replica or @primary to override. If no replica can be connected,
+    the primary is used.
+
+    sql_warn_repeats: log a warning (possible N+1 queries) when a statement of the same shape is executed
+        more than sql_warn_repeats times in one request (0: never), see ctx.sql (SqlStats)
     """
-    if dburi:
-        engine = create_engine(dburi)
-    else:
-        engine = create_engine(
-            '{protocol}://{username}:{password}@{host}:{port}/{entity}'.format(
-                protocol=protocol, username=quote(username), password=quote(password),
-                host=host, port=port, entity=entity
-            ),
-            pool_recycle=3600
+    if not dburi:
+        dburi = '{protocol}://{username}:{password}@{host}:{port}/{entity}'.format(
+            protocol=protocol, username=quote(username), password=quote(password),
+            host=host, port=port, entity=entity
         )
-    engine.echo = echo
+    engine = _create_engine(dburi, echo, pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping,
+                            poolclass)
     global_data.db_session_maker = scoped_session(sessionmaker(
         autoflush=autoflush, autocommit=autocommit, bind=engine))
     global_data.db_engine = engine
     global_data.autocommit = autocommit
 
+    global_data.replicas = None
+    if replicas:
+        engines = [
+            _create_engine(uri, echo, pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping, poolclass)
+            for uri in replicas
+        ]
+        global_data.replicas = ReplicaSet(engines, [
+            sessionmaker(autoflush=autoflush, autocommit=autocommit, bind=e) for e in engines
+        ], replica_policy, replica_retry)
+    global_data.sticky_seconds = sticky_seconds
+    global_data.sql_warn_repeats = sql_warn_repeats
+
+
+def apply_deadline(session, ctx: Context):
+    """
+    根据ctx.remaining()设置session所用连接的语句超时，使ctx.deadline到达时数据库中止正在执行的SQL
+        postgresql: SET LOCAL statement_timeout (当前事务内有效)
+        mysql: SET SESSION max_execution_time (只对SELECT有效，连接归还连接池时重置)
+        sqlite: progress handler (连接归还连接池时移除)
+    """
+    remaining = ctx.remaining()
+    if remaining is None:
+        return
+    milliseconds = max(1, int(remaining * 1000))
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        session.execute(text('SET LOCAL statement_timeout = %d' % milliseconds))
+    elif dialect == 'mysql':
+        session.execute(text('SET SESSION max_execution_time = %d' % milliseconds))
+        session.connection().connection.info['lessweb_deadline'] = dialect
+    elif dialect == 'sqlite':
+        deadline = ctx.deadline
+        dbapi_connection = session.connection().connection
+        dbapi_connection.set_progress_handler(lambda: time.monotonic() >= deadline, 1000)
+        dbapi_connection.info['lessweb_deadline'] = dialect
+
+
+def _reset_deadline(dbapi_connection, connection_record):
+    connection_record.info.pop(_SQL_STATS, None)
+    connection_record.info.pop('lessweb_sql_start', None)
+    dialect = connection_record.info.pop('lessweb_deadline', None)
+    if dialect == 'mysql':
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SET SESSION max_execution_time = 0')
+        cursor.close()
+    elif dialect == 'sqlite':
+        dbapi_connection.set_progress_handler(None, 0)
+
+
+def _engine_pool_stats(engine):
+    pool = engine.pool
+    stats = pool.lessweb_stats.storage()
+    stats.pool = type(pool).__name__[len('Lessweb'):]
+    for key, method in [('size', 'size'), ('checked_in', 'checkedin'), ('checked_out', 'checkedout'),
+                        ('overflow', 'overflow')]:
+        stats[key] = getattr(pool, method)() if hasattr(pool, method) else None
+    return stats
+
+
+def pool_stats():
+    """
+    Live statistics of the connection pool:
+        pool, size, checked_in, checked_out, overflow (None if the pool class does not track it),
+        checkouts, timeouts, in_use, wait_total, wait_max, wait_histogram,
+        replicas: [same statistics + failures for each replica]
+    """
+    stats = _engine_pool_stats(global_data.db_engine)
+    stats.replicas = []
+    replicas = global_data.replicas
+    if replicas is not None:
+        for engine, failures in zip(replicas.engines, replicas.failures):
+            stats.replicas.append(_engine_pool_stats(engine))
+            stats.replicas[-1].failures = failures
+        stats.replica_fallbacks = replicas.fallbacks
+    return stats
+
+
+class LazySession:
+    """
+    Proxy of a Session which is created by factory() on first use.
+    Requests that never touch ctx.db do not check out a connection or do rollback/close bookkeeping.
+
+        >>> opened = []
+        >>> db = LazySession(lambda: opened.append(1) or Storage(query=lambda x: x))
+        >>> db._session is None, opened
+        (True, [])
+        >>> db.query('q'), opened
+        ('q', [1])
+    """
+    def __init__(self, factory) -> None:
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_session', None)
+
+    def _get_session(self):
+        if self._session is None:
+            object.__setattr__(self, '_session', self._factory())
+        return self._session
+
+    def __getattr__(self, key):
+        return getattr(self._get_session(), key)
+
+    def __setattr__(self, key, value):
+        setattr(self._get_session(), key, value)
+
+    def __contains__(self, instance):
+        return instance in self._get_session()
+
+    def __iter__(self):
+        return iter(self._get_session())
+
+    def __repr__(self):
+        return '<LazySession %r>' % self._session
+
+
+_safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+
+def replica(dealer):
+    """Decorator: route the dealer's ctx.db to a read replica whatever the HTTP method"""
+    dealer.lessweb_db_route = 'replica'
+    return dealer
+
+
+def primary(dealer):
+    """Decorator: route the dealer's ctx.db to the primary whatever the HTTP method"""
+    dealer.lessweb_db_route = 'primary'
+    return dealer
+
+
+def _route(ctx: Context):
+    """-> 'replica' or 'primary'"""
+    route = getattr(getattr(ctx.mapping, 'dealer', None), 'lessweb_db_route', None)
+    if route is None:
+        route = 'replica' if ctx.method in _safe_methods else 'primary'
+    if route == 'replica' and global_data.sticky_seconds:
+        until = eafp(lambda: float(ctx.get_cookie()[global_data.sticky_cookie]), 0)
+        if until > time.time():
+            route = 'primary'
+    return route
+
+
+def _open_session(ctx: Context):
+    session = None
+    if global_data.replicas is not None and _route(ctx) == 'replica':
+        session = global_data.replicas.open_session()
+    if session is None:
+        # not the thread-local scoped session: a streamed response or an async dealer outlives the thread's
+        # current request, and async dealers share the loop thread
+        session = global_data.db_session_maker.session_factory()
+        if ctx.method not in _safe_methods and global_data.sticky_seconds:
+            ctx.set_cookie(global_data.sticky_cookie, str(int(time.time() + global_data.sticky_seconds)),
+                           expires=int(global_data.sticky_seconds), httponly=True)
+    session.info[_SQL_STATS] = ctx.sql
+    if session.in_transaction():  # a replica session is already connected
+        session.connection().info[_SQL_STATS] = ctx.sql
+    if global_data.autocommit:
+        session.begin()
+    apply_deadline(session, ctx)
+    return session
+
+
+def _close_session(db: LazySession):
+    if db._session is not None:
+        db._session.close()
+        db._session.info.pop(_SQL_STATS, None)
+
+
+def _stream_with_session(generator, db: LazySession):
+    """
+    ctx.db of a generator response is committed and closed after the stream has been sent.
+    The session belongs to this request only, the WSGI server must read the whole stream on one thread.
+    """
+    try:
+        yield from generator
+        if global_data.autocommit and db._session is not None:
+            db._session.commit()
+    except:  # including GeneratorExit when the client disconnected
+        if db._session is not None:
+            db._session.rollback()
+        raise
+    finally:
+        _close_session(db)
+
+
+def _end_session(ctx: DatabaseCtx, db: LazySession):
+    _close_session(db)
+    if ctx.sql.count and ctx.app is not None and ctx.app.debug:
+        ctx.set_header('Server-Timing', ctx.sql.server_timing())
+
+
+async def _await_with_session(ctx: DatabaseCtx, coro, db: LazySession):
+    """ctx.db of an async dealer is committed and closed after the coroutine has run"""
+    try:
+        result = await coro
+        if global_data.autocommit and db._session is not None:
+            db._session.commit()
+        return result
+    except:
+        if db._session is not None:
+            db._session.rollback()
+        ctx.check_deadline()
+        raise
+    finally:
+        _end_session(ctx, db)
+
 
 def processor(ctx: DatabaseCtx):
+    """
+    ctx.db: session opened on first use, committed (autocommit=True) or rolled back and closed after the dealer
+    ctx.sql: SqlStats of the request; in debug mode the response has a Server-Timing header
+
+    With an async dealer (or async interceptor inside), the coroutine is wrapped so that the session is
+    committed and closed after it has run; the session is still synchronous (and blocks the event loop),
+    aiodatabase.processor gives an AsyncSession. Overlapping async requests share the loop thread but each
+    has its own session.
+    """
+    db = ctx.db = LazySession(lambda: _open_session(ctx))
+    ctx.sql = SqlStats(global_data.sql_warn_repeats)
+    deferred = False  # the session is closed by the stream or the coroutine
     try:
-        ctx.db = global_data.db_session_maker()
-        if global_data.autocommit:
-            with ctx.db.begin():
-                return ctx()
-        else:
-            return ctx()
+        result = ctx()
+        if isinstance(result, GeneratorType):
+            deferred = True
+            return _stream_with_session(result, db)
+        if inspect.iscoroutine(result):
+            deferred = True
+            return _await_with_session(ctx, result, db)
+        if global_data.autocommit and db._session is not None:
+            db._session.commit()
+        return result
     except:
-        ctx.db.rollback()
+        if db._session is not None:
+            db._session.rollback()
+        ctx.check_deadline()  # 因超时被数据库中止的请求返回504
         raise
     finally:
-        ctx.db.close()
+        if not deferred:
+            _end_session(ctx, db)
 
 
 def create_all(*DbModelClass):
@@ -171,11 +1306,142 @@ def create_all(*DbModelClass):
         db_class.metadata.create_all(global_data.db_engine)
 
 
+def _bulk_rows(table, rows):
+    """dicts / lessweb Models / DbModels => dicts of the table's columns"""
+    columns = set(table.columns.keys())
+    for row in rows:
+        if not isinstance(row, dict):
+            row = row.storage()
+        yield {k: v for k, v in row.items() if k in columns}
+
+
+def _bulk_chunks(table, rows, chunk_size):
+    """
+    Split rows into chunks of at most chunk_size rows with the same keys
+    (an executemany statement is compiled from the keys of its first row)
+    """
+    assert chunk_size >= 1, 'chunk_size:[{}] should be >= 1'.format(chunk_size)
+    chunk, keys = [], None
+    for row in _bulk_rows(table, rows):
+        if chunk and (len(chunk) >= chunk_size or row.keys() != keys):
+            yield chunk
+            chunk = []
+        chunk.append(row)
+        keys = row.keys()
+    if chunk:
+        yield chunk
+
+
+def _primary_key(table, key):
+    return key[0] if len(table.primary_key.columns) == 1 else tuple(key)
+
+
+def bulk_insert(session, DbModelClass, rows, chunk_size=1000, return_keys=False):
+    """
+    INSERT rows (dicts, lessweb Models or DbModels) with one executemany statement per chunk,
+    bypassing the ORM unit of work (no objects are created, defaults are applied by the database).
+    The session's transaction is used: call session.commit() afterwards as usual.
+        -> number of rows inserted, or the list of primary keys when return_keys=True
+
+    With return_keys=True the keys come from INSERT ... RETURNING on databases supporting it
+    (e.g. PostgreSQL); on others (SQLite, MySQL) rows are inserted one by one to read their keys.
+
+        >>> init(dburi='sqlite://', echo=False)
+        >>> from sqlalchemy import Column, Integer, String
+        >>> class DbTag(DbModel):
+        ...     __tablename__ = 'tag'
+        ...     id = Column(Integer, primary_key=True)
+        ...     name = Column(String(20))
+        >>> DbTag.metadata.create_all(global_data.db_engine, [DbTag.__table__])
+        >>> with make_session() as session:
+        ...     DbTag.bulk_insert(session, [{'name': 'a'}, {'name': 'b'}], chunk_size=1)
+        ...     DbTag.bulk_insert(session, [DbTag(name='c')], return_keys=True)
+        2
+        [3]
+    """
+    table = DbModelClass.__table__
+    if not return_keys:
+        count = 0
+        for chunk in _bulk_chunks(table, rows, chunk_size):
+            session.execute(table.insert(), chunk)
+            count += len(chunk)
+        return count
+
+    keys = []
+    dialect = session.get_bind(DbModelClass).dialect
+    if dialect.implicit_returning and dialect.supports_multivalues_insert:
+        for chunk in _bulk_chunks(table, rows, chunk_size):
+            result = session.execute(table.insert().values(chunk).returning(*table.primary_key.columns))
+            keys.extend(_primary_key(table, key) for key in result)
+    else:
+        for chunk in _bulk_chunks(table, rows, chunk_size):
+            for row in chunk:
+                result = session.execute(table.insert(), row)
+                keys.append(_primary_key(table, result.inserted_primary_key))
+    return keys
+
+
+def bulk_upsert(session, DbModelClass, rows, chunk_size=1000, index_elements=None, update=None):
+    """
+    INSERT rows, or UPDATE the existing row when it conflicts on index_elements
+    (column names of the primary key or a unique index, default: the primary key).
+        update: column names to update on conflict (default: all other columns present in the row)
+        -> number of rows written
+    Uses INSERT ... ON CONFLICT DO UPDATE on PostgreSQL and SQLite, INSERT ... ON DUPLICATE KEY UPDATE
+    on MySQL (where the conflict target is any unique key), and session.merge() row by row elsewhere.
+    """
+    table = DbModelClass.__table__
+    dialect = session.get_bind(DbModelClass).dialect.name
+    if index_elements is None:
+        index_elements = [c.name for c in table.primary_key.columns]
+
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+    else:
+        count = 0
+        for chunk in _bulk_chunks(table, rows, chunk_size):
+            for row in chunk:
+                session.merge(DbModelClass(**row))
+            session.flush()
+            count += len(chunk)
+        return count
+
+    count = 0
+    for chunk in _bulk_chunks(table, rows, chunk_size):
+        columns = update if update is not None else [k for k in chunk[0] if k not in index_elements]
+        stmt = dialect_insert(table)
+        if dialect == 'mysql':
+            stmt = stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in columns}) if columns \
+                else stmt.prefix_with('IGNORE')
+        elif columns:
+            stmt = stmt.on_conflict_do_update(index_elements=index_elements,
+                                              set_={c: stmt.excluded[c] for c in columns})
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+        session.execute(stmt, chunk)
+        count += len(chunk)
+    return count
+
+
+DbModel.bulk_insert = classmethod(lambda cls, session, rows, chunk_size=1000, return_keys=False:
+                                  bulk_insert(session, cls, rows, chunk_size, return_keys))
+DbModel.bulk_upsert = classmethod(lambda cls, session, rows, chunk_size=1000, index_elements=None, update=None:
+                                  bulk_upsert(session, cls, rows, chunk_size, index_elements, update))
+
+
 @contextmanager
-def make_session():
+def make_session(replica=False):
+    """replica=True: use a read replica if one is available"""
     session = None
     try:
-        session = global_data.db_session_maker()
+        if replica and global_data.replicas is not None:
+            session = global_data.replicas.open_session()
+        if session is None:
+            session = global_data.db_session_maker()
         yield session
     except:
         session.rollback()
@@ -211,6 +1477,12 @@ ctx.db.add(cc_cookie)
 ctx.db.commit()
 print(cc_cookie.cookie_id)  #output: 1
 
+##MANY COOKIES
+from lessweb.plugin.database import bulk_insert, bulk_upsert
+Cookie.bulk_insert(ctx.db, [{'cookie_name': 'chip', ...}, CookieModel(...), ...], chunk_size=1000)
+Cookie.bulk_upsert(ctx.db, rows, index_elements=['cookie_sku'])  #INSERT ... ON CONFLICT DO UPDATE
+ctx.db.commit()
+
 session = ctx.db
 
 #QUERY
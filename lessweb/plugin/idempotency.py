@@ -0,0 +1,241 @@
+import base64
+import hashlib
+import inspect
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from types import GeneratorType
+
+from ..context import Context
+from ..storage import Storage
+from ..webapi import HttpError, BadRequest, Conflict, UnprocessableEntity
+from . import redis as redis_plugin
+
+
+__all__ = ["LocalIdempotencyStore", "RedisIdempotencyStore", "Idempotency", "idempotency"]
+
+
+class LocalIdempotencyStore:
+    """
+    In-process store of idempotency records (duplicates are only detected within the process)
+
+        >>> store = LocalIdempotencyStore()
+        >>> store.begin('k', {'state': 'pending', 'token': 't'}, ttl=60)
+        >>> store.begin('k', {'state': 'pending', 'token': 'u'}, ttl=60)
+        {'state': 'pending', 'token': 't'}
+        >>> store.release('k', 't')
+        >>> store.begin('k', {'state': 'pending', 'token': 'u'}, ttl=60)
+    """
+    def __init__(self, maxsize=100000) -> None:
+        self.maxsize: int = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key => (expire_at, record)
+
+    def _purge(self, now):
+        while self._data:
+            key, (expire_at, _) = next(iter(self._data.items()))
+            if expire_at > now and len(self._data) <= self.maxsize:
+                break
+            del self._data[key]
+
+    def begin(self, key, record, ttl):
+        """store record if the key is free and return None, otherwise return the record of the key"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            self._data[key] = (now + ttl, record)
+            self._data.move_to_end(key)
+            self._purge(now)
+
+    def save(self, key, record, ttl):
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (now + ttl, record)
+            self._data.move_to_end(key)
+            self._purge(now)
+
+    def release(self, key, token):
+        """forget the key if it is still locked with token"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1].get('token') == token:
+                del self._data[key]
+
+
+# KEYS[1]: record; ARGV[1]: token
+_RELEASE_LUA = """
+local raw = redis.call('GET', KEYS[1])
+if raw and cjson.decode(raw)['token'] == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisIdempotencyStore:
+    """Store of idempotency records in Redis (lessweb.plugin.redis, or the given client), shared by all processes"""
+    def __init__(self, redis=None, prefix='lessweb:idem:') -> None:
+        self.redis = redis
+        self.prefix: str = prefix
+
+    def _client(self):
+        return self.redis if self.redis is not None else redis_plugin.session()
+
+    def begin(self, key, record, ttl):
+        client = self._client()
+        name = self.prefix + key
+        raw = json.dumps(record)
+        for _ in range(3):
+            if client.set(name, raw, nx=True, px=max(1, int(ttl * 1000))):
+                return None
+            existing = client.get(name)
+            if existing is not None:
+                return json.loads(existing)
+        return None  # the key expires again and again: proceed without the lock
+
+    def save(self, key, record, ttl):
+        self._client().set(self.prefix + key, json.dumps(record), px=max(1, int(ttl * 1000)))
+
+    def release(self, key, token):
+        self._client().eval(_RELEASE_LUA, 1, self.prefix + key, token)
+
+
+class Idempotency:
+    """
+    Interceptor honouring the Idempotency-Key header, see idempotency().
+    stats(): executed, replayed, conflicts (409: first attempt in flight), mismatches (422: key reused)
+    """
+    def __init__(self, store=None, ttl=86400, lock_timeout=60, methods=('POST', 'PUT', 'PATCH'),
+                 header='Idempotency-Key', scope=None, required=False) -> None:
+        assert ttl > 0, 'ttl:[{}] should be > 0'.format(ttl)
+        assert lock_timeout > 0, 'lock_timeout:[{}] should be > 0'.format(lock_timeout)
+        self.store = LocalIdempotencyStore() if store is None else store
+        self.ttl: float = ttl
+        self.lock_timeout: float = lock_timeout
+        self.methods = tuple(m.upper() for m in methods)
+        self.header: str = header
+        self.scope = scope
+        self.required: bool = required
+        self._counter_lock = threading.Lock()
+        self.executed: int = 0
+        self.replayed: int = 0
+        self.conflicts: int = 0
+        self.mismatches: int = 0
+
+    def _count(self, name):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @staticmethod
+    def _fingerprint(ctx: Context):
+        digest = hashlib.sha256()
+        for part in (ctx.method, ctx.path, ctx.query):
+            digest.update(part.encode('utf-8') + b'\n')
+        digest.update(ctx.data() if ctx.method not in ('GET', 'HEAD', 'DELETE') else b'')
+        return digest.hexdigest()
+
+    def _save(self, ctx: Context, key, fingerprint, body: bytes):
+        self.store.save(key, {
+            'state': 'done', 'fingerprint': fingerprint, 'status': ctx.status_code, 'reason': ctx.reason,
+            'headers': [[k, v] for k, v in ctx.headers], 'body': base64.b64encode(body).decode('ascii'),
+        }, self.ttl)
+
+    def _replay(self, ctx: Context, record):
+        ctx.status_code, ctx.reason = record['status'], record['reason']
+        ctx.headers = [(k, v) for k, v in record['headers']]
+        ctx.set_header('Idempotent-Replayed', 'true')
+        return base64.b64decode(record['body'])
+
+    def _finish(self, ctx: Context, key, token, fingerprint, result):
+        if isinstance(result, GeneratorType):  # streamed responses are not stored
+            self.store.release(key, token)
+            return result
+        self._save(ctx, key, fingerprint, b''.join(ctx.app._encode_result((result,))))
+        return result
+
+    async def _finish_async(self, ctx: Context, key, token, fingerprint, coro):
+        try:
+            result = await coro
+        except BaseException as e:
+            self._fail(ctx, key, token, fingerprint, e)
+            raise
+        return self._finish(ctx, key, token, fingerprint, result)
+
+    def _fail(self, ctx: Context, key, token, fingerprint, e):
+        """client errors are final and replayed, the request can be retried after other errors"""
+        if isinstance(e, HttpError) and e.status_code < 500:
+            ctx.status_code, ctx.reason, ctx.headers = e.status_code, e.reason, e.headers
+            self._save(ctx, key, fingerprint, e.text.encode(ctx.app.encoding))
+        else:
+            self.store.release(key, token)
+
+    def __call__(self, ctx: Context):
+        if ctx.method not in self.methods:
+            return ctx()
+        value = ctx.get_header(self.header)
+        if not value:
+            if self.required:
+                raise BadRequest('%s header is required' % self.header)
+            return ctx()
+        if len(value) > 255:
+            raise BadRequest('%s header is too long' % self.header)
+        key = value if self.scope is None else '%s:%s' % (self.scope(ctx), value)
+        fingerprint = self._fingerprint(ctx)
+        token = uuid.uuid4().hex
+        record = self.store.begin(key, {'state': 'pending', 'token': token, 'fingerprint': fingerprint},
+                                  self.lock_timeout)
+        if record is not None:
+            if record.get('fingerprint') != fingerprint:
+                self._count('mismatches')
+                raise UnprocessableEntity('%s was used with another request' % self.header)
+            if record.get('state') != 'done':
+                self._count('conflicts')
+                raise Conflict('a request with the same %s is in progress' % self.header,
+                               headers=[('Retry-After', '1')])
+            self._count('replayed')
+            return self._replay(ctx, record)
+
+        self._count('executed')
+        try:
+            result = ctx()
+        except BaseException as e:
+            self._fail(ctx, key, token, fingerprint, e)
+            raise
+        if inspect.iscoroutine(result):  # an async interceptor (e.g. aiodatabase.processor) runs inside
+            return self._finish_async(ctx, key, token, fingerprint, result)
+        return self._finish(ctx, key, token, fingerprint, result)
+
+    def stats(self):
+        return Storage(executed=self.executed, replayed=self.replayed, conflicts=self.conflicts,
+                       mismatches=self.mismatches)
+
+
+def idempotency(store=None, ttl=86400, lock_timeout=60, methods=('POST', 'PUT', 'PATCH'),
+                header='Idempotency-Key', scope=None, required=False) -> Idempotency:
+    """
+    Interceptor making retried writes safe: the first request with a given Idempotency-Key runs the dealer,
+    and its final status, headers and body are stored for `ttl` seconds; duplicates get the stored response
+    (with the header Idempotent-Replayed: true) without running the dealer.
+
+        app.add_interceptor('/orders', 'POST', idempotency(RedisIdempotencyStore(), ttl=86400,
+                                                            scope=lambda ctx: ctx.get_cookie().get('uid')))
+        app.add_interceptor('/orders', 'POST', database.processor)
+
+    Add it before database.processor (the interceptors added first are the outer ones), so that the response
+    is stored after the commit and duplicates do not open a session.
+
+    * A duplicate received while the first attempt is still running gets 409 Conflict (with Retry-After);
+      the key is locked for at most lock_timeout seconds.
+    * The same key sent with another method, path, query or body gets 422 Unprocessable Entity.
+    * HttpErrors below 500 are stored and replayed; after other errors the key is released, so that
+      the client can retry. Streamed (generator) responses are not stored.
+
+    store: LocalIdempotencyStore() (default, in-process) or RedisIdempotencyStore() (shared by all processes)
+    scope: function of ctx (e.g. the user id) prefixed to the key, so that clients cannot see each other's responses
+    required: respond 400 to requests without the header
+    """
+    return Idempotency(store, ttl, lock_timeout, methods, header, scope, required)
@@ -0,0 +1,279 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import ConnectionError, TimeoutError, NoScriptError
+
+from ..context import Context
+from ..storage import Storage
+from ..webapi import TooManyRequests
+from . import redis as redis_plugin
+
+
+__all__ = ["RateLimiter", "LocalTokenBucket", "LocalSlidingWindow", "rate_limit"]
+
+
+# KEYS[1]: bucket; ARGV: rate (tokens/s), burst -> {allowed, seconds to wait}
+_TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed, wait = 0, (1 - tokens) / rate
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed, wait = 1, 0
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(wait)}
+"""
+
+# KEYS[1]: counters; ARGV: window (s), limit -> {allowed, seconds to wait}
+_SLIDING_WINDOW_LUA = """
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local current = math.floor(now / window)
+local state = redis.call('HMGET', KEYS[1], 'window', 'count', 'previous')
+local count, previous = tonumber(state[2]) or 0, tonumber(state[3]) or 0
+local last = tonumber(state[1])
+if last ~= current then
+    if last == current - 1 then previous = count else previous = 0 end
+    count = 0
+end
+local elapsed = now - current * window
+if previous * (window - elapsed) / window + count + 1 > limit then
+    local wait
+    if count + 1 > limit then
+        wait = window - elapsed + math.max(0, window * (1 - (limit - 1) / count))
+    else
+        wait = math.max(0, window * (1 - (limit - 1 - count) / previous) - elapsed)
+    end
+    return {0, tostring(wait)}
+end
+redis.call('HSET', KEYS[1], 'window', current, 'count', count + 1, 'previous', previous)
+redis.call('PEXPIRE', KEYS[1], math.ceil(window * 2000))
+return {1, '0'}
+"""
+
+
+class _LocalLimiter:
+    """In-process limiter; the state of at most maxkeys keys is kept (least recently used are dropped)"""
+    def __init__(self, maxkeys=100000) -> None:
+        self.maxkeys: int = maxkeys
+        self._lock = threading.Lock()
+        self._state = OrderedDict()
+
+    def _get(self, key):
+        state = self._state.get(key)
+        if state is not None:
+            self._state.move_to_end(key)
+        return state
+
+    def _put(self, key, state):
+        self._state[key] = state
+        self._state.move_to_end(key)
+        while len(self._state) > self.maxkeys:
+            self._state.popitem(last=False)
+
+
+class LocalTokenBucket(_LocalLimiter):
+    """
+    Token bucket: `burst` requests at once, then `rate` requests per second
+
+        >>> bucket = LocalTokenBucket(rate=1, burst=2)
+        >>> [bucket.hit('a', now=100.0)[0] for _ in range(3)]
+        [True, True, False]
+        >>> bucket.hit('a', now=100.0)[1]
+        1.0
+        >>> bucket.hit('a', now=101.0)
+        (True, 0.0)
+    """
+    def __init__(self, rate, burst, maxkeys=100000) -> None:
+        super().__init__(maxkeys)
+        self.rate: float = rate
+        self.burst: float = burst
+
+    def hit(self, key, now=None):
+        """-> (allowed, seconds to wait before retrying)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, ts = self._get(key) or (self.burst, now)
+            tokens = min(self.burst, tokens + max(0.0, now - ts) * self.rate)
+            if tokens >= 1:
+                self._put(key, (tokens - 1, now))
+                return True, 0.0
+            self._put(key, (tokens, now))
+            return False, (1 - tokens) / self.rate
+
+
+class LocalSlidingWindow(_LocalLimiter):
+    """
+    Sliding window counter: at most `limit` requests in any `window` seconds
+    (the count of the previous fixed window is weighted by its overlap with the sliding window)
+
+        >>> limiter = LocalSlidingWindow(limit=2, window=10)
+        >>> [limiter.hit('a', now=100.0)[0] for _ in range(3)]
+        [True, True, False]
+        >>> limiter.hit('a', now=105.0)
+        (False, 10.0)
+        >>> limiter.hit('a', now=115.0)
+        (True, 0.0)
+    """
+    def __init__(self, limit, window, maxkeys=100000) -> None:
+        super().__init__(maxkeys)
+        self.limit: int = limit
+        self.window: float = window
+
+    def hit(self, key, now=None):
+        """-> (allowed, seconds to wait before retrying)"""
+        now = time.time() if now is None else now
+        window, limit = self.window, self.limit
+        current = math.floor(now / window)
+        with self._lock:
+            last, count, previous = self._get(key) or (current, 0, 0)
+            if last != current:
+                previous, count = (count if last == current - 1 else 0), 0
+            elapsed = now - current * window
+            if previous * (window - elapsed) / window + count + 1 > limit:
+                self._put(key, (current, count, previous))
+                if count + 1 > limit:
+                    return False, window - elapsed + max(0.0, window * (1 - (limit - 1) / count))
+                return False, max(0.0, window * (1 - (limit - 1 - count) / previous) - elapsed)
+            self._put(key, (current, count + 1, previous))
+            return True, 0.0
+
+
+def _key_function(key):
+    if callable(key):
+        return key
+    if key == 'ip':
+        return lambda ctx: ctx.ip
+    if key.startswith('header:'):
+        header = key[len('header:'):]
+        return lambda ctx: ctx.get_header(header)
+    raise ValueError("key:[{}] should be 'ip', 'header:<Name>' or a function of ctx".format(key))
+
+
+class RateLimiter:
+    """
+    Interceptor admitting at most `limit` requests per `per` seconds for each key, see rate_limit().
+    stats(): allowed, limited, fallbacks (checks done locally because Redis was unreachable)
+    """
+    def __init__(self, limit, per=1.0, burst=None, key='ip', algorithm='token_bucket', backend='redis',
+                 redis=None, prefix='lessweb:rl:', scope=None, fallback=True, maxkeys=100000) -> None:
+        assert limit > 0, 'limit:[{}] should be > 0'.format(limit)
+        assert per > 0, 'per:[{}] should be > 0'.format(per)
+        assert algorithm in ('token_bucket', 'sliding_window'), \
+            "algorithm:[{}] should be 'token_bucket' or 'sliding_window'".format(algorithm)
+        assert backend in ('redis', 'local'), "backend:[{}] should be 'redis' or 'local'".format(backend)
+        self.limit = limit
+        self.per: float = per
+        self.burst = limit if burst is None else burst
+        self.algorithm: str = algorithm
+        self.backend: str = backend
+        self.redis = redis
+        self.fallback: bool = fallback
+        self.key_of = _key_function(key)
+        if scope is None:
+            scope = '%s:%s/%s' % (algorithm, limit, per)
+        self.prefix: str = prefix + scope + ':'
+        if algorithm == 'token_bucket':
+            self.local = LocalTokenBucket(limit / per, self.burst, maxkeys)
+            self._script, self._args = _TOKEN_BUCKET_LUA, (limit / per, self.burst)
+        else:
+            self.local = LocalSlidingWindow(limit, per, maxkeys)
+            self._script, self._args = _SLIDING_WINDOW_LUA, (per, limit)
+        self._sha = hashlib.sha1(self._script.encode()).hexdigest()
+        self._loaded = False  # whether Redis is known to have the script
+        self._counter_lock = threading.Lock()
+        self.allowed: int = 0
+        self.limited: int = 0
+        self.fallbacks: int = 0
+
+    def _client(self):
+        return self.redis if self.redis is not None else redis_plugin.session()
+
+    def _redis_hit(self, key):
+        """one EVALSHA (EVAL the first time, or when Redis lost the script)"""
+        client = self._client()
+        name = self.prefix + key
+        if self._loaded:
+            try:
+                allowed, wait = client.evalsha(self._sha, 1, name, *self._args)
+                return bool(allowed), float(wait)
+            except NoScriptError:
+                pass
+        allowed, wait = client.eval(self._script, 1, name, *self._args)  # EVAL caches the script
+        self._loaded = True
+        return bool(allowed), float(wait)
+
+    def hit(self, key):
+        """-> (allowed, seconds to wait before retrying)"""
+        key = str(key)
+        if self.backend == 'local':
+            return self.local.hit(key)
+        try:
+            return self._redis_hit(key)
+        except (ConnectionError, TimeoutError):
+            if not self.fallback:
+                raise
+            with self._counter_lock:
+                self.fallbacks += 1
+            return self.local.hit(key)
+
+    def __call__(self, ctx: Context):
+        key = self.key_of(ctx)
+        if key is None:  # e.g. no such header: not limited
+            return ctx()
+        allowed, wait = self.hit(key)
+        with self._counter_lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.limited += 1
+        if not allowed:
+            raise TooManyRequests(retry_after=max(1, math.ceil(wait)))
+        return ctx()
+
+    def stats(self):
+        return Storage(limit=self.limit, per=self.per, burst=self.burst, algorithm=self.algorithm,
+                       backend=self.backend, allowed=self.allowed, limited=self.limited, fallbacks=self.fallbacks)
+
+
+def rate_limit(limit, per=1.0, burst=None, key='ip', algorithm='token_bucket', backend='redis', redis=None,
+               prefix='lessweb:rl:', scope=None, fallback=True, maxkeys=100000) -> RateLimiter:
+    """
+    Interceptor admitting at most `limit` requests per `per` seconds for each key;
+    the others get 429 Too Many Requests with Retry-After, before the dealer runs:
+
+        login_limit = rate_limit(5, per=60, key='ip', algorithm='sliding_window')
+        app.add_interceptor('/login', 'POST', login_limit)
+        app.add_interceptor('/api/.*', '*', rate_limit(20, burst=40, key=lambda ctx: ctx.get_cookie().get('uid')))
+        app.add_interceptor('/api/.*', '*', database.processor)
+
+    Add it before database.processor (the interceptors added first are the outer ones),
+    so that a limited request does not open a session.
+
+    key: 'ip', 'header:<Name>' (e.g. 'header:X-Api-Key') or a function of ctx (e.g. the user id);
+        requests whose key is None are not limited
+    algorithm:
+        'token_bucket': `burst` (default: limit) requests at once, refilled at limit/per per second
+        'sliding_window': at most `limit` requests in any `per` seconds (weighted counters of two windows)
+    backend:
+        'redis': the limit is shared by all processes, with one Lua script call (one round trip) per request
+            through lessweb.plugin.redis (or the given redis client); if Redis is unreachable, the requests are
+            checked by the in-process limiter instead (fallback=False: raise)
+        'local': in-process only (the limit is per process)
+    scope: namespace of the keys in Redis (default: derived from algorithm, limit and per)
+    maxkeys: keys remembered by the in-process limiter
+    """
+    return RateLimiter(limit, per, burst, key, algorithm, backend, redis, prefix, scope, fallback, maxkeys)
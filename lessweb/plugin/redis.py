@@ -1,7 +1,18 @@
+import json
+import threading
+import time
 from typing import Any
-from redis import Redis, ConnectionPool
+from redis import Redis, ConnectionPool, BlockingConnectionPool
+from redis.client import Pipeline
+from redis.connection import UnixDomainSocketConnection
+from redis.exceptions import ConnectionError
 
 from ..context import Context
+from ..storage import Storage
+from ..utils import json_dumps
+
+
+__all__ = ["global_data", "init", "processor", "session", "pool_stats", "LesswebRedis", "RedisBatch", "RedisFuture"]
 
 
 class GlobalData:
@@ -11,18 +22,263 @@ class GlobalData:
 global_data = GlobalData()
 
 
+_POOL_LIMIT_ERRORS = ('Too many connections', 'No connection available')
+
+
+class _InstrumentedPool:
+    """Mixin of redis connection pools counting connections in use and the time spent waiting for one"""
+    def _lessweb_init(self):
+        self.lessweb_lock = threading.Lock()
+        self.lessweb_checked_out = set()  # id() of the connections returned by get_connection()
+        self.lessweb_checkouts = 0
+        self.lessweb_exhausted = 0  # no connection available: over max_connections, or waited longer than timeout
+        self.lessweb_wait_total = 0.0
+        self.lessweb_wait_max = 0.0
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except ConnectionError as e:  # also raised when the server cannot be reached
+            if str(e).startswith(_POOL_LIMIT_ERRORS):
+                with self.lessweb_lock:
+                    self.lessweb_exhausted += 1
+            raise
+        seconds = time.perf_counter() - start
+        with self.lessweb_lock:
+            self.lessweb_checked_out.add(id(connection))
+            self.lessweb_checkouts += 1
+            self.lessweb_wait_total += seconds
+            self.lessweb_wait_max = max(self.lessweb_wait_max, seconds)
+        return connection
+
+    def release(self, connection):
+        # redis-py also releases the connections which failed to connect inside get_connection()
+        with self.lessweb_lock:
+            self.lessweb_checked_out.discard(id(connection))
+        return super().release(connection)
+
+    def lessweb_idle(self) -> int:
+        if hasattr(self, '_available_connections'):  # ConnectionPool
+            return len(self._available_connections)
+        return sum(1 for c in list(self.pool.queue) if c is not None)  # BlockingConnectionPool
+
+
+class LesswebConnectionPool(_InstrumentedPool, ConnectionPool):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._lessweb_init()
+
+
+class LesswebBlockingConnectionPool(_InstrumentedPool, BlockingConnectionPool):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._lessweb_init()
+
+
+class RedisFuture:
+    """Result of a command of RedisBatch; result() sends the pending commands of the batch if needed"""
+    def __init__(self, batch) -> None:
+        self._batch = batch
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def done(self) -> bool:
+        return self._done
+
+    def _set(self, value):
+        self._done = True
+        if isinstance(value, Exception):
+            self._error = value
+        else:
+            self._value = value
+
+    def result(self):
+        if not self._done:
+            self._batch.execute()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class RedisBatch:
+    """
+    Commands called on the batch are buffered and sent in one pipeline (one round trip, no transaction);
+    each command returns a RedisFuture. The batch is sent when the with-block exits, when execute() is called
+    or when the result of one of its futures is needed.
+
+        with ctx.redis.batch() as batch:
+            views = batch.incr('views:%d' % article_id)
+            likes = batch.get('likes:%d' % article_id)
+        return {'views': views.result(), 'likes': likes.result()}
+    """
+    def __init__(self, client) -> None:
+        self._client = client
+        self._pipe = None
+        self._futures = []
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(Pipeline, name, None)):
+            raise AttributeError(name)
+
+        def _1_command(*args, **kwargs):
+            if self._pipe is None:
+                self._pipe = self._client.pipeline(transaction=False)
+            getattr(self._pipe, name)(*args, **kwargs)
+            future = RedisFuture(self)
+            self._futures.append(future)
+            return future
+
+        return _1_command
+
+    def execute(self):
+        pipe, futures = self._pipe, self._futures
+        self._pipe, self._futures = None, []
+        if pipe is None:
+            return
+        for future, value in zip(futures, pipe.execute(raise_on_error=False)):
+            future._set(value)
+
+    def discard(self):
+        if self._pipe is not None:
+            self._pipe.reset()
+        self._pipe, self._futures = None, []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.discard()
+
+
+class _CountingPipeline(Pipeline):
+    def __init__(self, client, *args) -> None:
+        super().__init__(*args)
+        self._lessweb_client = client
+
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            self._lessweb_client.round_trips += 1
+            self._lessweb_client.commands += len(self.command_stack)
+        return super().execute(raise_on_error)
+
+
+class LesswebRedis(Redis):
+    """
+    Redis client of a request (ctx.redis). Besides the usual commands:
+        batch(): RedisBatch sending independent commands in one round trip
+        mget_models(keys, ModelClass) / mset_models({key: model}, ex=None): lessweb Models stored as JSON
+        stats(): commands and round trips issued by this client
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.commands: int = 0
+        self.round_trips: int = 0
+
+    def execute_command(self, *args, **options):
+        self.commands += 1
+        self.round_trips += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return _CountingPipeline(self, self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    def batch(self) -> RedisBatch:
+        return RedisBatch(self)
+
+    def mget_models(self, keys, ModelClass):
+        """-> [ModelClass instance or None] in the order of keys, with one MGET"""
+        keys = list(keys)
+        if not keys:
+            return []
+        ret = []
+        for raw in self.mget(keys):
+            if raw is None:
+                ret.append(None)
+            else:
+                model = ModelClass()
+                model.setall(**json.loads(raw))
+                ret.append(model)
+        return ret
+
+    def mset_models(self, mapping, ex=None):
+        """store {key: Model or jsonable} as JSON in one round trip; ex: expire seconds"""
+        from ..application import _make_default_json_encoders
+        encoders = _make_default_json_encoders(())
+        with self.batch() as batch:
+            for key, model in mapping.items():
+                batch.set(key, json_dumps(model, encoders), ex=ex)
+
+    def stats(self):
+        return Storage(commands=self.commands, round_trips=self.round_trips)
+
+
 class RedisCtx(Context):
-    redis: Redis
+    redis: LesswebRedis
+
 
+def init(host='localhost', port=6379, db=0, *, url=None, unix_socket_path=None, password=None,
+         max_connections=None, blocking=False, blocking_timeout=20, socket_timeout=None,
+         socket_connect_timeout=None, health_check_interval=0, retry_on_timeout=False, **connection_kwargs):
+    """
+    url: e.g. 'redis://:password@host:6379/0', 'rediss://host' or 'unix:///run/redis.sock?db=0'
+        (instead of host, port, db, unix_socket_path and password)
+    max_connections: upper bound of connections in the pool (None: the redis-py default, 100 in redis-py 8,
+        unbounded in older versions; 50 with blocking=True)
+    blocking: when max_connections connections are in use, wait up to blocking_timeout seconds for one
+        (BlockingConnectionPool) instead of failing at once with ConnectionError('Too many connections')
+    socket_timeout, socket_connect_timeout: seconds
+    health_check_interval: PING connections idle for more than this many seconds before using them (0: never)
+    Statistics of the pool are available from pool_stats().
+    """
+    assert max_connections is None or max_connections >= 1, \
+        'max_connections:[{}] should be >= 1'.format(max_connections)
+    options = dict(socket_timeout=socket_timeout, health_check_interval=health_check_interval,
+                   retry_on_timeout=retry_on_timeout, **connection_kwargs)
+    if socket_connect_timeout is not None:
+        options['socket_connect_timeout'] = socket_connect_timeout
+    if blocking:
+        pool_class = LesswebBlockingConnectionPool
+        options.update(max_connections=max_connections or 50, timeout=blocking_timeout)
+    else:
+        pool_class = LesswebConnectionPool
+        options.update(max_connections=max_connections)
 
-def init(host, port, db=0):
-    global_data.redis_pool = ConnectionPool(host=host, port=port, db=db)
+    if url is not None:
+        global_data.redis_pool = pool_class.from_url(url, **options)
+    elif unix_socket_path is not None:
+        global_data.redis_pool = pool_class(connection_class=UnixDomainSocketConnection, path=unix_socket_path,
+                                            db=db, password=password, **options)
+    else:
+        global_data.redis_pool = pool_class(host=host, port=port, db=db, password=password, **options)
 
 
 def processor(ctx: RedisCtx):
+    """ctx.redis takes a connection from the pool only while a command (or a batch) is executed"""
     ctx.redis = session()
     return ctx()
 
 
 def session():
-    return Redis(connection_pool=global_data.redis_pool)
+    return LesswebRedis(connection_pool=global_data.redis_pool)
+
+
+def pool_stats():
+    """
+    Live statistics of the connection pool:
+        pool, max_connections, in_use, idle, checkouts, exhausted, wait_total, wait_max (seconds)
+    """
+    pool = global_data.redis_pool
+    if not isinstance(pool, _InstrumentedPool):
+        return Storage(pool=type(pool).__name__)
+    with pool.lessweb_lock:
+        return Storage(
+            pool='BlockingConnectionPool' if isinstance(pool, BlockingConnectionPool) else 'ConnectionPool',
+            max_connections=pool.max_connections, in_use=len(pool.lessweb_checked_out), idle=pool.lessweb_idle(),
+            checkouts=pool.lessweb_checkouts, exhausted=pool.lessweb_exhausted,
+            wait_total=pool.lessweb_wait_total, wait_max=pool.lessweb_wait_max,
+        )
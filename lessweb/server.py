@@ -0,0 +1,161 @@
+"""
+aiohttp bridge used by Application.run()
+(from lessweb)
+
+Requirements:
+    aiohttp, aiohttp_wsgi
+"""
+import asyncio
+import time
+
+from aiohttp import web
+from aiohttp.web_response import CIMultiDict
+from aiohttp_wsgi import WSGIHandler
+
+from lessweb.webapi import HttpError
+
+
+__all__ = [
+    "StreamingWSGIHandler",
+]
+
+
+def _start_application(application, environ):
+    """Run in executor: call the WSGI app; materialize the body unless it should be streamed"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        status_code, reason = status.split(None, 1)
+        response.update(status=int(status_code), reason=reason, headers=headers)
+        return None
+
+    iterable = application(environ, start_response)
+    if getattr(iterable, 'generator', None) is not None or getattr(iterable, 'aiter', None) is not None:
+        return response, None, iterable
+    try:
+        chunks = b''.join(iterable)
+    except:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+        raise
+    return response, chunks, iterable
+
+
+def _serve_application(application, environ, request, loop):
+    """
+    Run in executor: call the WSGI app. A generator response is sent from this thread, writing each chunk
+    on the event loop, and closed here: it is read on one thread (e.g. it may hold a database session).
+    -> the sent web.StreamResponse, or (response, chunks, iterable) to be sent on the event loop
+    """
+    response, chunks, iterable = _start_application(application, environ)
+    if chunks is not None or getattr(iterable, 'aiter', None) is not None:
+        return response, chunks, iterable
+
+    def _1_on_loop(coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    try:
+        resp = web.StreamResponse(status=response['status'], reason=response['reason'],
+                                  headers=CIMultiDict(response['headers']))
+        _1_on_loop(resp.prepare(request))
+        try:
+            for chunk in iterable:
+                _1_on_loop(resp.write(chunk))
+            _1_on_loop(resp.write_eof())
+        except ConnectionResetError:  # client disconnected
+            pass
+        return resp
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+class StreamingWSGIHandler(WSGIHandler):
+    """
+    WSGIHandler that
+        * streams generator responses chunk by chunk (aiohttp_wsgi buffers the whole body), each one read
+          and closed on a single executor thread, and serves lessweb async bodies (e.g. EventStream over
+          an async generator) on the event loop;
+        * closes the response iterable after it has been sent, which runs the tasks from ctx.defer();
+        * records request['lessweb.received_at'] and applies an AsyncConcurrencyLimiter to the executor.
+    """
+    def __init__(self, application, *, limiter=None, **kwargs) -> None:
+        super().__init__(application, **kwargs)
+        self.limiter = limiter
+
+    def _get_environ(self, request, body, content_length):
+        environ = super()._get_environ(request, body, content_length)
+        environ['lessweb.async_body'] = True
+        environ['lessweb.loop'] = asyncio.get_event_loop()  # async dealers run on this loop
+        return environ
+
+    async def _read_body(self, request):
+        if request.content_length is not None and request.content_length > self._max_request_body_size:
+            raise web.HTTPRequestEntityTooLarge(
+                max_size=self._max_request_body_size, actual_size=request.content_length)
+        body = self._body_io()
+        content_length = 0
+        while True:
+            block = await request.content.readany()
+            if not block:
+                break
+            content_length += len(block)
+            if content_length > self._max_request_body_size:
+                body.close()
+                raise web.HTTPRequestEntityTooLarge(
+                    max_size=self._max_request_body_size, actual_size=content_length)
+            body.write(block)
+        body.seek(0)
+        return body, content_length
+
+    async def handle_request(self, request):
+        request['lessweb.received_at'] = time.monotonic()
+        loop = asyncio.get_event_loop()
+        body, content_length = await self._read_body(request)
+        try:
+            environ = self._get_environ(request, body, content_length)
+            if self.limiter is None:
+                result = await loop.run_in_executor(
+                    self._executor, _serve_application, self._application, environ, request, loop)
+            else:
+                try:
+                    await self.limiter.acquire()
+                except HttpError as e:
+                    return web.Response(status=e.status_code, reason=e.reason, text=e.text, headers=dict(e.headers))
+                try:  # a streamed response holds its thread until it has been sent
+                    result = await loop.run_in_executor(
+                        self._executor, _serve_application, self._application, environ, request, loop)
+                finally:
+                    await self.limiter.release()
+            if isinstance(result, web.StreamResponse):
+                return result
+
+            response, chunks, iterable = result
+            try:
+                if chunks is not None:
+                    resp = web.Response(status=response['status'], reason=response['reason'],
+                                        headers=CIMultiDict(response['headers']), body=chunks)
+                    await resp.prepare(request)
+                    await resp.write_eof()
+                    return resp
+                resp = web.StreamResponse(status=response['status'], reason=response['reason'],
+                                          headers=CIMultiDict(response['headers']))
+                await resp.prepare(request)
+                try:
+                    aiter = iterable.aiter
+                    try:
+                        async for chunk in aiter:
+                            await resp.write(chunk)
+                    finally:
+                        await aiter.aclose()
+                    await resp.write_eof()
+                except ConnectionResetError:  # client disconnected
+                    pass
+                return resp
+            finally:
+                if hasattr(iterable, 'close'):
+                    await loop.run_in_executor(self._executor, iterable.close)
+        finally:
+            body.close()
+
+    __call__ = handle_request
@@ -0,0 +1,114 @@
+"""
+Single-flight request coalescing
+(from lessweb)
+"""
+from concurrent.futures import Future, TimeoutError
+import threading
+from urllib.parse import parse_qsl
+
+from lessweb.storage import Storage
+
+
+__all__ = [
+    "SingleFlight", "RequestCoalescer",
+]
+
+
+class SingleFlight:
+    """
+    同一个key同时只执行一次fn，其余调用者等待并共享它的结果(或异常)，
+    等待超过timeout秒的调用者退回自己执行fn。
+
+        >>> sf = SingleFlight()
+        >>> sf.do('k', lambda: 42)
+        42
+        >>> sf.stats()
+        <Storage {'executions': 1, 'shared': 0, 'fallbacks': 0, 'inflight': 0}>
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls = {}  # key => concurrent.futures.Future
+        self.executions: int = 0
+        self.shared: int = 0  # 直接共享了leader结果的调用次数
+        self.fallbacks: int = 0  # 等待超时后自己执行的次数
+
+    def _join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            self.executions += 1
+            return future, True
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, timeout=None):
+        future, leader = self._join(key)
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(key, future, error=e)
+                raise
+            self._finish(key, future, result=result)
+            return result
+        try:
+            result = future.result(timeout)
+        except TimeoutError:
+            self._count('fallbacks')
+            return fn()
+        self._count('shared')
+        return result
+
+    def stats(self):
+        return Storage(executions=self.executions, shared=self.shared, fallbacks=self.fallbacks,
+                       inflight=len(self._calls))
+
+
+CREDENTIAL_HEADERS = ('Authorization', 'Cookie')
+
+
+class RequestCoalescer(SingleFlight):
+    """
+    按method、path、选定的query参数和vary头合并同时到达的相同请求。
+    等待者直接拿到leader的响应，不会执行自己的interceptor(鉴权、限流等)，
+    所以vary默认是Authorization和Cookie，带不同凭证的请求不会合并；
+    给出vary时以它为准，响应与用户有关时要把凭证头也列进去。
+
+        >>> from lessweb.context import Context
+        >>> ctx = Context()
+        >>> ctx.method, ctx.path, ctx.query = 'GET', '/items', 'page=2&_t=1&page=3'
+        >>> ctx.env = {'HTTP_ACCEPT_LANGUAGE': 'zh'}
+        >>> RequestCoalescer(query=['page'], vary=['Accept-Language']).key(ctx)
+        ('GET', '/items', (('page', '2'), ('page', '3')), ('zh',))
+        >>> RequestCoalescer().key(ctx)
+        ('GET', '/items', 'page=2&_t=1&page=3', (None, None))
+    """
+    def __init__(self, query=None, vary=CREDENTIAL_HEADERS, timeout=10) -> None:
+        super().__init__()
+        if isinstance(query, str):
+            query = query.replace(',', ' ').split()
+        if isinstance(vary, str):
+            vary = vary.replace(',', ' ').split()
+        self.query = None if query is None else frozenset(query)  # None表示使用完整的query
+        self.vary = tuple(vary)
+        self.timeout = timeout
+
+    def key(self, ctx):
+        if self.query is None:
+            query = ctx.query or ''
+        else:
+            query = tuple(sorted((k, v) for k, v in parse_qsl(ctx.query or '', keep_blank_values=True)
+                                 if k in self.query))
+        return ctx.method, ctx.path, query, tuple(ctx.get_header(h) for h in self.vary)
@@ -0,0 +1,148 @@
+"""
+Server-Sent Events
+(from lessweb)
+"""
+import asyncio
+import time
+
+from lessweb.utils import json_dumps
+
+
+__all__ = [
+    "ServerSentEvent", "EventStream",
+]
+
+
+class ServerSentEvent:
+    """
+    One event of an EventStream. data is sent as-is if it is str, otherwise as json.
+
+        >>> ServerSentEvent('a\\nb', event='status', id=3).format(str)
+        'event: status\\nid: 3\\ndata: a\\ndata: b\\n\\n'
+    """
+    def __init__(self, data, event=None, id=None, retry=None) -> None:
+        self.data = data
+        self.event = event
+        self.id = id
+        self.retry = retry
+
+    def format(self, encode) -> str:
+        data = self.data if isinstance(self.data, str) else encode(self.data)
+        lines = []
+        if self.event is not None:
+            lines.append('event: %s' % self.event)
+        if self.id is not None:
+            lines.append('id: %s' % self.id)
+        if self.retry is not None:
+            lines.append('retry: %d' % self.retry)
+        lines.extend('data: ' + line for line in data.split('\n'))
+        return '\n'.join(lines) + '\n\n'
+
+
+class EventStream:
+    """
+    Response of Server-Sent Events (text/event-stream).
+
+    source can be
+        * a generator (sync mode): the WSGI thread is held while streaming, like other generator responses.
+          Yield None when idle so that heartbeats are sent and disconnected clients are detected.
+        * an async generator (async mode): under Application.run() the dealer's thread is released as soon
+          as it returns, and the stream is served on the event loop without holding a thread.
+    Items can be ServerSentEvent or any data (wrapped as ServerSentEvent(data)).
+    A comment line is sent when no event was sent for `heartbeat` seconds.
+
+    Example:
+
+        def status(ctx: Context, job: int):
+            async def events():
+                while True:
+                    yield ServerSentEvent(await fetch_status(job), event='status')
+                    await asyncio.sleep(1)
+            return EventStream(events(), heartbeat=15)
+
+        >>> stream = EventStream(iter(['a', None, {'b': 1}]), heartbeat=0)
+        >>> list(stream.iter_text(json_dumps))
+        [':\\n\\n', 'data: a\\n\\n', ':\\n\\n', 'data: {"b": 1}\\n\\n']
+    """
+    headers = (
+        ('Content-Type', 'text/event-stream; charset=utf-8'),
+        ('Cache-Control', 'no-cache'),
+        ('X-Accel-Buffering', 'no'),  # nginx: do not buffer
+    )
+
+    def __init__(self, source, heartbeat=15, retry=None) -> None:
+        self.source = source
+        self.heartbeat: float = heartbeat
+        self.retry = retry  # reconnection time (ms) for the client
+
+    @property
+    def is_async(self) -> bool:
+        return hasattr(self.source, '__aiter__')
+
+    def _preamble(self) -> str:
+        # sent at once so that the client receives the headers before the first event
+        return 'retry: %d\n\n' % self.retry if self.retry is not None else ':\n\n'
+
+    def _format(self, item, encode) -> str:
+        if not isinstance(item, ServerSentEvent):
+            item = ServerSentEvent(item)
+        return item.format(encode)
+
+    def iter_text(self, encode=json_dumps):
+        yield self._preamble()
+        last_sent = time.monotonic()
+        for item in self.source:
+            if item is None:
+                if time.monotonic() - last_sent < self.heartbeat:
+                    continue
+                yield ':\n\n'
+            else:
+                yield self._format(item, encode)
+            last_sent = time.monotonic()
+
+    async def aiter_text(self, encode=json_dumps):
+        yield self._preamble()
+        iterator = self.source.__aiter__()
+        pending = None
+        last_sent = time.monotonic()
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                timeout = max(0.0, last_sent + self.heartbeat - time.monotonic())
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    yield ':\n\n'
+                    last_sent = time.monotonic()
+                    continue
+                task, pending = pending, None
+                try:
+                    item = task.result()
+                except StopAsyncIteration:
+                    return
+                if item is not None:
+                    yield self._format(item, encode)
+                    last_sent = time.monotonic()
+        finally:
+            if pending is not None:
+                pending.cancel()
+                try:
+                    await pending
+                except BaseException:
+                    pass
+            if hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+
+    def iter_text_blocking(self, encode=json_dumps):
+        """Drive an async source from a WSGI thread (used when not served by Application.run())"""
+        loop = asyncio.new_event_loop()
+        agen = self.aiter_text(encode)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(agen.aclose())
+            loop.close()
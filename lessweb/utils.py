@@ -1,5 +1,6 @@
 from contextlib import contextmanager
 import json
+import os
 from pathlib import Path
 import pickle
 import re
@@ -160,17 +161,47 @@ class StaticDict(dict):
 
 
 @contextmanager
-def static_dict(path):
+def static_dict(path, backend=None, **options):
+    """
+    with static_dict('data/table.json') as data: ...
+
+    backend:
+        None: the whole JSON (*.json) or pickle file is loaded on entry, and rewritten on exit if data was
+            modified (to a temporary file renamed over the old one, so that readers never see a partial file)
+        'log': lessweb.logdict.LogDict, for large tables: keys are indexed on entry and values unpickled
+            on first access; on exit the modified items are appended to the file, which is compacted from
+            time to time (options: compact_ratio, compact_min_bytes)
+    The changes are not saved if the with-block raises.
+    """
+    if backend == 'log':
+        from .logdict import LogDict
+        with LogDict.open(path, **options) as data:
+            yield data
+        return
+    assert backend is None, "backend:[{}] should be None or 'log'".format(backend)
+
     is_json = path.lower().endswith('.json')
     path = Path(path)
-    if is_json:
-        data = StaticDict(json.load(path.open('r'))) if path.exists() else StaticDict()
+    if not path.exists():
+        data = StaticDict()
+    elif is_json:
+        with path.open('r') as f:
+            data = StaticDict(json.load(f))
     else:
-        data = StaticDict(pickle.load(path.open('rb'))) if path.exists() else StaticDict()
+        with path.open('rb') as f:
+            data = StaticDict(pickle.load(f))
     yield data
     if data.touched:
         path.parent.mkdir(parents=True, exist_ok=True)
-        if is_json:
-            json.dump(data, path.open('w'))
-        else:
-            pickle.dump(data, path.open('wb'))
+        tmp_path = path.with_name('%s.%d.tmp' % (path.name, os.getpid()))
+        try:
+            if is_json:
+                with tmp_path.open('w') as f:
+                    json.dump(data, f)
+            else:
+                with tmp_path.open('wb') as f:
+                    pickle.dump(data, f)
+            os.replace(str(tmp_path), str(path))
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
@@ -42,8 +42,11 @@ status_table = {
     412: 'Precondition Failed',
     415: 'Unsupported Media Type',
     422: 'Unprocessable Entity',
+    429: 'Too Many Requests',
     451: 'Unavailable For Legal Reasons',
     500: 'Internal Server Error',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout',
 }
 
 
@@ -168,11 +171,37 @@ class UnavailableForLegalReasons(_TextHttpError):
         super().__init__(status_code=451, text=text, headers=headers)
 
 
+class UnprocessableEntity(_TextHttpError):
+    def __init__(self, text='unprocessable entity', headers=None):
+        super().__init__(status_code=422, text=text, headers=headers)
+
+
+class TooManyRequests(_TextHttpError):
+    def __init__(self, text='too many requests', retry_after=None, headers=None):
+        headers = headers or []
+        if retry_after is not None:
+            set_header(headers, 'Retry-After', str(retry_after), setdefault=True)
+        super().__init__(status_code=429, text=text, headers=headers)
+
+
 class InternalError(_TextHttpError):
     def __init__(self, text='internal server error', headers=None):
         super().__init__(status_code=500, text=text, headers=headers)
 
 
+class ServiceUnavailable(_TextHttpError):
+    def __init__(self, text='service unavailable', retry_after=None, headers=None):
+        headers = headers or []
+        if retry_after is not None:
+            set_header(headers, 'Retry-After', str(retry_after), setdefault=True)
+        super().__init__(status_code=503, text=text, headers=headers)
+
+
+class GatewayTimeout(_TextHttpError):
+    def __init__(self, text='gateway timeout', headers=None):
+        super().__init__(status_code=504, text=text, headers=headers)
+
+
 def set_header(headers, key, value, multiple=False, setdefault=False):
     assert isinstance(key, str) and isinstance(value, str)
     if '\n' in key or '\r' in key or '\n' in value or '\r' in value:
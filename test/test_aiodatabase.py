@@ -0,0 +1,73 @@
+import asyncio
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import select
+
+from lessweb import Application
+from lessweb.plugin import aiodatabase
+from lessweb.plugin.aiodatabase import AsyncDatabaseCtx
+from lessweb.webapi import BadParamError
+from test.test_database import DbItem
+
+
+async def _add(ctx: AsyncDatabaseCtx, name):
+    ctx.db.add(DbItem(name=name))
+    if name == 'bad':
+        raise BadParamError(query='name', error='bad name')
+    await ctx.db.commit()
+    return {'added': name}
+
+
+async def _list(ctx: AsyncDatabaseCtx, pageNo: int = 1):
+    return await aiodatabase.dumppage(ctx.db, select(DbItem).order_by(DbItem.id), pageNo, 2)
+
+
+def _sync_count(ctx: AsyncDatabaseCtx):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return {'sync': True}  # not blocking the event loop
+    return {'sync': False}
+
+
+class TestAioDatabase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        aiodatabase.init(dburi='sqlite+aiosqlite:///' + os.path.join(self.tmpdir.name, 'test.db'), echo=False)
+        asyncio.run(aiodatabase.create_all(DbItem))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_processor(self):
+        app = Application()
+        app.add_interceptor('.*', '*', aiodatabase.processor)
+        app.add_post_mapping('/add', _add)
+        app.add_get_mapping('/list', _list)
+        app.add_get_mapping('/sync', _sync_count)
+        for name in 'abc':
+            with app.test_post('/add', {'name': name}) as ret:
+                self.assertEqual(ret, {'added': name})
+        with app.test_post('/add', {'name': 'bad'}, status_code=400):
+            pass
+        with app.test_get('/list', {'pageNo': 2}) as ret:
+            self.assertEqual((ret['totalNum'], ret['list']), (3, [{'id': 3, 'name': 'c'}]))
+        with app.test_get('/sync') as ret:
+            self.assertEqual(ret, {'sync': True})
+
+    def test_dump(self):
+        async def run():
+            async with aiodatabase.make_session() as session:
+                session.add_all([DbItem(name='n%d' % i) for i in range(5)])
+                await session.commit()
+                stmt = select(DbItem)
+                page1 = await aiodatabase.dumpcursor(session, stmt, size=3, order_by=DbItem.id)
+                page2 = await aiodatabase.dumpcursor(session, stmt, page1.nextCursor, size=3, order_by=DbItem.id)
+                self.assertEqual([x['id'] for x in page1.list + page2.list], [1, 2, 3, 4, 5])
+                self.assertIsNone(page2.nextCursor)
+                rows = await aiodatabase.dumprows(session, stmt.order_by(DbItem.id))
+                self.assertEqual(rows, await aiodatabase.dumpall(session, stmt.order_by(DbItem.id)))
+                self.assertEqual(await aiodatabase.dumpone(session, stmt.where(DbItem.id == 9)), None)
+        asyncio.run(run())
@@ -0,0 +1,77 @@
+import os
+import sys
+from unittest import TestCase
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmark'))
+
+import bench_gate
+
+
+def _run(calibration, **ops):
+    """a bench_micro.run() result whose benchmark `name` has the samples ops[name]"""
+    return {
+        'environment': {}, 'calibration': calibration,
+        'results': {name: {'ops_per_sec': sorted(samples)[len(samples) // 2], 'samples': samples,
+                           'peak_bytes': 100, 'retained_blocks': 0.0} for name, samples in ops.items()},
+    }
+
+
+class TestBenchGate(TestCase):
+    def status(self, baseline, current, threshold=0.15):
+        return {row['name']: row['status'] for row in bench_gate.compare(baseline, current, threshold)}
+
+    def test_slowdown_flagged(self):
+        baseline = _run(1000, dispatch=[1000, 1010, 990, 1005, 995])
+        self.assertEqual(self.status(baseline, _run(1000, dispatch=[800, 805, 795, 810, 790])),
+                         {'dispatch': 'REGRESSED'})
+        self.assertEqual(self.status(baseline, _run(1000, dispatch=[900, 905, 895, 910, 890])),
+                         {'dispatch': 'ok'})
+        # a noisy current run does not widen the threshold
+        self.assertEqual(self.status(baseline, _run(1000, dispatch=[400, 1200, 800, 600, 1000])),
+                         {'dispatch': 'REGRESSED'})
+        # on a slower machine (half the calibration) the same slowdown is still found
+        self.assertEqual(self.status(baseline, _run(500, dispatch=[400, 402, 398, 405, 395])),
+                         {'dispatch': 'REGRESSED'})
+
+    def test_noisy_baseline_capped(self):
+        baseline = _run(1000, dispatch=[600, 1400, 1000, 700, 1300])
+        row, = bench_gate.compare(baseline, _run(1000, dispatch=[650, 640, 660, 655, 645]), 0.15)
+        self.assertAlmostEqual(row['allowed'], 0.30)
+        self.assertEqual(row['status'], 'REGRESSED')
+
+    def test_merge_normalizes_each_run(self):
+        fast = _run(1000, dispatch=[1000, 1010, 990])
+        slow = _run(500, dispatch=[500, 505, 495])  # the same code while the machine was twice slower
+        merged = bench_gate.merge([fast, slow])
+        self.assertEqual(merged['calibration'], 750)
+        samples = merged['results']['dispatch']['samples']
+        self.assertEqual(bench_gate.spread(samples), bench_gate.spread([1000, 1010, 990]))
+        current = _run(750, dispatch=[600, 606, 594])  # 20% slower than the merged baseline
+        self.assertEqual(self.status(merged, current), {'dispatch': 'REGRESSED'})
+
+    def test_recheck(self):
+        baseline = _run(1000, dispatch=[1000, 1010, 990], json_list=[500, 505, 495])
+        current = _run(1000, dispatch=[500, 505, 495], json_list=[400, 402, 398])
+        rows = bench_gate.compare(baseline, current, 0.15)
+        # dispatch was slowed down by another process once, json_list is slower every time
+        again = {'dispatch': iter([[1000, 1005, 995], [500, 505, 495], [990, 1000, 1010], [1005, 1000, 995]]),
+                 'json_list': iter([[400, 405, 395], [410, 400, 405], [500, 505, 495], [395, 400, 405]])}
+        calls = []
+
+        def remeasure(name):
+            calls.append(name)
+            return _run(1000, **{name: next(again[name])})
+
+        rows = bench_gate.recheck(rows, baseline, remeasure, 4, 0.15)
+        self.assertEqual({row['name']: row['status'] for row in rows}, {'dispatch': 'ok', 'json_list': 'REGRESSED'})
+        self.assertEqual(calls, ['dispatch'] * 4 + ['json_list'] * 4)
+        self.assertEqual(bench_gate.recheck(bench_gate.compare(baseline, baseline, 0.15), baseline,
+                                            remeasure, 4, 0.15)[0]['status'], 'ok')  # ok rows are not measured
+        self.assertEqual(len(calls), 8)
+
+    def test_recheck_unstable(self):
+        baseline = _run(1000, dispatch=[1000, 1010, 990])
+        rows = bench_gate.compare(baseline, _run(1000, dispatch=[660, 665, 655]), 0.15)
+        again = iter([[1120, 1125, 1115], [730, 735, 725], [890, 895, 885], [780, 785, 775]])
+        rows = bench_gate.recheck(rows, baseline, lambda name: _run(1000, dispatch=next(again)), 4, 0.15)
+        self.assertEqual(rows[0]['status'], 'unstable')
@@ -0,0 +1,116 @@
+import threading
+import time
+from unittest import TestCase
+
+import fakeredis
+
+from lessweb import Application, Context
+from lessweb.plugin import redis as redis_plugin
+from lessweb.plugin.cache import TwoTierCache, response_cache
+
+
+class TestTwoTierCache(TestCase):
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        redis_plugin.init(connection_class=fakeredis.FakeConnection, server=self.server)
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.stop_listener()
+
+    def make_cache(self, **kwargs):
+        cache = TwoTierCache('test', **kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_invalidation(self):
+        a, b = self.make_cache(), self.make_cache()
+        a.set('k', {'v': 1})
+        self.assertEqual(b.get('k'), {'v': 1})  # from redis
+        self.assertEqual(b.get('k'), {'v': 1})  # local
+        self.assertEqual((b.stats().redis_hits, b.stats().local_hits), (1, 1))
+        time.sleep(0.1)  # b's listener subscribes on first use
+        a.set('k', {'v': 2})
+        self.wait_for(lambda: b.stats().invalidations_received == 1)
+        self.assertEqual(b.get('k'), {'v': 2})
+        a.delete('k')
+        self.wait_for(lambda: b.stats().invalidations_received == 2)
+        self.assertEqual(b.get('k', 'missing'), 'missing')
+
+    def test_stampede(self):
+        cache = self.make_cache(invalidation=False)
+        calls = []
+
+        def _load():
+            calls.append(1)
+            time.sleep(0.1)
+            return [1, 2]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_set('s', _load)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual((len(calls), results), (1, [[1, 2]] * 5))
+        other = self.make_cache(invalidation=False)
+        self.assertEqual(other.get_or_set('s', _load), [1, 2])
+        self.assertEqual(len(calls), 1)
+
+    def test_response_cache(self):
+        calls = []
+
+        def _categories(ctx: Context, lang='en'):
+            calls.append(lang)
+            ctx.set_header('X-Lang', lang)
+            return {'lang': lang}
+
+        app = Application()
+        app.add_interceptor('.*', 'GET', response_cache(self.make_cache(invalidation=False), ttl=60))
+        app.add_get_mapping('/categories', _categories)
+        for _ in range(2):
+            resp = app.request('/categories?lang=zh')
+            self.assertEqual((resp.data, resp.headers['X-Lang']), (b'{"lang": "zh"}', 'zh'))
+        with app.test_get('/categories') as ret:
+            self.assertEqual(ret, {'lang': 'en'})
+        self.assertEqual(calls, ['zh', 'en'])
+
+    def test_response_cache_binary(self):
+        png = b'\x89PNG\r\n\x1a\n\xff\xfe' + bytes(range(256))
+        calls = []
+
+        def _logo(ctx: Context):
+            calls.append(1)
+            ctx.set_header('Content-Type', 'image/png')
+            return png
+
+        app = Application()
+        app.add_interceptor('.*', 'GET', response_cache(self.make_cache(invalidation=False), ttl=60))
+        app.add_get_mapping('/logo.png', _logo)
+        for _ in range(2):
+            resp = app.request('/logo.png')
+            self.assertEqual((resp.status_code, resp.data, resp.headers['Content-Type']), (200, png, 'image/png'))
+        self.assertEqual(calls, [1])
+
+    def test_response_cache_async(self):
+        calls = []
+
+        async def _categories(ctx: Context):
+            calls.append(1)
+            return {'calls': len(calls)}
+
+        app = Application()
+        app.add_interceptor('.*', 'GET', response_cache(self.make_cache(invalidation=False), ttl=60))
+        app.add_get_mapping('/categories', _categories)
+        for _ in range(2):
+            with app.test_get('/categories') as ret:
+                self.assertEqual(ret, {'calls': 1})
+        self.assertEqual(calls, [1])
@@ -0,0 +1,424 @@
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.pool import QueuePool
+
+from lessweb.plugin import database
+from lessweb.plugin.database import DbModel
+
+
+class DbItem(DbModel):
+    __tablename__ = 'item'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+
+    def dump(self):
+        return {'id': self.id, 'name': self.name}
+
+
+class DbLogEvent(DbModel):
+    __tablename__ = 'log_event'
+    id = Column('event_id', Integer, primary_key=True)
+    createdAt = Column('created_at', DateTime)
+
+    def dump(self):
+        return {'id': self.id, 'createdAt': self.createdAt}
+
+
+class DatabaseTestCase(TestCase):
+    init_options = {}
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dburi = 'sqlite:///' + os.path.join(self.tmpdir.name, 'test.db')
+        database.init(dburi=self.dburi, echo=False, **self.init_options)
+        database.create_all(DbItem)
+
+    def tearDown(self):
+        database._count_cache.clear()
+        database.global_data.db_engine.dispose()
+        self.tmpdir.cleanup()
+
+
+class TestPool(DatabaseTestCase):
+    init_options = dict(poolclass=QueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+
+    def test_pool_stats(self):
+        from sqlalchemy.exc import TimeoutError
+        with database.make_session() as session:
+            session.add(DbItem(name='a'))
+            session.flush()
+            self.assertEqual(database.pool_stats().checked_out, 1)
+            t = threading.Thread(target=lambda: self.assertRaises(TimeoutError, database.global_data.db_engine.connect))
+            t.start()
+            t.join()
+            session.commit()
+        stats = database.pool_stats()
+        self.assertEqual((stats.pool, stats.size, stats.checked_out), ('QueuePool', 1, 0))
+        self.assertEqual(stats.timeouts, 1)
+        self.assertGreaterEqual(stats.checkouts, 2)
+        self.assertEqual(sum(stats.wait_histogram.values()), stats.checkouts)
+
+    def test_invalid_options(self):
+        with self.assertRaises(AssertionError):
+            database.init(dburi=self.dburi, pool_size=-1)
+
+
+class TestProcessor(DatabaseTestCase):
+    def test_lazy_session(self):
+        from lessweb import Application
+        from lessweb.plugin.database import DatabaseCtx
+
+        def _health(ctx: DatabaseCtx):
+            return {'ok': True}
+
+        def _add(ctx: DatabaseCtx, name):
+            ctx.db.add(DbItem(name=name))
+            ctx.db.commit()
+            return {'count': ctx.db.query(DbItem).count()}
+
+        app = Application()
+        app.add_interceptor('.*', '*', database.processor)
+        app.add_get_mapping('/health', _health)
+        app.add_post_mapping('/add', _add)
+        checkouts = database.pool_stats().checkouts
+        with app.test_get('/health') as ret:
+            self.assertEqual(ret, {'ok': True})
+        self.assertEqual(database.pool_stats().checkouts, checkouts)
+        with app.test_post('/add', {'name': 'a'}) as ret:
+            self.assertEqual(ret, {'count': 1})
+        self.assertGreater(database.pool_stats().checkouts, checkouts)
+
+    def test_async_dealer(self):
+        from lessweb import Application
+        from lessweb.plugin.database import DatabaseCtx
+
+        sessions = []
+
+        async def _add(ctx: DatabaseCtx, name):
+            sessions.append(ctx.db)
+            ctx.db.add(DbItem(name=name))
+            ctx.db.commit()
+            return {'count': ctx.db.query(DbItem).count()}
+
+        app = Application()
+        app.add_interceptor('.*', '*', database.processor)
+        app.add_post_mapping('/add', _add)
+        for i in range(3):
+            with app.test_post('/add', {'name': 'a'}) as ret:
+                self.assertEqual(ret, {'count': i + 1})
+        self.assertEqual(database.pool_stats().in_use, 0)
+        self.assertFalse(any(db._session.in_transaction() for db in sessions))  # closed after the coroutine ran
+
+    def test_overlapping_async_dealers(self):
+        import asyncio
+        from lessweb import Application
+        from lessweb.plugin.database import DatabaseCtx
+
+        sessions, both = [], {}
+
+        async def _add(ctx: DatabaseCtx, name):
+            ctx.db.add(DbItem(name=name))
+            sessions.append(ctx.db._session)
+            event = both.setdefault('event', asyncio.Event())
+            if len(sessions) == 2:
+                event.set()
+            await asyncio.wait_for(event.wait(), 5)  # both requests are inside their transaction
+            ctx.db.commit()
+            return {'ok': True}
+
+        app = Application()
+        app.add_interceptor('.*', '*', database.processor)
+        app.add_post_mapping('/add', _add)
+        statuses = []
+        clients = [threading.Thread(target=lambda name=name: statuses.append(
+            app.request('/add', method='POST', data={'name': name}).status)) for name in ('a', 'b')]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        self.assertEqual(statuses, ['200 OK', '200 OK'])
+        self.assertIsNot(sessions[0], sessions[1])
+        with database.make_session() as session:
+            self.assertEqual(sorted(x.name for x in session.query(DbItem)), ['a', 'b'])
+
+    def test_sql_stats(self):
+        from lessweb import Application
+        from lessweb.plugin.database import DatabaseCtx
+
+        def _names(ctx: DatabaseCtx):
+            ids = [x.id for x in ctx.db.query(DbItem)]
+            names = [ctx.db.query(DbItem).filter(DbItem.id == i).one().name for i in ids]  # N+1
+            return {'names': len(names), 'count': ctx.sql.count, 'repeated': list(ctx.sql.repeated().values())}
+
+        with database.make_session() as session:
+            DbItem.bulk_insert(session, [{'name': 'n%d' % i} for i in range(12)])
+            session.commit()
+        app = Application()
+        app.add_interceptor('.*', '*', database.processor)
+        app.add_get_mapping('/names', _names)
+        with self.assertLogs(level='WARNING') as logs:
+            resp = app.request('/names')
+        self.assertEqual(json.loads(resp.data), {'names': 12, 'count': 13, 'repeated': [12]})
+        self.assertIn('possible N+1 queries', logs.output[0])
+        self.assertRegex(resp.headers['Server-Timing'], r'^db;dur=[0-9.]+;desc="13 queries"$')
+
+
+class TestDump(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        with database.make_session() as session:
+            session.add_all([DbItem(name='n%d' % (i % 3)) for i in range(25)])
+            session.commit()
+
+    def test_dumpcursor(self):
+        from sqlalchemy import desc
+        from lessweb.webapi import BadParamError
+        with database.make_session() as session:
+            query = session.query(DbItem)
+            ids, after = [], None
+            while True:
+                page = query | database.dumpcursor(after=after, size=10, order_by=DbItem.id)
+                ids.extend(x['id'] for x in page.list)
+                after = page.nextCursor
+                if after is None:
+                    break
+            self.assertEqual(ids, list(range(1, 26)))
+
+            order_by = [DbItem.name, desc(DbItem.id)]
+            expected = [x.id for x in query.order_by(*order_by)]
+            page1 = query | database.dumpcursor(size=12, order_by=order_by)
+            page2 = query | database.dumpcursor(after=page1.nextCursor, size=12, order_by=order_by)
+            self.assertEqual([x['id'] for x in page1.list + page2.list], expected[:24])
+            self.assertTrue(page2.jsonize()['hasMore'])
+
+            with self.assertRaises(BadParamError):
+                query | database.dumpcursor(after=page1.nextCursor, size=12, order_by=DbItem.id)
+
+    def test_dumpcursor_attribute_names(self):
+        from datetime import datetime
+        from sqlalchemy import desc
+        database.create_all(DbLogEvent)
+        with database.make_session() as session:
+            session.add_all([DbLogEvent(createdAt=datetime(2020, 1, 1 + i % 3)) for i in range(7)])
+            session.commit()
+            order_by = [desc(DbLogEvent.createdAt), DbLogEvent.id]
+            expected = [x.id for x in session.query(DbLogEvent).order_by(*order_by)]
+            ids, after = [], None
+            while True:
+                page = session.query(DbLogEvent) | database.dumpcursor(after=after, size=3, order_by=order_by)
+                ids.extend(x['id'] for x in page.list)
+                after = page.nextCursor
+                if after is None:
+                    break
+            self.assertEqual(ids, expected)
+
+    def test_dumppage(self):
+        with database.make_session() as session:
+            query = session.query(DbItem).order_by(DbItem.id)
+            page = query | database.dumppage(2, 10)
+            self.assertEqual((page.totalNum, page.totalPage, page.list[0]['id']), (25, 3, 11))
+
+            page = query | database.dumppage(3, 10, count_cap=20)
+            self.assertEqual((page.totalNum, page.totalCapped, page.totalPage, len(page.list)), (20, True, 2, 5))
+            self.assertTrue(page.jsonize()['totalCapped'])
+            page = query | database.dumppage(1, 10, count_cap=30)
+            self.assertEqual((page.totalNum, page.totalCapped), (25, False))
+            self.assertNotIn('totalCapped', page.jsonize())
+
+            page = query | database.dumppage(1, 10, count_concurrently=True)
+            self.assertEqual((page.totalNum, len(page.list)), (25, 10))
+
+            page = query | database.dumppage(1, 10, count_ttl=60)
+            self.assertEqual(page.totalNum, 25)
+            session.add(DbItem(name='new'))
+            session.commit()
+            self.assertEqual((query | database.dumppage(1, 10, count_ttl=60)).totalNum, 25)
+            self.assertEqual((query | database.dumppage(1, 10)).totalNum, 26)
+            filtered = query.filter(DbItem.name == 'n0') | database.dumppage(1, 10, count_ttl=60)
+            self.assertEqual(filtered.totalNum, 9)
+
+    def test_dumpstream(self):
+        from lessweb import Application
+        from lessweb.plugin.database import DatabaseCtx
+
+        def _export(ctx: DatabaseCtx, format):
+            return ctx.db.query(DbItem).order_by(DbItem.id) | database.dumpstream(batch_size=10, format=format)
+
+        app = Application()
+        app.add_interceptor('.*', '*', database.processor)
+        app.add_get_mapping('/export', _export)
+        with app.test_get('/export', {'format': 'json'}) as ret:
+            self.assertEqual([x['id'] for x in ret], list(range(1, 26)))
+        with app.test_get('/export', {'format': 'jsonl'}, parsejson=False) as ret:
+            self.assertEqual(json.loads(ret.splitlines()[-1]), {'id': 25, 'name': 'n0'})
+        with app.test_get('/export', {'format': 'csv'}, parsejson=False) as ret:
+            self.assertEqual(ret.splitlines()[:2], ['id,name', '1,n0'])
+
+        env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/export', 'QUERY_STRING': 'format=json'}
+        body = app.wsgifunc()(env, lambda status, headers: None)
+        chunks = iter(body)
+        self.assertEqual(next(chunks), b'[')
+        next(chunks)
+        self.assertEqual(database.pool_stats().in_use, 1)
+        body.close()  # client disconnected
+        self.assertEqual(database.pool_stats().in_use, 0)
+
+    def test_dumprows(self):
+        with database.make_session() as session:
+            query = session.query(DbItem).filter(DbItem.name == 'n1').order_by(DbItem.id)
+            self.assertEqual(query | database.dumprows(), query | database.dumpall)
+            self.assertEqual((query | database.dumprows([DbItem.name]))[:1], [{'name': 'n1'}])
+            page = query | database.dumppage(2, 5, columns=True)
+            self.assertEqual((page.totalNum, page.list), (8, (query | database.dumpall)[5:]))
+            stream = query | database.dumpstream(batch_size=3, format='jsonl', columns=[DbItem.id])
+            self.assertEqual(''.join(stream).splitlines(), ['{"id": %d}' % i for i in range(2, 26, 3)])
+
+
+class TestBulk(DatabaseTestCase):
+    def test_bulk_insert(self):
+        from lessweb import Model
+
+        class Item(Model):
+            name: str
+
+        item = Item()
+        item.name = 'model'
+        with database.make_session() as session:
+            rows = [{'name': 'd%d' % i, 'unknown': 1} for i in range(5)] + [item, DbItem(name='db')]
+            self.assertEqual(DbItem.bulk_insert(session, rows, chunk_size=2), 7)
+            self.assertEqual(database.bulk_insert(session, DbItem, [{'name': 'k'}] * 3, return_keys=True),
+                             [8, 9, 10])
+            session.commit()
+            names = [x.name for x in session.query(DbItem).order_by(DbItem.id)]
+            self.assertEqual(names, ['d0', 'd1', 'd2', 'd3', 'd4', 'model', 'db', 'k', 'k', 'k'])
+
+    def test_bulk_upsert(self):
+        with database.make_session() as session:
+            DbItem.bulk_insert(session, [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}])
+            rows = [{'id': 2, 'name': 'B'}, {'id': 3, 'name': 'C'}]
+            self.assertEqual(DbItem.bulk_upsert(session, rows), 2)
+            self.assertEqual(DbItem.bulk_upsert(session, [{'id': 1, 'name': 'x'}], update=[]), 1)
+            session.commit()
+            self.assertEqual([(x.id, x.name) for x in session.query(DbItem).order_by(DbItem.id)],
+                             [(1, 'a'), (2, 'B'), (3, 'C')])
+
+
+class TestQueryCache(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        with database.make_session() as session:
+            DbItem.bulk_insert(session, [{'name': 'a'}, {'name': 'b'}])
+            session.commit()
+
+    def tearDown(self):
+        database.global_data.query_cache = None
+        super().tearDown()
+
+    def check_cache(self, cache):
+        with database.make_session() as session:
+            query = session.query(DbItem).order_by(DbItem.id)
+            self.assertEqual(len(query | database.dumpcached()), 2)
+            session.execute(DbItem.__table__.insert(), {'name': 'core'})
+            session.commit()
+            self.assertEqual(len(query | database.dumpcached()), 3)  # invalidated by the commit
+            self.assertEqual(len(query | database.dumpcached()), 3)
+            self.assertEqual(len(query.filter(DbItem.id == 1) | database.dumpcached(columns=[DbItem.id])), 1)
+
+            session.add(DbItem(name='c'))
+            session.flush()
+            self.assertEqual(len(query | database.dumpcached()), 4)  # uncommitted writes bypass the cache
+            session.rollback()
+            self.assertEqual(len(query | database.dumpcached()), 3)
+
+            with database.make_session() as other:
+                other.query(DbItem).filter(DbItem.id == 1).update({'name': 'x'})
+                other.commit()
+            self.assertEqual((query | database.dumpcached())[0]['name'], 'x')
+            for _ in range(2):  # changing a result (after a miss, then after a hit) leaves the cached one intact
+                rows = query | database.dumpcached()
+                rows[0]['name'] = 'changed'
+                rows.pop()
+            self.assertEqual([x['name'] for x in query | database.dumpcached()], ['x', 'b', 'core'])
+        stats = cache.stats()
+        self.assertEqual((stats.hits, stats.misses, stats.invalidations), (5, 4, 2))
+
+    def test_local(self):
+        self.check_cache(database.init_query_cache(database.LocalQueryCache(maxsize=10)))
+
+    def test_redis(self):
+        import fakeredis
+        self.check_cache(database.init_query_cache(database.RedisQueryCache(fakeredis.FakeRedis())))
+
+
+class TestReplica(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.replica_uri = 'sqlite:///' + os.path.join(self.tmpdir.name, 'replica.db')
+        self.init_options = dict(replicas=[self.replica_uri, 'sqlite:////nonexistent/dir/replica.db'],
+                                 sticky_seconds=60)
+        database.global_data.db_engine.dispose()
+        database.init(dburi=self.dburi, echo=False, **self.init_options)
+        database.create_all(DbItem)
+        engine = database.global_data.replicas.engines[0]
+        DbItem.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(DbItem.__table__.insert(), [{'name': 'replica'}])
+
+    def tearDown(self):
+        for engine in database.global_data.replicas.engines:
+            engine.dispose()
+        super().tearDown()
+
+    def test_routing(self):
+        from lessweb import Application
+        from lessweb.plugin.database import DatabaseCtx
+
+        def _list(ctx: DatabaseCtx):
+            return [x.name for x in ctx.db.query(DbItem)]
+
+        @database.replica
+        def _search(ctx: DatabaseCtx):
+            return _list(ctx)
+
+        def _add(ctx: DatabaseCtx, name):
+            ctx.db.add(DbItem(name=name))
+            ctx.db.commit()
+            return _list(ctx)
+
+        app = Application()
+        app.add_interceptor('.*', '*', database.processor)
+        app.add_get_mapping('/list', _list)
+        app.add_post_mapping('/search', _search)
+        app.add_post_mapping('/add', _add)
+        for _ in range(3):  # the unreachable replica is skipped
+            with app.test_get('/list') as ret:
+                self.assertEqual(ret, ['replica'])
+        with app.test_post('/search') as ret:
+            self.assertEqual(ret, ['replica'])
+        resp = app.request('/add', 'POST', {'name': 'a'})
+        self.assertEqual(resp.data, b'["a"]')
+        cookie = resp.headers['Set-Cookie'].split(';')[0]
+        self.assertTrue(cookie.startswith('lwdbsticky='))
+        with app.test_get('/list', headers={'Cookie': cookie}) as ret:
+            self.assertEqual(ret, ['a'])  # reads its own write
+
+        stats = database.pool_stats()
+        self.assertEqual([r.failures for r in stats.replicas], [0, 1])
+        self.assertEqual(stats.replicas[0].in_use, 0)
+
+    def test_dumppage_count_on_replica(self):
+        with database.make_session(replica=True) as session:
+            page = session.query(DbItem) | database.dumppage(1, 10, count_concurrently=True)
+            self.assertEqual((page.totalNum, [x['name'] for x in page.list]), (1, ['replica']))
+
+    def test_fallback(self):
+        replicas = database.global_data.replicas
+        replicas.mark_down(0)
+        with database.make_session(replica=True) as session:
+            self.assertEqual(session.query(DbItem).count(), 0)  # the primary
+        self.assertEqual(replicas.fallbacks, 1)
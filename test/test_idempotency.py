@@ -0,0 +1,84 @@
+import threading
+from unittest import TestCase
+
+import fakeredis
+
+from lessweb import Application, Context, BadRequest
+from lessweb.plugin import redis as redis_plugin
+from lessweb.plugin.idempotency import idempotency, RedisIdempotencyStore
+
+
+class TestIdempotency(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.proceed.set()
+
+    def make_app(self, guard):
+        def _create_order(ctx: Context, item: str):
+            self.calls.append(item)
+            self.started.set()
+            self.proceed.wait(2)
+            if item == 'bad':
+                raise BadRequest('bad item')
+            if item == 'boom':
+                raise RuntimeError('boom')
+            ctx.status_code, ctx.reason = 201, 'Created'
+            ctx.set_header('Location', '/orders/%d' % len(self.calls))
+            return {'id': len(self.calls), 'item': item}
+
+        app = Application()
+        app.add_interceptor('.*', '*', guard)
+        app.add_post_mapping('/orders', _create_order)
+        return app
+
+    def post(self, app, item='book', key='k1'):
+        headers = {'Idempotency-Key': key} if key else None
+        return app.request('/orders', method='POST', data={'item': item}, headers=headers)
+
+    def check_replay(self, guard):
+        app = self.make_app(guard)
+        first, second = self.post(app), self.post(app)
+        self.assertEqual((first.status_code, second.status_code), (201, 201))
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(second.headers['Location'], '/orders/1')
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.post(app, key='k2').data, b'{"id": 2, "item": "book"}')
+        self.assertEqual(self.post(app, key=None).status_code, 201)
+        self.assertEqual(self.post(app, item='pen').status_code, 422)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(guard.stats(), {'executed': 2, 'replayed': 1, 'conflicts': 0, 'mismatches': 1})
+
+    def test_local(self):
+        self.check_replay(idempotency())
+
+    def test_redis(self):
+        redis_plugin.init(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+        self.check_replay(idempotency(RedisIdempotencyStore()))
+
+    def test_in_flight(self):
+        guard = idempotency()
+        app = self.make_app(guard)
+        self.proceed.clear()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.post(app)))
+        thread.start()
+        self.started.wait(2)
+        ret = self.post(app)
+        self.assertEqual((ret.status_code, ret.headers['Retry-After']), (409, '1'))
+        self.proceed.set()
+        thread.join()
+        self.assertEqual(results[0].status_code, 201)
+        self.assertEqual(self.post(app).data, results[0].data)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_errors(self):
+        redis_plugin.init(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+        app = self.make_app(idempotency(RedisIdempotencyStore()))
+        self.assertEqual(self.post(app, item='bad').status_code, 400)
+        ret = self.post(app, item='bad')
+        self.assertEqual((ret.status_code, ret.data), (400, b'bad item'))  # client errors are replayed
+        self.assertEqual(self.post(app, item='boom', key='k2').status_code, 500)
+        self.assertEqual(self.post(app, item='boom', key='k2').status_code, 500)  # released: runs again
+        self.assertEqual(self.calls, ['bad', 'boom', 'boom'])
@@ -0,0 +1,36 @@
+import os
+from unittest import TestCase
+
+from lessweb import Application, Context
+from lessweb.loadtest import Request, load_test, format_report, _percentile
+
+
+def _hello(ctx: Context):
+    return 'Hello, world!'
+
+
+def hello_app():
+    app = Application()
+    app.add_get_mapping('/hello', _hello)
+    return app
+
+
+class TestLoadTest(TestCase):
+    def test_percentile(self):
+        ordered = list(range(1, 101))
+        self.assertEqual([_percentile(ordered, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertIsNone(_percentile([], 50))
+
+    def test_load_test(self):
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        result = load_test('test.test_loadtest:hello_app', ['GET /hello@3', Request('GET', '/missing')],
+                           mode='wsgiref', concurrency=4, duration=1, warmup=0.2, seed=0, pythonpath=[root])
+        self.assertEqual(set(result.statuses), {'200', '404'})
+        self.assertEqual(sum(result.statuses.values()), result.requests)
+        self.assertGreater(result.statuses['200'], result.statuses['404'])
+        self.assertEqual((result.failures, result.errors), ({}, result.statuses['404']))
+        latency = result.latency_ms
+        self.assertTrue(0 < latency.p50 <= latency.p95 <= latency.p99 <= latency.max)
+        self.assertGreater(result.throughput, 0)
+        self.assertGreater(result.server.peak_rss_mb, 0)
+        self.assertIn('test.test_loadtest:hello_app', format_report([result]))
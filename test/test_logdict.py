@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from lessweb.logdict import LogDict
+from lessweb.utils import static_dict
+
+
+class TestLogDict(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'table.log')
+
+    def test_incremental(self):
+        with static_dict(self.path, backend='log') as data:
+            data.update({i: {'n': i} for i in range(100)})
+        size = os.path.getsize(self.path)
+        with static_dict(self.path, backend='log') as data:
+            self.assertEqual((len(data), data[7]), (100, {'n': 7}))
+            self.assertEqual(len(data._values), 1)  # other values are not unpickled
+            data[7] = {'n': 'seven'}
+            del data[8]
+            self.assertNotIn(8, data)
+            self.assertEqual(data.pop(9), {'n': 9})
+        self.assertLess(os.path.getsize(self.path) - size, 200)  # only the changes are appended
+        with static_dict(self.path, backend='log') as data:
+            self.assertEqual((len(data), data[7], data.get(8)), (98, {'n': 'seven'}, None))
+
+    def test_no_change_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with static_dict(self.path, backend='log') as data:
+                data['a'] = 1
+                raise RuntimeError()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_concurrent(self):
+        with LogDict.open(self.path) as data:
+            data['a'] = 1
+        reader, writer = LogDict(self.path), LogDict(self.path, compact_ratio=0.4, compact_min_bytes=0)
+        reader.load()
+        writer.load()
+        writer['a'], writer['b'] = 2, 3
+        writer.commit()
+        writer['a'] = 4
+        writer.commit()  # compacted: the file is replaced
+        self.assertNotEqual(os.stat(self.path).st_ino, reader._ino)
+        self.assertEqual(dict(reader), {'a': 1})  # still reads its snapshot
+        reader['c'] = 5
+        reader.commit()  # sees the commits of the writer first
+        self.assertEqual(dict(reader), {'a': 4, 'b': 3, 'c': 5})
+        reader.close()
+        writer.close()
+
+    def test_compaction(self):
+        with LogDict.open(self.path, compact_ratio=0.4, compact_min_bytes=1000) as data:
+            data['big'] = 'x' * 2000
+        size = os.path.getsize(self.path)
+        with LogDict.open(self.path, compact_ratio=0.4, compact_min_bytes=1000) as data:
+            data['big'] = 'y' * 2000
+        self.assertLess(os.path.getsize(self.path), size + 100)
+        with LogDict.open(self.path) as data:
+            self.assertEqual(data['big'], 'y' * 2000)
+        self.assertEqual([name for name in os.listdir(self.dir) if name.endswith('.tmp')], [])
+
+    def test_incomplete_record(self):
+        with LogDict.open(self.path) as data:
+            data['a'] = 1
+        with open(self.path, 'ab') as f:
+            f.write(LogDict._record(1, 'b', 2)[:-3])  # crashed writer
+        with LogDict.open(self.path) as data:
+            self.assertEqual(dict(data), {'a': 1})
+            data['c'] = 3
+        with LogDict.open(self.path) as data:
+            self.assertEqual(dict(data), {'a': 1, 'c': 3})
+
+    def test_json_atomic(self):
+        path = os.path.join(self.dir, 'sub', 'table.json')
+        with static_dict(path) as data:
+            data['a'] = [1]
+        with open(path) as f:
+            self.assertEqual(json.load(f), {'a': [1]})
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['table.json'])
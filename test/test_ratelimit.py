@@ -0,0 +1,90 @@
+from unittest import TestCase
+
+import fakeredis
+from redis.exceptions import ConnectionError
+
+from lessweb import Application, Context
+from lessweb.plugin import redis as redis_plugin
+from lessweb.plugin.ratelimit import rate_limit
+
+
+class _DownRedis:
+    def eval(self, *args):
+        raise ConnectionError('down')
+
+    evalsha = eval
+
+
+class TestRateLimit(TestCase):
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        redis_plugin.init(connection_class=fakeredis.FakeConnection, server=self.server)
+
+    def make_app(self, limiter):
+        calls = []
+
+        def _hello(ctx: Context):
+            calls.append(1)
+            return 'hello'
+
+        app = Application()
+        app.add_interceptor('.*', '*', limiter)
+        app.add_get_mapping('/hello', _hello)
+        return app, calls
+
+    def request(self, app, ip='1.2.3.4', **headers):
+        return app.request('/hello', env={'REMOTE_ADDR': ip}, headers=headers or None)
+
+    def check_limited(self, limiter):
+        app, calls = self.make_app(limiter)
+        statuses = [self.request(app).status_code for _ in range(4)]
+        self.assertEqual(statuses, [200, 200, 200, 429])
+        self.assertEqual(self.request(app, ip='5.6.7.8').status_code, 200)
+        ret = self.request(app)
+        self.assertEqual(ret.status_code, 429)
+        self.assertTrue(int(ret.headers['Retry-After']) >= 1)
+        self.assertEqual(len(calls), 4)  # the dealer is not called for limited requests
+        stats = limiter.stats()
+        self.assertEqual((stats.allowed, stats.limited), (4, 2))
+
+    def test_token_bucket(self):
+        self.check_limited(rate_limit(1, per=60, burst=3))
+
+    def test_sliding_window(self):
+        self.check_limited(rate_limit(3, per=60, algorithm='sliding_window'))
+
+    def test_local(self):
+        limiter = rate_limit(3, per=60, algorithm='sliding_window', backend='local')
+        self.check_limited(limiter)
+        self.assertEqual(limiter.stats().fallbacks, 0)
+
+    def test_one_round_trip(self):
+        limiter = rate_limit(10, per=60)
+        client = redis_plugin.session()
+        limiter.redis = client
+        for _ in range(3):
+            self.assertEqual(limiter.hit('k'), (True, 0.0))
+        self.assertEqual(client.stats().round_trips, 3)
+        client.script_flush()
+        self.assertEqual(limiter.hit('k'), (True, 0.0))  # EVALSHA fails, then EVAL
+        self.assertEqual(limiter.hit('k'), (True, 0.0))
+        self.assertEqual(client.stats().round_trips, 3 + 1 + 2 + 1)
+
+    def test_header_key(self):
+        limiter = rate_limit(1, per=60, key='header:X-Api-Key')
+        app, calls = self.make_app(limiter)
+        self.assertEqual(self.request(app, X_API_KEY='a').status_code, 200)
+        self.assertEqual(self.request(app, X_API_KEY='a').status_code, 429)
+        self.assertEqual(self.request(app, X_API_KEY='b').status_code, 200)
+        self.assertEqual(self.request(app).status_code, 200)  # no key: not limited
+
+    def test_fallback(self):
+        limiter = rate_limit(2, per=60, redis=_DownRedis())
+        app, calls = self.make_app(limiter)
+        statuses = [self.request(app).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(limiter.stats().fallbacks, 3)
+
+        limiter = rate_limit(2, per=60, redis=_DownRedis(), fallback=False)
+        with self.assertRaises(ConnectionError):
+            limiter.hit('k')
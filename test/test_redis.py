@@ -0,0 +1,107 @@
+from unittest import TestCase
+
+import fakeredis
+from redis.exceptions import ConnectionError
+from redis.exceptions import ResponseError
+
+from lessweb import Application, Model
+from lessweb.plugin import redis as redis_plugin
+from lessweb.plugin.redis import RedisCtx
+
+
+class User(Model):
+    id: int
+    name: str
+
+
+def _make_user(id, name):
+    user = User()
+    user.id, user.name = id, name
+    return user
+
+
+class RedisTestCase(TestCase):
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        redis_plugin.init(connection_class=fakeredis.FakeConnection, server=self.server)
+
+
+class TestBatch(RedisTestCase):
+    def test_batch(self):
+        client = redis_plugin.session()
+        client.set('a', 1)
+        with client.batch() as batch:
+            a = batch.incr('a')
+            b = batch.get('b')
+            bad = batch.hincrby('a', 'x')  # wrong type
+            self.assertFalse(a.done())
+        self.assertEqual((a.result(), b.result()), (2, None))
+        with self.assertRaises(ResponseError):
+            bad.result()
+
+        batch = client.batch()
+        c = batch.set('c', 'x')
+        self.assertEqual(c.result(), True)  # sends the batch
+        self.assertEqual(client.stats(), {'commands': 5, 'round_trips': 3})
+
+    def test_models(self):
+        client = redis_plugin.session()
+        client.mset_models({'user:1': _make_user(1, 'a'), 'user:2': _make_user(2, 'b')}, ex=60)
+        users = client.mget_models(['user:1', 'user:3', 'user:2'], User)
+        self.assertEqual(users, [_make_user(1, 'a'), None, _make_user(2, 'b')])
+        self.assertEqual(client.stats().round_trips, 2)
+
+    def test_processor(self):
+        def _counts(ctx: RedisCtx):
+            with ctx.redis.batch() as batch:
+                futures = [batch.incr('n%d' % i) for i in range(20)]
+            return {'sum': sum(f.result() for f in futures), 'round_trips': ctx.redis.stats().round_trips}
+
+        app = Application()
+        app.add_interceptor('.*', '*', redis_plugin.processor)
+        app.add_get_mapping('/counts', _counts)
+        with app.test_get('/counts') as ret:
+            self.assertEqual(ret, {'sum': 20, 'round_trips': 1})
+
+
+class TestPool(RedisTestCase):
+    def check_exhausted(self):
+        pool = redis_plugin.global_data.redis_pool
+        held = pool.get_connection()
+        with self.assertRaises(ConnectionError):
+            redis_plugin.session().get('a')
+        stats = redis_plugin.pool_stats()
+        self.assertEqual((stats.max_connections, stats.in_use, stats.idle, stats.exhausted), (1, 1, 0, 1))
+        pool.release(held)
+        redis_plugin.session().set('a', 1)
+        stats = redis_plugin.pool_stats()
+        self.assertEqual((stats.in_use, stats.idle, stats.checkouts), (0, 1, 2))
+
+    def test_max_connections(self):
+        redis_plugin.init(connection_class=fakeredis.FakeConnection, server=self.server, max_connections=1)
+        self.check_exhausted()
+
+    def test_blocking(self):
+        redis_plugin.init(connection_class=fakeredis.FakeConnection, server=self.server, max_connections=1,
+                          blocking=True, blocking_timeout=0.05)
+        self.assertEqual(redis_plugin.pool_stats().pool, 'BlockingConnectionPool')
+        self.check_exhausted()
+
+    def test_server_down(self):
+        import socket
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]  # nothing listens on it
+        redis_plugin.init(port=port, socket_connect_timeout=0.5)
+        for _ in range(3):
+            with self.assertRaises(ConnectionError):
+                redis_plugin.session().get('a')
+        stats = redis_plugin.pool_stats()
+        self.assertEqual((stats.in_use, stats.exhausted, stats.checkouts), (0, 0, 0))
+
+    def test_url(self):
+        redis_plugin.init(url='redis://:secret@example.com:6380/2', socket_timeout=1.5, health_check_interval=30)
+        kwargs = redis_plugin.global_data.redis_pool.connection_kwargs
+        self.assertEqual((kwargs['host'], kwargs['port'], kwargs['db'], kwargs['password']),
+                         ('example.com', 6380, 2, 'secret'))
+        self.assertEqual((kwargs['socket_timeout'], kwargs['health_check_interval']), (1.5, 30))
@@ -0,0 +1,161 @@
+"""
+Application.run() (aiohttp + StreamingWSGIHandler), served in a child process:
+    LESSWEB_TEST_DIR=<tmpdir> python -m test.test_server <config> <port>
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from unittest import TestCase
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from sqlalchemy import Column, Integer, String
+
+from lessweb import Application, Context
+from lessweb.loadtest import _free_port, _wait_for_port
+from lessweb.plugin import database
+from lessweb.plugin.database import DbModel, DatabaseCtx
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def _stream(ctx: Context):
+    def _1_chunks():
+        threads = set()
+        for i in range(20):
+            threads.add(threading.get_ident())
+            time.sleep(0.001)
+            yield b'%d,' % i
+        yield b'threads=%d' % len(threads)
+
+    return _1_chunks()
+
+
+async def _async_hello(ctx: Context, name='world'):
+    return {'hello': name}
+
+
+def _slow(ctx: Context):
+    """holds its thread until the client removes the file it created"""
+    marker = os.path.join(os.environ['LESSWEB_TEST_DIR'], 'slow')
+    open(marker, 'w').close()
+    deadline = time.monotonic() + 10
+    while os.path.exists(marker) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return {'slow': True}
+
+
+class DbRow(DbModel):
+    __tablename__ = 'server_row'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+
+    def dump(self):
+        return {'id': self.id, 'name': self.name}
+
+
+def _export(ctx: DatabaseCtx):
+    return ctx.db.query(DbRow).order_by(DbRow.id) | database.dumpstream(batch_size=10, format='jsonl')
+
+
+def make_app():
+    database.init(dburi='sqlite:///' + os.path.join(os.environ['LESSWEB_TEST_DIR'], 'test.db'), echo=False)
+    database.create_all(DbRow)
+    with database.make_session() as session:
+        session.query(DbRow).delete()
+        DbRow.bulk_insert(session, [{'name': 'n%d' % i} for i in range(100)])
+        session.commit()
+    app = Application()
+    app.add_interceptor('/export', '*', database.processor)
+    app.add_get_mapping('/export', _export)
+    app.add_get_mapping('/stream', _stream)
+    app.add_get_mapping('/async', _async_hello)
+    app.add_get_mapping('/slow', _slow)
+    return app
+
+
+CONFIGS = {
+    'pool': dict(max_workers=4),
+    'shedding': dict(max_workers=1, max_queue=0, retry_after=7),
+}
+
+
+class ServerTestCase(TestCase):
+    config = 'pool'
+
+    @classmethod
+    def setUpClass(cls):
+        import tempfile
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.port = _free_port()
+        env = dict(os.environ, LESSWEB_TEST_DIR=cls.tmpdir.name,
+                   PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+        cls.process = subprocess.Popen(
+            [sys.executable, '-m', 'test.test_server', cls.config, str(cls.port)],
+            env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _wait_for_port(cls.port, cls.process, 30)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        cls.process.wait(10)
+        cls.tmpdir.cleanup()
+
+    def get(self, path):
+        try:
+            with urlopen('http://127.0.0.1:%d%s' % (self.port, path), timeout=10) as resp:
+                return resp.status, resp.headers, resp.read()
+        except HTTPError as e:
+            return e.code, e.headers, e.read()
+
+
+class TestRun(ServerTestCase):
+    def test_stream(self):
+        for _ in range(3):
+            status, _, body = self.get('/stream')
+            self.assertEqual(status, 200)
+            self.assertEqual(body, b''.join(b'%d,' % i for i in range(20)) + b'threads=1')
+
+    def test_dumpstream(self):
+        results = []
+        clients = [threading.Thread(target=lambda: results.extend(self.get('/export') for _ in range(4)))
+                   for _ in range(4)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        self.assertEqual(len(results), 16)
+        for status, _, body in results:
+            self.assertEqual(status, 200)
+            self.assertEqual([json.loads(line)['id'] for line in body.splitlines()], list(range(1, 101)))
+
+    def test_async_dealer(self):
+        status, _, body = self.get('/async?name=lessweb')
+        self.assertEqual((status, body), (200, b'{"hello": "lessweb"}'))
+
+
+class TestShedding(ServerTestCase):
+    config = 'shedding'
+
+    def test_503(self):
+        marker = os.path.join(self.tmpdir.name, 'slow')
+        results = []
+        first = threading.Thread(target=lambda: results.append(self.get('/slow')))
+        first.start()
+        deadline = time.monotonic() + 10
+        while not os.path.exists(marker) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        status, headers, _ = self.get('/async')  # the only worker is busy and max_queue=0
+        self.assertEqual((status, headers['Retry-After']), (503, '7'))
+        os.remove(marker)
+        first.join()
+        self.assertEqual(results[0][0], 200)
+        self.assertEqual(self.get('/async')[0], 200)
+
+
+if __name__ == '__main__':
+    make_app().run(port=int(sys.argv[2]), **CONFIGS[sys.argv[1]])
@@ -226,3 +226,170 @@ class TestUsage(TestCase):
             self.assertEquals(ret, {'ans': '[DELETE23]'})
         with app.test_delete('/del/1/2') as ret:
             self.assertEquals(ret, {'ans': 'DELETE12'})
+
+    def test_max_concurrency(self):
+        import threading
+        entered, leave = threading.Event(), threading.Event()
+
+        def _report():
+            entered.set()
+            leave.wait(5)
+            return {'ans': 'done'}
+
+        app = Application()
+        app.add_get_mapping('/report', _report, max_concurrency=1, retry_after=3)
+        app.add_get_mapping('/cheap', add3)
+        first = threading.Thread(target=app.request, args=('/report',))
+        first.start()
+        entered.wait(5)
+        ret = app.request('/report')
+        self.assertEqual(ret.status_code, 503)
+        self.assertEqual(ret.headers['Retry-After'], '3')
+        with app.test_get('/cheap') as ret:
+            self.assertEqual(ret, {'ans': 'xy'})
+        leave.set()
+        first.join()
+        stats = app.concurrency_stats().mapping['GET /report']
+        self.assertEqual((stats.active, stats.admitted, stats.rejected), (0, 1, 1))
+
+    def test_coalesce(self):
+        import threading
+        calls, joined = [], threading.Semaphore(0)
+
+        def _items(page:int):
+            calls.append(page)
+            for _ in range(5 if page == 1 else 0):  # every request has joined the flight
+                joined.acquire(timeout=5)
+            return {'page': page, 'calls': len(calls)}
+
+        app = Application()
+        app.add_get_mapping('/items', _items, coalesce=True, coalesce_query='page')
+        coalescer = app.mapping[0].coalescer
+        join = coalescer._join
+
+        def _join(key):
+            ret = join(key)
+            joined.release()
+            return ret
+
+        coalescer._join = _join
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(app.request('/items?page=1&_t=%d' % i)))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual({r.data for r in results}, {b'{"page": 1, "calls": 1}'})
+        stats = app.concurrency_stats().coalesce['GET /items']
+        self.assertEqual((stats.executions, stats.shared, stats.inflight), (1, 4, 0))
+        with app.test_get('/items', {'page': 2}) as ret:
+            self.assertEqual(ret, {'page': 2, 'calls': 2})
+
+    def test_coalesce_credentials(self):
+        import threading
+        both = threading.Barrier(2, timeout=5)  # broken if one request waited for the other's response
+
+        def _me(ctx:Context):
+            both.wait()
+            return {'user': ctx.get_header('Authorization')}
+
+        app = Application()
+        app.add_get_mapping('/me', _me, coalesce=True)
+        results = {}
+        threads = [threading.Thread(target=lambda user=user: results.update(
+            {user: app.request('/me', headers={'Authorization': user}).data})) for user in ('alice', 'bob')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {'alice': b'{"user": "alice"}', 'bob': b'{"user": "bob"}'})
+        stats = app.concurrency_stats().coalesce['GET /me']
+        self.assertEqual((stats.executions, stats.shared), (2, 0))
+
+    def test_deadline(self):
+        import time
+
+        def _slow(ctx:Context):
+            time.sleep(0.1)
+            return {'ans': 'late'}
+
+        def _polite(ctx:Context):
+            remaining = ctx.remaining()
+            ctx.check_deadline()
+            return {'ans': remaining is not None and remaining <= 1}
+
+        app = Application(timeout=1)
+        app.add_get_mapping('/slow', _slow, timeout=0.05)
+        app.add_get_mapping('/polite', _polite)
+        with app.test_get('/slow', status_code=504) as ret:
+            self.assertEqual(ret, 'gateway timeout')
+        with app.test_get('/polite') as ret:
+            self.assertEqual(ret, {'ans': True})
+
+    def test_deadline_expired_on_entry(self):
+        import threading
+        entered, leave = threading.Event(), threading.Event()
+
+        def _report():
+            entered.set()
+            leave.wait(5)
+            return {'ans': 'done'}
+
+        app = Application()
+        app.add_get_mapping('/report', _report, max_concurrency=1, max_queue=1, timeout=1)
+        app.add_get_mapping('/expired', _report, timeout=0)
+        with app.test_get('/expired', status_code=504) as ret:
+            self.assertEqual(ret, 'gateway timeout')
+        self.assertFalse(entered.is_set())
+        first = threading.Thread(target=app.request, args=('/report',))
+        first.start()
+        entered.wait(5)
+        app.mapping[0].timeout = 0.05  # the queued request reaches its deadline before a slot is free
+        ret = app.request('/report')
+        self.assertEqual(ret.status_code, 504)
+        leave.set()
+        first.join()
+
+    def test_defer(self):
+        import threading
+        done, order = threading.Event(), []
+
+        def _audit(name):
+            order.append('audit:' + name)
+            done.set()
+
+        def _create(ctx:Context, name):
+            ctx.defer(_audit, name)
+            order.append('create:' + name)
+            return {'ans': name}
+
+        app = Application()
+        app.add_post_mapping('/create', _create)
+        with app.test_post('/create', {'name': 'x'}) as ret:
+            self.assertEqual(ret, {'ans': 'x'})
+            self.assertTrue(done.wait(5))
+        self.assertEqual(order, ['create:x', 'audit:x'])
+        app.background.shutdown()
+        self.assertEqual(app.background.stats().completed, 1)
+
+    def test_event_stream(self):
+        from lessweb import EventStream, ServerSentEvent
+
+        def _events():
+            yield ServerSentEvent({'n': 1}, event='status', id=1)
+            yield None
+            yield 'done'
+
+        async def _aevents():
+            yield 'async'
+
+        app = Application()
+        app.add_get_mapping('/events', lambda: EventStream(_events(), heartbeat=60, retry=500))
+        app.add_get_mapping('/aevents', lambda: EventStream(_aevents()))
+        ret = app.request('/events')
+        self.assertEqual(ret.headers['Content-Type'], 'text/event-stream; charset=utf-8')
+        self.assertEqual(ret.data, b'retry: 500\n\nevent: status\nid: 1\ndata: {"n": 1}\n\ndata: done\n\n')
+        ret = app.request('/aevents')
+        self.assertEqual(ret.data, b':\n\ndata: async\n\n')